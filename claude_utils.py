@@ -1,8 +1,14 @@
 # claude_utils.py  —  замена openai_utils.py на Anthropic Claude API
 
 import os
+import re
+import time
+import base64
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -15,8 +21,73 @@ CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "claude-sonnet-5")
 #                поднять MAX_OUTPUT_TOKENS, иначе ответ может обрезаться).
 _THINKING_MODE = os.getenv("THINKING_MODE", "disabled").lower()
 
+# Маршрутизация по задачам: у каждого вызова модели есть задача (task), а модель, режим
+# размышлений и таймаут запроса берутся из таблицы. Ответ пользователю — основная модель,
+# фоновые и классификационные вызовы (сводки, темы, реакции) — быстрый дешёвый tier:
+# качество им почти не нужно, а по числу вызовов они сравнимы с ответами.
+# Переопределение: MODEL_ROUTES="reaction=claude-haiku-4-5:disabled:5,summary=:adaptive"
+# (task=model[:thinking[:timeout_sec]], пустое поле — значение по умолчанию).
+CLAUDE_FAST_MODEL = os.getenv("CLAUDE_FAST_MODEL", "claude-haiku-4-5")
+
+TASK_REPLY = "reply"
+TASK_SUMMARY = "summary"
+TASK_LONG_TERM = "long_term"
+TASK_TOPICS = "topics"
+TASK_REACTION = "reaction"
+
+# task -> (model, thinking, timeout_sec); model=None — CLAUDE_MODEL, timeout=0 — по умолчанию SDK
+_DEFAULT_ROUTES: Dict[str, Tuple[Optional[str], str, float]] = {
+    TASK_REPLY: (None, _THINKING_MODE, 0.0),
+    TASK_SUMMARY: (CLAUDE_FAST_MODEL, "disabled", 30.0),
+    TASK_LONG_TERM: (CLAUDE_FAST_MODEL, "disabled", 30.0),
+    TASK_TOPICS: (CLAUDE_FAST_MODEL, "disabled", 15.0),
+    TASK_REACTION: (CLAUDE_FAST_MODEL, "disabled", 8.0),
+}
+
+
+def _parse_routes(spec: str) -> Dict[str, Tuple[Optional[str], str, float]]:
+    routes = dict(_DEFAULT_ROUTES)
+    for part in (spec or "").split(","):
+        task, _, value = part.partition("=")
+        task = task.strip()
+        if not task or not value:
+            continue
+        model, thinking, timeout = (value.split(":") + ["", ""])[:3]
+        base = routes.get(task, _DEFAULT_ROUTES[TASK_REPLY])
+        try:
+            routes[task] = (
+                model.strip() or base[0],
+                thinking.strip().lower() or base[1],
+                float(timeout) if timeout.strip() else base[2],
+            )
+        except ValueError:
+            logger.warning("Bad MODEL_ROUTES entry ignored: %r", part)
+    return routes
+
+
+_routes = _parse_routes(os.getenv("MODEL_ROUTES", ""))
+
+
+def route_for(task: str) -> Tuple[str, str, float]:
+    """(model, thinking, timeout_sec) для задачи; неизвестная задача идёт как reply."""
+    model, thinking, timeout = _routes.get(task) or _routes[TASK_REPLY]
+    return model or os.getenv("CLAUDE_MODEL", CLAUDE_MODEL), thinking, timeout
+
+# Prompt caching: точки кэша (cache_control) на стабильных секциях system и на префиксе
+# истории. Порядок кэша у API: tools → system → messages, поэтому всё волатильное
+# (дата/время, сводка, scope с ID автора, выбранные факты) передаётся отдельно через
+# volatile_note, ПОСЛЕ последней точки кэша: в system оно сбрасывало бы кэш всей истории.
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "1") == "1"
+_CACHE_CONTROL = {"type": "ephemeral"}
+
 # --------- Anthropic SDK init ---------
+# LAZY_INIT=1 (по умолчанию): SDK импортируется и клиент создаётся при первом вызове
+# модели — пропущенные сообщения в группах (большая часть трафика) не платят за импорт
+# anthropic (~сотни мс холодного старта). LAZY_INIT=0 — как раньше, при импорте модуля.
+LAZY_INIT = os.getenv("LAZY_INIT", "1") == "1"
+
 _client = None
+_client_lock = threading.Lock()
 
 
 def _init_client():
@@ -27,26 +98,165 @@ def _init_client():
     if not api_key:
         logger.error("ANTHROPIC_API_KEY is missing in environment")
         return
-    try:
-        import anthropic
-        _client = anthropic.Anthropic(api_key=api_key)
-        logger.info("Anthropic client initialized, model=%s", CLAUDE_MODEL)
-    except Exception as e:
-        logger.error("Anthropic client init failed: %s", e)
+    with _client_lock:  # группы диалогов обрабатываются в потоках
+        if _client is not None:
+            return
+        try:
+            t0 = time.perf_counter()
+            import anthropic
+            _client = anthropic.Anthropic(api_key=api_key)
+            logger.info("Anthropic client initialized in %dms, model=%s",
+                        (time.perf_counter() - t0) * 1000, CLAUDE_MODEL)
+        except Exception as e:
+            logger.error("Anthropic client init failed: %s", e)
 
 
-_init_client()
+if not LAZY_INIT:
+    _init_client()
 
 
 # ---- Approximate token counting ----
-# Claude не имеет публичного локального токенизатора (как tiktoken у OpenAI).
-# Используем приближение ~4 символа = 1 токен (аналогично fallback в старом коде).
+# Claude не имеет публичного локального токенизатора (как tiktoken у OpenAI). Раньше было
+# «4 символа = 1 токен» и 6400 символов на картинку — для русского текста это сильно мимо
+# (кириллица дороже латиницы). Теперь оценка по составу текста: своя цена символа для
+# кириллицы, латиницы, цифр, пробелов, пунктуации, эмодзи и прочего; картинка — по размеру.
+# Цены подбираются по count_tokens (см. token_bench.py) и задаются env TOKEN_RATES.
+
+_SCRIPT_CLASSES = (
+    ("cyr", re.compile(r"[\u0400-\u04FF]")),
+    ("lat", re.compile(r"[A-Za-z]")),
+    ("digit", re.compile(r"[0-9]")),
+    ("space", re.compile(r"\s")),
+    ("punct", re.compile(r"[!-/:-@\[-`{-~«»—–…№]")),
+    ("emoji", re.compile("[\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D]")),
+)
+# Токенов на символ; "other" — всё, что не попало в классы (CJK, редкие символы)
+_DEFAULT_RATES = {"cyr": 0.38, "lat": 0.27, "digit": 0.5, "space": 0.03,
+                  "punct": 0.7, "emoji": 1.5, "other": 1.0}
+
+# Картинки: модель уменьшает их до 1568 px по длинной стороне и ~1.15 Мпикс,
+# цена — width*height/750 токенов. Размер неизвестен — берём максимум.
+IMAGE_MAX_EDGE = 1568
+IMAGE_MAX_PIXELS = 1_150_000
+_IMAGE_DEFAULT_TOKENS = 1600
+
+
+def _parse_rates(spec: str) -> Dict[str, float]:
+    rates = dict(_DEFAULT_RATES)
+    for part in (spec or "").split(","):
+        k, _, v = part.partition("=")
+        if k.strip() in rates and v.strip():
+            try:
+                rates[k.strip()] = float(v)
+            except ValueError:
+                logger.warning("Bad TOKEN_RATES entry: %r", part)
+    return rates
+
+
+class TokenEstimator:
+    """Локальная оценка токенов: текст — по составу символов, картинка — по размеру.
+
+    Подменяется через set_estimator() (напр., на обёртку с точным подсчётом).
+    """
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None):
+        self.rates = dict(rates or _DEFAULT_RATES)
+
+    @property
+    def tag(self) -> str:
+        """Отпечаток оценщика: сохраняется рядом с оценкой реплики (tokens_v в Messages) —
+        оценки со старым отпечатком (другие TOKEN_RATES) пересчитываются."""
+        spec = ",".join(f"{k}={v:g}" for k, v in sorted(self.rates.items()))
+        return hashlib.sha1(f"{type(self).__name__}:{spec}".encode("utf-8")).hexdigest()[:8]
+
+    def char_counts(self, text: str) -> Dict[str, int]:
+        counts = {name: len(rx.findall(text)) for name, rx in _SCRIPT_CLASSES}
+        counts["other"] = max(len(text) - sum(counts.values()), 0)
+        return counts
+
+    def text_tokens(self, text: str) -> int:
+        if not text:
+            return 0
+        counts = self.char_counts(text)
+        return int(round(sum(self.rates.get(k, 1.0) * n for k, n in counts.items())))
+
+    @staticmethod
+    def image_tokens(width: Optional[int] = None, height: Optional[int] = None) -> int:
+        if not (width and height):
+            return _IMAGE_DEFAULT_TOKENS
+        w, h = float(width), float(height)
+        k = min(1.0, IMAGE_MAX_EDGE / max(w, h))
+        w, h = w * k, h * k
+        if w * h > IMAGE_MAX_PIXELS:
+            k = (IMAGE_MAX_PIXELS / (w * h)) ** 0.5
+            w, h = w * k, h * k
+        return max(int(w * h / 750), 1)
+
+
+_estimator = TokenEstimator(_parse_rates(os.getenv("TOKEN_RATES", "")))
+
+
+def get_estimator() -> TokenEstimator:
+    return _estimator
+
+
+def set_estimator(estimator: TokenEstimator) -> None:
+    global _estimator
+    _estimator = estimator
 
-def _content_len(content: Any) -> int:
-    """Длина контента в символах. Поддерживает как строку, так и список блоков
-    (мультимодальное сообщение: text/image)."""
+
+def image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) из заголовка PNG/JPEG/GIF/WebP без декодирования картинки."""
+    try:
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+        if data[:6] in (b"GIF87a", b"GIF89a"):
+            return int.from_bytes(data[6:8], "little"), int.from_bytes(data[8:10], "little")
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            chunk = data[12:16]
+            if chunk == b"VP8 ":
+                return (int.from_bytes(data[26:28], "little") & 0x3FFF,
+                        int.from_bytes(data[28:30], "little") & 0x3FFF)
+            if chunk == b"VP8L":
+                bits = int.from_bytes(data[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                return (int.from_bytes(data[24:27], "little") + 1,
+                        int.from_bytes(data[27:30], "little") + 1)
+        if data[:2] == b"\xff\xd8":
+            i = 2
+            while i + 9 < len(data):
+                if data[i] != 0xFF:
+                    return None
+                marker = data[i + 1]
+                if marker == 0xFF:  # заполнитель
+                    i += 1
+                    continue
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+                i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    except (IndexError, ValueError):
+        pass
+    return None
+
+
+def _image_block_size(block: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+    """Размер base64-картинки из блока: хватает начала данных (заголовок/маркеры JPEG)."""
+    src = block.get("source") or {}
+    data = src.get("data") if src.get("type") == "base64" else None
+    if not data:
+        return None, None
+    try:
+        size = image_size(base64.b64decode(data[:87384]))  # ~64 КБ, кратно 4
+    except (ValueError, TypeError):
+        size = None
+    return size or (None, None)
+
+
+def _content_tokens(content: Any) -> int:
+    """Оценка контента: строка или список блоков (мультимодальное сообщение: text/image)."""
     if isinstance(content, str):
-        return len(content)
+        return _estimator.text_tokens(content)
     if isinstance(content, list):
         total = 0
         for b in content:
@@ -54,23 +264,161 @@ def _content_len(content: Any) -> int:
                 continue
             btype = b.get("type")
             if btype == "text":
-                total += len(b.get("text", ""))
+                total += _estimator.text_tokens(b.get("text", ""))
             elif btype == "image":
-                total += 6400  # ~1600 токенов на изображение (грубая оценка)
+                # Размер — из заголовка данных (после image_utils это уже уменьшенная
+                # картинка); не разобрали — максимум
+                total += _estimator.image_tokens(*_image_block_size(b))
         return total
     return 0
 
 
-def num_tokens_from_messages(messages: List[Dict[str, Any]], system: str = "") -> int:
+def system_tokens(system: Any) -> int:
+    """Оценка system: строка или список text-блоков (см. build_system)."""
+    if isinstance(system, list):
+        return sum(_estimator.text_tokens(b.get("text", "")) for b in system if isinstance(b, dict))
+    return _estimator.text_tokens(system or "")
+
+
+# ---- Калибровка по count_tokens ----
+# TOKEN_CALIBRATION=1: для текстов от TOKEN_CALIBRATION_MIN_CHARS символов calibrated_tokens
+# берёт точное число из count_tokens API (ответ кэшируется по хэшу текста в контейнере).
+# Только при записи реплики (worker сохраняет оценку с ней) — не при чтении истории: иначе
+# каждая старая реплика без сохранённой оценки стоила бы сетевого вызова (~100 мс) на ходу.
+# Выключено по умолчанию; для подбора TOKEN_RATES хватает token_bench.py.
+TOKEN_CALIBRATION = os.getenv("TOKEN_CALIBRATION", "0") == "1"
+TOKEN_CALIBRATION_MIN_CHARS = int(os.getenv("TOKEN_CALIBRATION_MIN_CHARS", "200"))
+_COUNT_CACHE_MAX = 2048
+_count_cache: "OrderedDict[str, int]" = OrderedDict()
+_count_lock = threading.Lock()
+_count_overhead: Optional[int] = None  # обёртка запроса count_tokens без текста
+
+
+def _count_raw(text: str) -> int:
+    model = os.getenv("CLAUDE_MODEL", CLAUDE_MODEL)
+    r = _client.messages.count_tokens(model=model, messages=[{"role": "user", "content": text}])
+    return int(r.input_tokens)
+
+
+def count_tokens_cached(text: str) -> Optional[int]:
+    """Точное число токенов текста (count_tokens API, без служебной обёртки) или None."""
+    global _count_overhead
+    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    with _count_lock:
+        if key in _count_cache:
+            _count_cache.move_to_end(key)
+            return _count_cache[key]
+    _init_client()
+    if _client is None:
+        return None
+    try:
+        if _count_overhead is None:
+            _count_overhead = _count_raw(".") - 1
+        n = max(_count_raw(text) - _count_overhead, 0)
+    except Exception as e:
+        logger.warning("count_tokens failed: %s", e)
+        return None
+    with _count_lock:
+        _count_cache[key] = n
+        while len(_count_cache) > _COUNT_CACHE_MAX:
+            _count_cache.popitem(last=False)
+    return n
+
+
+def content_tokens(content: Any) -> int:
+    """Оценка токенов контента одной реплики (без служебных), локально."""
+    return _content_tokens(content)
+
+
+def tokens_tag() -> str:
+    """Отпечаток оценок, сохраняемых с репликами: оценщик + режим калибровки."""
+    return _estimator.tag + ("+cal" if TOKEN_CALIBRATION else "")
+
+
+def calibrated_tokens(content: Any) -> int:
+    """Оценка для записи вместе с репликой (`tokens` в Messages, с tokens_tag() в
+    `tokens_v`): при TOKEN_CALIBRATION длинный текст считается точно."""
+    if TOKEN_CALIBRATION and isinstance(content, str) and len(content) >= TOKEN_CALIBRATION_MIN_CHARS:
+        exact = count_tokens_cached(content)
+        if exact is not None:
+            return exact
+    return _content_tokens(content)
+
+
+def stored_tokens(m: Dict[str, Any]) -> int:
+    """Токены контента реплики из истории: сохранённая оценка, если она посчитана текущим
+    оценщиком (tokens_v), иначе — заново, локально."""
+    if m.get("tokens") is not None and m.get("tokens_v") == tokens_tag():
+        return int(m["tokens"])
+    return content_tokens(m.get("content", ""))
+
+
+def message_tokens(content: Any) -> int:
+    """Реплика целиком: per-message overhead + контент."""
+    return 4 + content_tokens(content)
+
+
+def num_tokens_from_messages(messages: List[Dict[str, Any]], system: Any = "") -> int:
     """Approximate token count for system prompt + messages."""
-    tokens = len(system) // 4 + 4          # system overhead
+    tokens = system_tokens(system) + 4      # system overhead
     for m in messages:
-        tokens += 4                         # per-message overhead
-        tokens += _content_len(m.get("content", "")) // 4
+        tokens += message_tokens(m.get("content", ""))
     tokens += 2                             # conversation overhead
     return tokens
 
 
+class TokenBudgeter:
+    """Обрезка истории под бюджет токенов за один проход.
+
+    Стоимость реплики считается один раз и кладётся в неё же (`_tok`; можно передать
+    готовую — напр., из сохранённого `tokens`), сумма поддерживается инкрементально.
+    Раньше каждый шаг trim-а заново считал всю историю — квадратично от её длины.
+    """
+
+    def __init__(self, system: Any = "", *, budget: int):
+        self.base = system_tokens(system) + 4 + 2  # system + conversation overhead
+        self.budget = budget
+
+    @staticmethod
+    def cost(m: Dict[str, Any]) -> int:
+        if m.get("_tok") is None:
+            m["_tok"] = message_tokens(m.get("content", ""))
+        return m["_tok"]
+
+    def total(self, messages: List[Dict[str, Any]]) -> int:
+        return self.base + sum(self.cost(m) for m in messages)
+
+    def trim(self, messages: List[Dict[str, Any]], *,
+             drop_first=None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Режет, пока сумма больше бюджета и осталось больше одной реплики → (kept, removed).
+
+        drop_first(m) — реплики, которые уходят первыми, от старых к новым (scope=hybrid:
+        чужие реплики в группе); затем — самые старые ходы (user+assistant парой).
+        """
+        total = self.total(messages)
+        left = len(messages)
+        removed: List[Dict[str, Any]] = []
+        kept = messages
+        if drop_first is not None:
+            kept = []
+            for m in messages:
+                if total > self.budget and left > 1 and drop_first(m):
+                    removed.append(m)
+                    total -= m["_tok"]
+                    left -= 1
+                else:
+                    kept.append(m)
+        start = 0
+        while total > self.budget and len(kept) - start > 1:
+            pair = (len(kept) - start >= 2 and kept[start]["role"] == "user"
+                    and kept[start + 1]["role"] == "assistant")
+            for m in kept[start:start + (2 if pair else 1)]:
+                removed.append(m)
+                total -= m["_tok"]
+            start += 2 if pair else 1
+        return kept[start:], removed
+
+
 def _to_blocks(content: Any) -> List[Dict[str, Any]]:
     """Приводит контент к списку блоков (для склейки мультимодальных сообщений)."""
     if isinstance(content, list):
@@ -105,6 +453,70 @@ def _ensure_alternation(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     return merged
 
 
+def build_system(*sections: List[str]) -> List[Dict[str, Any]]:
+    """Собирает system из секций в виде text-блоков.
+
+    Каждая секция — список частей (склеиваются через пустую строку). Все секции, кроме
+    последней, получают свою точку кэша; последняя (подсказки, стиль-файрвол) — без неё,
+    её покрывает точка на конце истории. Поэтому и она должна быть стабильной: всё, что
+    меняется от хода к ходу, идёт в volatile_note. Пустые секции пропускаются.
+    """
+    blocks: List[Dict[str, Any]] = []
+    last = len(sections) - 1
+    for i, parts in enumerate(sections):
+        text = "\n\n".join(p for p in (parts or []) if p)
+        if not text:
+            continue
+        block: Dict[str, Any] = {"type": "text", "text": text}
+        if PROMPT_CACHE_ENABLED and i < last:
+            block["cache_control"] = dict(_CACHE_CONTROL)
+        blocks.append(block)
+    return blocks
+
+
+def _mark_history_cache(messages: List[Dict[str, Any]], *, cache: bool,
+                        volatile_note: str = "") -> List[Dict[str, Any]]:
+    """Ставит точку кэша на последний блок истории и добавляет волатильную пометку после неё.
+
+    Следующий ход повторит этот префикс байт-в-байт (пометка в историю не сохраняется),
+    и API прочитает его из кэша. Картинки в историю тоже не сохраняются: если они есть в
+    последнем сообщении, точка встаёт на предыдущее — иначе следующий ход не совпадёт с
+    префиксом и заплатит полную запись в кэш. messages уже прошли _ensure_alternation.
+    """
+    if not messages:
+        return messages
+    out = [dict(m) for m in messages]
+    last = out[-1]
+    if cache and PROMPT_CACHE_ENABLED:
+        target = out[-1]
+        if len(out) > 1 and any(b.get("type") == "image" for b in _to_blocks(target["content"])):
+            target = out[-2]
+        blocks = _to_blocks(target["content"])
+        if blocks:
+            blocks[-1] = dict(blocks[-1], cache_control=dict(_CACHE_CONTROL))
+        target["content"] = blocks
+    if volatile_note:
+        if last["role"] == "user":
+            last["content"] = _to_blocks(last["content"]) + [{"type": "text", "text": volatile_note}]
+        else:
+            out.append({"role": "user", "content": volatile_note})
+    return out
+
+
+def _log_usage(model: str, usage: Dict[str, int], est: int = 0, *,
+               task: str = TASK_REPLY, ms: float = 0.0) -> None:
+    """prompt — фактический вход первого запроса хода (in + cache_read + cache_write),
+    est — локальная оценка того же запроса без инструментов; пара для token_bench.py.
+    task/ms — задача маршрутизации и время всего хода (с итерациями tool use)."""
+    logger.info(
+        "Claude usage task=%s model=%s ms=%d in=%d out=%d cache_read=%d cache_write=%d "
+        "prompt=%d est=%d",
+        task, model, ms, usage.get("input_tokens", 0), usage.get("output_tokens", 0),
+        usage.get("cache_read_input_tokens", 0), usage.get("cache_creation_input_tokens", 0),
+        usage.get("prompt", 0), est,
+    )
+
+
 def _client_tools_only(tools: Optional[List[Dict[str, Any]]]) -> Optional[List[Dict[str, Any]]]:
     """Оставляет только клиентские инструменты (без серверных, у которых есть поле "type",
     напр. web_search_20250305). Используется для graceful-degradation при ошибке."""
@@ -128,18 +540,45 @@ def _extract_text(resp) -> str:
     return "".join(text_parts).strip()
 
 
-def _chat(messages: List[Dict[str, Any]], system: str, max_tokens: int,
+def _chat(messages: List[Dict[str, Any]], system: Any, max_tokens: int,
           tools: Optional[List[Dict[str, Any]]] = None,
-          tool_executor=None) -> str:
+          tool_executor=None,
+          cache_history: bool = False,
+          volatile_note: str = "",
+          on_text=None,
+          task: str = TASK_REPLY) -> str:
+    _init_client()
     if _client is None:
         logger.error("Anthropic client is not configured")
         return "⚠️ Anthropic client is not configured."
 
-    model = os.getenv("CLAUDE_MODEL", CLAUDE_MODEL)
+    model, thinking, timeout = route_for(task)
+    t_start = time.perf_counter()
     safe_messages = _ensure_alternation(messages)
 
     if not safe_messages:
         safe_messages = [{"role": "user", "content": "(пустой контекст)"}]
+    if cache_history or volatile_note:
+        safe_messages = _mark_history_cache(safe_messages, cache=cache_history,
+                                            volatile_note=volatile_note)
+
+    # Usage за весь ход (с учётом итераций tool use) — для контроля эффекта кэша
+    usage_total: Dict[str, int] = {}
+
+    def _call(kwargs: Dict[str, Any]):
+        if on_text is None:
+            return _client.messages.create(**kwargs)
+        # Стриминг: отдаём накопленный текст текущей итерации по мере прихода фрагментов.
+        # Итоговое сообщение то же, что вернул бы create — tool use/pause_turn не меняются.
+        acc = ""
+        with _client.messages.stream(**kwargs) as stream:
+            for chunk in stream.text_stream:
+                acc += chunk
+                try:
+                    on_text(acc)
+                except Exception as e:
+                    logger.warning("on_text callback failed: %s", e)
+            return stream.get_final_message()
 
     def _run(active_tools: Optional[List[Dict[str, Any]]]):
         kwargs: Dict[str, Any] = {
@@ -150,8 +589,10 @@ def _chat(messages: List[Dict[str, Any]], system: str, max_tokens: int,
         # Современные модели (Sonnet 5, Opus 4.6+, Fable) отклоняют temperature/top_p/top_k
         # с 400 — не передаём их. Режимом рассуждений управляем через thinking.
         kwargs["thinking"] = (
-            {"type": "adaptive"} if _THINKING_MODE == "adaptive" else {"type": "disabled"}
+            {"type": "adaptive"} if thinking == "adaptive" else {"type": "disabled"}
         )
+        if timeout > 0:
+            kwargs["timeout"] = timeout  # на один запрос, не на весь ход
         if system:
             kwargs["system"] = system
         if active_tools:
@@ -160,7 +601,14 @@ def _chat(messages: List[Dict[str, Any]], system: str, max_tokens: int,
         # Цикл tool use: Claude может вызвать клиентский инструмент несколько раз.
         # Серверные инструменты (web_search) выполняются на стороне API.
         for _ in range(8):  # защита от зацикливания
-            resp = _client.messages.create(**kwargs)
+            resp = _call(kwargs)
+            usage = getattr(resp, "usage", None)
+            if "prompt" not in usage_total:
+                usage_total["prompt"] = sum(int(getattr(usage, k, 0) or 0) for k in (
+                    "input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"))
+            for k in ("input_tokens", "output_tokens",
+                      "cache_read_input_tokens", "cache_creation_input_tokens"):
+                usage_total[k] = usage_total.get(k, 0) + int(getattr(usage, k, 0) or 0)
 
             # Долгий серверный инструмент мог приостановить ход — продолжаем
             if resp.stop_reason == "pause_turn":
@@ -198,7 +646,7 @@ def _chat(messages: List[Dict[str, Any]], system: str, max_tokens: int,
     try:
         resp = _run(tools)
     except Exception as e:
-        logger.exception("Anthropic API error (tools=%s): %r", bool(tools), e)
+        logger.exception("Anthropic API error (task=%s, tools=%s): %r", task, bool(tools), e)
         if tools:
             try:
                 logger.warning("Retry with client-only tools")
@@ -213,20 +661,32 @@ def _chat(messages: List[Dict[str, Any]], system: str, max_tokens: int,
         else:
             return "⚠️ Не удалось получить ответ от модели."
 
+    _log_usage(model, usage_total, num_tokens_from_messages(safe_messages, system),
+               task=task, ms=(time.perf_counter() - t_start) * 1000)
     return _extract_text(resp)
 
 
 def generate_response(messages: List[Dict[str, Any]], *,
-                      system: str = "",
+                      system: Any = "",
                       max_tokens: int = 800,
                       tools: Optional[List[Dict[str, Any]]] = None,
-                      tool_executor=None) -> str:
+                      tool_executor=None,
+                      cache_history: bool = False,
+                      volatile_note: str = "",
+                      on_text=None) -> str:
     """Генерация ответа Claude. messages — только user/assistant.
+    system — строка или список text-блоков с точками кэша (см. build_system).
     tools — список инструментов для tool use (опционально).
     tool_executor — callable(tool_name, tool_input) -> str (опционально).
+    cache_history — поставить точку кэша на конец истории (prompt caching).
+    volatile_note — волатильная пометка (дата/время, сводка, scope…), добавляется ПОСЛЕ точки кэша.
+    on_text — callable(text_so_far) -> None: включает стриминг (messages.stream), вызывается
+              с накопленным текстом текущей итерации (опционально).
     """
     return _chat(messages, system, max_tokens,
-                 tools=tools, tool_executor=tool_executor)
+                 tools=tools, tool_executor=tool_executor,
+                 cache_history=cache_history, volatile_note=volatile_note,
+                 on_text=on_text, task=TASK_REPLY)
 
 
 def _plain_text(content: Any) -> str:
@@ -246,9 +706,15 @@ def _plain_text(content: Any) -> str:
 
 def summarize_history(
     history: List[Dict[str, Any]],
-    user_context: Optional[Dict[str, Any]] = None
+    user_context: Optional[Dict[str, Any]] = None,
+    *,
+    previous: Optional[str] = None,
 ) -> str:
-    """Суммаризация истории диалога с сохранением персонального контекста."""
+    """Суммаризация истории диалога с сохранением персонального контекста.
+
+    previous — прежняя сводка: тогда history — только реплики после неё, и модель
+    дописывает их в сводку вместо пересказа всего окна заново.
+    """
 
     # Нейтральная фактическая сводка — служебная заметка для памяти, НЕ ответ пользователю.
     # Важно: без шаблонной формы, чтобы стиль оформления не «протекал» в будущие ответы.
@@ -263,8 +729,19 @@ def summarize_history(
 если ответы в нём шаблонные, это старый дефект, не воспроизводи его.
 Это служебная заметка для памяти, а не реплика в чате."""
 
-    # Увеличить количество сообщений и токенов
-    few = [{"role": m["role"], "content": _plain_text(m.get("content", ""))} for m in history[-30:]]
+    if previous:
+        system += f"""
+
+Ниже — прежняя сводка; в диалоге — только реплики после неё. Верни обновлённую сводку
+целиком: дополни прежнюю новым, устаревшее сократи, важное не теряй (до 5 предложений).
+
+Прежняя сводка:
+{previous}"""
+
+    # Увеличить количество сообщений и токенов. При дописывании окно уже ограничено
+    # курсором — режем только первую сводку, иначе курсор «перепрыгнет» реплики.
+    window = history if previous else history[-30:]
+    few = [{"role": m["role"], "content": _plain_text(m.get("content", ""))} for m in window]
 
     # Если есть контекст пользователя, добавить в system
     if user_context:
@@ -275,7 +752,7 @@ def summarize_history(
             user_info += f"Username: @{user_context['username']}\n"
         system += user_info
 
-    return _chat(few, system, max_tokens=600)
+    return _chat(few, system, max_tokens=600, task=TASK_SUMMARY)
 
 
 def create_long_term_summary(
@@ -300,7 +777,7 @@ def create_long_term_summary(
     if user_info.get("first_name"):
         system += f"\n\nИмя пользователя: {user_info['first_name']}"
 
-    return _chat(messages, system, max_tokens=400)
+    return _chat(messages, system, max_tokens=400, task=TASK_LONG_TERM)
 
 
 def extract_topics(messages: List[Dict[str, Any]], max_topics: int = 5) -> List[str]:
@@ -314,7 +791,7 @@ def extract_topics(messages: List[Dict[str, Any]], max_topics: int = 5) -> List[
     few = [{"role": m["role"], "content": _plain_text(m.get("content", ""))} for m in messages[-10:]]
 
     try:
-        result = _chat(few, system, max_tokens=100)
+        result = _chat(few, system, max_tokens=100, task=TASK_TOPICS)
         # Парсим темы
         topics = [t.strip() for t in result.split(",") if t.strip()]
         return topics[:max_topics]
@@ -331,6 +808,80 @@ REACTION_EMOJIS = [
 ]
 
 
+# Локальный префильтр реакций: модель зовём только при явном эмоциональном сигнале —
+# на проходные сообщения она почти всегда отвечает NONE, и такой вызов просто потерян.
+_REACTION_SKIP_RE = re.compile(r"^\s*(/\w|```)")  # команда бота, блок кода
+_URL_RE = re.compile(r"https?://\S+|www\.\S+|@\w+", re.IGNORECASE)
+_EMOJI_RE = re.compile("[\U0001F000-\U0001FAFF\u2600-\u27BF]")
+_REACTION_LEXICON_RE = re.compile(
+    r"(ура\b|поздрав|победи|выиграл|наконец|спасиб|благодар|а?ха-?ха|хах|ахах|лол\b|ржу|"
+    r"круто|класс|супер|огонь|жесть|офиге|обалд|вау\b|ого\b|кошмар|ужас|грустн|жаль\b|"
+    r"люблю|родил|свадьб|день рожд|отпуск|сдал|получилось|новость|"
+    r"\bwow\b|\blol\b|congrat|thanks|\bomg\b|haha)",
+    re.IGNORECASE,
+)
+_REACTION_MAX_CHARS = 600
+_REACTION_LINE_RE = re.compile(r"^\s*(\d+)\s*[:.)\-]\s*(.*)$")
+
+
+def reaction_worthy(text: str) -> bool:
+    """Дешёвая детерминированная проверка: есть ли повод спрашивать модель о реакции.
+
+    Отсекает команды, код, голые ссылки/упоминания и длинные технические тексты; пропускает
+    сообщения с эмодзи, восклицанием, «)))/(((», КАПСОМ или словом из эмоционального словаря.
+    Стикеры и медиа без подписи сюда не доходят (у них нет текста).
+    """
+    t = (text or "").strip()
+    if len(t) < 2 or _REACTION_SKIP_RE.match(t):
+        return False
+    bare = _URL_RE.sub("", t).strip()
+    if not any(ch.isalpha() for ch in bare) and not _EMOJI_RE.search(bare):
+        return False
+    if _EMOJI_RE.search(bare) or _REACTION_LEXICON_RE.search(bare):
+        return True
+    if len(bare) > _REACTION_MAX_CHARS:
+        return False
+    return ("!" in bare or ")))" in bare or "(((" in bare
+            or any(len(w) >= 4 and w.isalpha() and w.isupper() for w in bare.split()))
+
+
+def choose_reactions(texts: List[str]) -> List[str]:
+    """Реакции на несколько сообщений, на которые бот не отвечает, — одним вызовом модели.
+
+    Возвращает список той же длины: эмодзи из REACTION_EMOJIS или '' (не реагировать).
+    Один текст — тот же вызов, что choose_reaction.
+    """
+    texts = [(t or "").strip() for t in texts]
+    if len(texts) <= 1:
+        return [choose_reaction(t) for t in texts]
+    allowed = " ".join(REACTION_EMOJIS)
+    system = (
+        "Ты — Петрович в мессенджере. Тебе показывают пронумерованные сообщения, на которые "
+        "ты НЕ отвечаешь текстом, и для каждого ты решаешь, поставить ли эмодзи-реакцию.\n"
+        f"Разрешённые эмодзи (на сообщение — РОВНО ОДИН): {allowed}\n"
+        "Правило: реагируй ТОЛЬКО когда есть явный повод — эмоция, юмор, новость, достижение, "
+        "что-то яркое или трогательное. На обычные, нейтральные, технические и проходные "
+        "сообщения реакция НЕ нужна. Сомневаешься — не реагируй.\n"
+        "Ответь строками вида «N: эмодзи» или «N: NONE», по одной на сообщение. Без пояснений."
+    )
+    body = "\n".join(f"{i}. {t[:300]}" for i, t in enumerate(texts, 1))
+    out = [""] * len(texts)
+    try:
+        result = _chat([{"role": "user", "content": body}], system,
+                       max_tokens=12 * len(texts), task=TASK_REACTION) or ""
+    except Exception:
+        return out
+    for line in result.splitlines():
+        m = _REACTION_LINE_RE.match(line)
+        if not m or not (1 <= int(m.group(1)) <= len(texts)):
+            continue
+        for e in REACTION_EMOJIS:
+            if e in m.group(2):
+                out[int(m.group(1)) - 1] = e
+                break
+    return out
+
+
 def choose_reaction(text: str) -> str:
     """Подбирает уместный эмодзи-реакцию на сообщение или '' (реагировать не стоит).
 
@@ -351,7 +902,7 @@ def choose_reaction(text: str) -> str:
     )
     few = [{"role": "user", "content": (text or "")[:500]}]
     try:
-        result = (_chat(few, system, max_tokens=12) or "").strip()
+        result = (_chat(few, system, max_tokens=12, task=TASK_REACTION) or "").strip()
     except Exception:
         return ""
     if not result or "NONE" in result.upper():
@@ -0,0 +1,93 @@
+# coldstart.py  —  замер холодного старта Lambda
+"""Сколько стоит холодный старт и на что он уходит.
+
+В Lambda: handler-модуль запоминает `time.perf_counter()` до своих импортов и вызывает
+`mark_init(t0)` после них; в handler — `log_invocation(name)`. На первом вызове контейнера
+в лог уходит `COLDSTART <name> init=…ms first_call_at=…ms loaded=…` (какие тяжёлые пакеты
+уже импортированы), дальше — ничего.
+
+Локально: `python coldstart.py worker_lambda webhook_lambda` — стоимость импорта по пакетам
+из `python -X importtime` (в отдельном процессе, чтобы кэш импорта не искажал цифры).
+"""
+
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Пакеты, ради которых имеет смысл LAZY_INIT (см. claude_utils / dynamo_utils / telegram_utils)
+HEAVY_PACKAGES = ("anthropic", "httpx", "boto3", "botocore", "requests", "urllib3")
+
+_state: Dict[str, Optional[float]] = {"t0": None, "init_ms": None, "reported": 0}
+
+
+def mark_init(t0: float) -> None:
+    """Конец импортов handler-модуля; t0 — perf_counter() до них."""
+    _state["t0"] = t0
+    _state["init_ms"] = (time.perf_counter() - t0) * 1000
+
+
+def loaded_heavy() -> List[str]:
+    return [p for p in HEAVY_PACKAGES if p in sys.modules]
+
+
+def log_invocation(name: str) -> None:
+    """На первом вызове контейнера пишет COLDSTART-строку (только её)."""
+    if _state["reported"] or _state["t0"] is None:
+        return
+    _state["reported"] = 1
+    logger.info(
+        "COLDSTART %s init=%dms first_call_at=%dms loaded=%s",
+        name, _state["init_ms"], (time.perf_counter() - _state["t0"]) * 1000,
+        ",".join(loaded_heavy()) or "-",
+    )
+
+
+# ---------- Локальный профиль импорта ----------
+
+def _importtime(module: str) -> List[Tuple[str, int, int]]:
+    """[(module, self_us, cumulative_us)] из `python -X importtime -c 'import module'`."""
+    import subprocess  # только для локального профиля: в Lambda не импортируем
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=here, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cum_us, name = line[len("import time:"):].split("|", 2)
+            rows.append((name.strip(), int(self_us), int(cum_us)))
+        except ValueError:
+            continue
+    return rows
+
+
+def profile_imports(module: str, top: int = 15) -> str:
+    rows = _importtime(module)
+    by_pkg: Dict[str, int] = {}
+    for name, self_us, _ in rows:
+        root = name.split(".")[0]
+        by_pkg[root] = by_pkg.get(root, 0) + self_us
+    total = next((cum for name, _, cum in rows if name == module), sum(by_pkg.values()))
+    lines = [f"{module}: import {total / 1000:.0f}ms, LAZY_INIT={os.getenv('LAZY_INIT', '1')}"]
+    for pkg, us in sorted(by_pkg.items(), key=lambda kv: -kv[1])[:top]:
+        mark = "  *" if pkg in HEAVY_PACKAGES else ""
+        lines.append(f"  {pkg:<24} {us / 1000:8.1f}ms{mark}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    for mod in sys.argv[1:] or ["worker_lambda", "webhook_lambda", "maintenance_lambda"]:
+        try:
+            print(profile_imports(mod))
+        except RuntimeError as e:
+            print(f"{mod}: {e}")
@@ -1,9 +1,17 @@
 # dynamo_utils.py
 
 import os
+import copy
+import json
 import time
+import zlib
+import hashlib
+import re
+import contextlib
 import logging
-from typing import Optional, List, Dict, Any
+import threading
+from collections import Counter, OrderedDict
+from typing import Optional, List, Dict, Any, Tuple
 
 import boto3
 from boto3.dynamodb.conditions import Key
@@ -11,7 +19,56 @@ from boto3.dynamodb.conditions import Key
 logger = logging.getLogger(__name__)
 
 DDB_ENDPOINT_URL = os.getenv("DDB_ENDPOINT_URL")  # allow local testing
-dynamodb = boto3.resource("dynamodb", endpoint_url=DDB_ENDPOINT_URL) if DDB_ENDPOINT_URL else boto3.resource("dynamodb")
+# LAZY_INIT=1: ресурс создаётся при первом запросе, а не при импорте (см. claude_utils).
+LAZY_INIT = os.getenv("LAZY_INIT", "1") == "1"
+
+
+def _new_resource(session):
+    t0 = time.perf_counter()
+    res = session.resource("dynamodb", endpoint_url=DDB_ENDPOINT_URL) if DDB_ENDPOINT_URL else session.resource("dynamodb")
+    logger.info("DynamoDB resource initialized in %dms (%s)",
+                (time.perf_counter() - t0) * 1000, threading.current_thread().name)
+    return res
+
+
+dynamodb = None if LAZY_INIT else _new_resource(boto3)
+
+# boto3-ресурсы не потокобезопасны, а worker обрабатывает разные диалоги параллельно.
+# Главный поток работает с общим `dynamodb`, остальные получают свой ресурс (из своей
+# сессии) при первом обращении — и переиспользуют его в тёплом контейнере.
+_local = threading.local()
+
+
+def _thread_resource():
+    global dynamodb
+    if threading.current_thread() is threading.main_thread():
+        if dynamodb is None:
+            dynamodb = _new_resource(boto3)
+        return dynamodb
+    res = getattr(_local, "resource", None)
+    if res is None:
+        res = _local.resource = _new_resource(boto3.session.Session())
+    return res
+
+
+class _ThreadLocalTable:
+    """Table, у которого в каждом потоке свой экземпляр (см. _thread_resource)."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def _get(self):
+        tables = getattr(_local, "tables", None)
+        if tables is None:
+            tables = _local.tables = {}
+        tbl = tables.get(self.name)
+        if tbl is None:
+            tbl = tables[self.name] = _thread_resource().Table(self.name)
+        return tbl
+
+    def __getattr__(self, attr):
+        return getattr(self._get(), attr)
+
 
 USERS_TABLE     = os.getenv("USERS_TABLE", "Users")
 CHANNELS_TABLE  = os.getenv("CHANNELS_TABLE", "Channels")
@@ -19,31 +76,185 @@ THREADS_TABLE   = os.getenv("THREADS_TABLE", "Threads")
 MESSAGES_TABLE  = os.getenv("MESSAGES_TABLE", "Messages")
 SUMMARIES_TABLE = os.getenv("SUMMARIES_TABLE", "Summaries")
 SETTINGS_TABLE  = os.getenv("SETTINGS_TABLE",  "Settings")
+UPDATES_TABLE   = os.getenv("UPDATES_TABLE", "Updates")
+
+users_tbl     = _ThreadLocalTable(USERS_TABLE)
+channels_tbl  = _ThreadLocalTable(CHANNELS_TABLE)
+threads_tbl   = _ThreadLocalTable(THREADS_TABLE)
+messages_tbl  = _ThreadLocalTable(MESSAGES_TABLE)
+summaries_tbl = _ThreadLocalTable(SUMMARIES_TABLE)
+settings_tbl  = _ThreadLocalTable(SETTINGS_TABLE)
+updates_tbl   = _ThreadLocalTable(UPDATES_TABLE)
+
+# ---------- Кэш чтений тёплого контейнера ----------
+# Тёплый контейнер Lambda раз за разом обслуживает одни и те же активные чаты, а каждый
+# ход заново читал настройки, автора, канал, тред и сводку. Держим их в LRU с TTL:
+# свои записи кладём в кэш сразу (write-through), чужие (другие контейнеры,
+# maintenance_lambda) видны не позже чем через DDB_CACHE_TTL_SEC.
+
+DDB_CACHE_ENABLED   = os.getenv("DDB_CACHE_ENABLED", "1") == "1"
+DDB_CACHE_TTL_SEC   = float(os.getenv("DDB_CACHE_TTL_SEC", "60"))
+DDB_CACHE_MAX_ITEMS = int(os.getenv("DDB_CACHE_MAX_ITEMS", "2000"))
+# Грубый лимит памяти: размер элемента оцениваем длиной repr()
+DDB_CACHE_MAX_BYTES = int(os.getenv("DDB_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+_MISS = object()
 
-users_tbl     = dynamodb.Table(USERS_TABLE)
-channels_tbl  = dynamodb.Table(CHANNELS_TABLE)
-threads_tbl   = dynamodb.Table(THREADS_TABLE)
-messages_tbl  = dynamodb.Table(MESSAGES_TABLE)
-summaries_tbl = dynamodb.Table(SUMMARIES_TABLE)
-settings_tbl  = dynamodb.Table(SETTINGS_TABLE)
+
+class _ReadCache:
+    """Потокобезопасный LRU с TTL. Ключ — (namespace, id); None тоже кэшируется
+    («записи нет»), ошибки чтения — нет. Наружу отдаются копии: вызывающие мутируют dict'ы."""
+
+    def __init__(self, ttl: float, max_items: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[Tuple[str, str], Tuple[float, int, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+        self.evictions = 0
+
+    def get(self, ns: str, key: str) -> Any:
+        k = (ns, key)
+        with self._lock:
+            entry = self._data.get(k)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._pop(k)
+                self.misses[ns] += 1
+                return _MISS
+            self._data.move_to_end(k)
+            self.hits[ns] += 1
+            value = entry[2]
+        return copy.deepcopy(value)
+
+    def put(self, ns: str, key: str, value: Any) -> None:
+        if not DDB_CACHE_ENABLED:
+            return
+        size = len(repr(value))
+        if size > self.max_bytes:
+            self.invalidate(ns, key)
+            return
+        k = (ns, key)
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._pop(k)
+            self._data[k] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while self._data and (len(self._data) > self.max_items or self._bytes > self.max_bytes):
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate(self, ns: str, key: str) -> None:
+        with self._lock:
+            self._pop((ns, key))
+
+    def _pop(self, k: Tuple[str, str]) -> None:
+        entry = self._data.pop(k, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def stats(self, reset: bool = False) -> Dict[str, Any]:
+        with self._lock:
+            out = {
+                "hits": dict(self.hits), "misses": dict(self.misses),
+                "evictions": self.evictions, "items": len(self._data), "bytes": self._bytes,
+            }
+            if reset:
+                self.hits.clear()
+                self.misses.clear()
+                self.evictions = 0
+        return out
+
+
+_cache = _ReadCache(DDB_CACHE_TTL_SEC, DDB_CACHE_MAX_ITEMS, DDB_CACHE_MAX_BYTES)
+
+
+def _cached(ns: str, key: str, use_cache: bool) -> Any:
+    if not (DDB_CACHE_ENABLED and use_cache):
+        return _MISS
+    return _cache.get(ns, key)
+
+
+def log_cache_stats(reset: bool = True) -> None:
+    """Пишет в лог hit/miss по неймспейсам (за вызов Lambda при reset=True) и заполненность."""
+    if not DDB_CACHE_ENABLED:
+        return
+    st = _cache.stats(reset=reset)
+    hits, misses = sum(st["hits"].values()), sum(st["misses"].values())
+    per_ns = " ".join(
+        f"{ns}={st['hits'].get(ns, 0)}/{st['hits'].get(ns, 0) + st['misses'].get(ns, 0)}"
+        for ns in sorted(set(st["hits"]) | set(st["misses"]))
+    )
+    logger.info(
+        "DDB cache hits=%d misses=%d %s items=%d bytes=%d evicted=%d",
+        hits, misses, per_ns, st["items"], st["bytes"], st["evictions"],
+    )
 
 # ---------- Users / Channels / Threads ----------
 
-def get_user(user_id: str) -> Optional[Dict[str, Any]]:
+def get_user(user_id: str, *, use_cache: bool = True, snapshot: bool = True) -> Optional[Dict[str, Any]]:
+    turn = current_turn() if snapshot else None
+    if turn is not None:
+        return turn.user(user_id, use_cache=use_cache)
+    hit = _cached("user", user_id, use_cache)
+    if hit is not _MISS:
+        return hit
     try:
         r = users_tbl.get_item(Key={"user_id": user_id})
-        return r.get("Item")
+        item = r.get("Item")
+        _cache.put("user", user_id, item)
+        return item
     except Exception as e:
         logger.warning(f"get_user({user_id}) failed: {e}")
         return None
 
+def batch_get_users(user_ids: List[str], *, snapshot: bool = True) -> Dict[str, Dict[str, Any]]:
+    """Пачка пользователей одним BatchGetItem (по 100 ключей) → {user_id: item}.
+
+    Необработанные ключи (UnprocessedKeys при троттлинге) дочитываются с короткой паузой.
+    Отсутствующих пользователей в результате нет. Уже закэшированных не запрашиваем.
+    """
+    turn = current_turn() if snapshot else None
+    if turn is not None:
+        return turn.users(user_ids)
+    out: Dict[str, Dict[str, Any]] = {}
+    ids = []
+    for u in dict.fromkeys(u for u in user_ids if u):
+        hit = _cached("user", u, True)
+        if hit is _MISS:
+            ids.append(u)
+        elif hit:
+            out[u] = hit
+    for i in range(0, len(ids), 100):
+        request = {USERS_TABLE: {"Keys": [{"user_id": u} for u in ids[i:i + 100]]}}
+        for attempt in range(4):
+            try:
+                r = _thread_resource().batch_get_item(RequestItems=request)
+            except Exception as e:
+                logger.warning(f"batch_get_users({len(ids)}) failed: {e}")
+                break
+            for item in r.get("Responses", {}).get(USERS_TABLE, []):
+                out[item["user_id"]] = item
+                _cache.put("user", item["user_id"], item)
+            request = r.get("UnprocessedKeys") or {}
+            if not request:
+                break
+            time.sleep(0.05 * (2 ** attempt))
+    return out
+
 def save_user(
     user_id: str,
     username: Optional[str],
     first_name: Optional[str] = None,
     last_name: Optional[str] = None,
-    profile: Optional[Dict[str, Any]] = None
+    profile: Optional[Dict[str, Any]] = None,
+    *,
+    defer: bool = False,
 ) -> None:
+    """defer=True — внутри хода запись уходит в TurnContext.flush() (см. там)."""
     now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
     # Инициализация структуры profile
@@ -64,42 +275,160 @@ def save_user(
         "created_at": now,
         "updated_at": now,
     }
+    if _defer_put(defer, USERS_TABLE, item, "user", user_id):
+        return
     try:
         users_tbl.put_item(Item=item)
+        _cache.put("user", user_id, item)
     except Exception as e:
+        _cache.invalidate("user", user_id)
         logger.warning(f"save_user({user_id}) failed: {e}")
 
-def get_channel(channel_id: str) -> Optional[Dict[str, Any]]:
+def get_channel(channel_id: str, *, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+    hit = _cached("channel", channel_id, use_cache)
+    if hit is not _MISS:
+        return hit
     try:
         r = channels_tbl.get_item(Key={"channel_id": channel_id})
-        return r.get("Item")
+        item = r.get("Item")
+        _cache.put("channel", channel_id, item)
+        return item
     except Exception as e:
         logger.warning(f"get_channel({channel_id}) failed: {e}")
         return None
 
-def save_channel(channel_id: str, channel_name: Optional[str]) -> None:
+def save_channel(channel_id: str, channel_name: Optional[str], *, defer: bool = False) -> None:
     now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
     item = {
         "channel_id": channel_id,
         "channel_name": channel_name or "",
         "channel_summary": "",
+        "roster": {},
+        "roster_rev": 0,
         "created_at": now,
         "updated_at": now,
     }
+    if _defer_put(defer, CHANNELS_TABLE, item, "channel", channel_id):
+        return
     try:
         channels_tbl.put_item(Item=item)
+        _cache.put("channel", channel_id, item)
     except Exception as e:
+        _cache.invalidate("channel", channel_id)
         logger.warning(f"save_channel({channel_id}) failed: {e}")
 
-def get_thread(thread_id: str) -> Optional[Dict[str, Any]]:
+# Состав группы (roster) — в элементе Channels, который ход группы и так читает:
+# roster = {user_id: {username, first_name, last_name, seen}}, не больше ROSTER_MAX самых
+# недавно писавших. Автор отмечается при своей реплике, но запись — только если сменились
+# имена или seen старше ROSTER_SEEN_SEC. roster_rev растёт лишь при смене состава или имён:
+# по нему worker кэширует отрисованный блок «Участники беседы», на нём же — условная запись.
+# Состав — на чат: в форуме в него попадают авторы всех тем.
+
+ROSTER_MAX = int(os.getenv("ROSTER_MAX", "50"))
+ROSTER_SEEN_SEC = int(os.getenv("ROSTER_SEEN_SEC", "600"))
+
+
+def update_roster(channel_id: str, user_id: str, username: Optional[str],
+                  first_name: Optional[str] = None, last_name: Optional[str] = None, *,
+                  channel: Optional[Dict[str, Any]] = None, defer: bool = False) -> bool:
+    """Отмечает автора в составе чата. channel — уже прочитанный элемент канала (get_channel,
+    возможно из кэша): по его roster решаем, нужна ли запись и кого вытеснить сверх ROSTER_MAX.
+    Состав меняется только вместе с roster_rev, поэтому запись условна по нему (и по наличию
+    автора в составе): на конфликте — темы одного чата идут параллельно, копия могла
+    устареть — элемент перечитывается строго согласованно и решение принимается заново.
+    → была ли (отложена ли) запись."""
+    turn = current_turn()
+    if defer and turn is not None and turn.buffer_writes:
+        if _roster_write(channel, user_id, username, first_name, last_name) is None:
+            return False
+        turn.defer_roster(channel_id, user_id, username, first_name, last_name, channel)
+        return True
+    for _ in range(3):
+        plan = _roster_write(channel, user_id, username, first_name, last_name)
+        if plan is None:
+            return False
+        try:
+            try:
+                r = channels_tbl.update_item(Key={"channel_id": channel_id}, ReturnValues="ALL_NEW", **plan)
+            except Exception as e:
+                if _PATH_INVALID not in str(e):
+                    raise
+                # Канал без roster (заведён до него): заводим состав с одним автором
+                r = channels_tbl.update_item(
+                    Key={"channel_id": channel_id},
+                    UpdateExpression=("SET updated_at = :u, #r = if_not_exists(#r, :full), "
+                                      "roster_rev = if_not_exists(roster_rev, :zero) + :one"),
+                    ExpressionAttributeNames={"#r": "roster"},
+                    ExpressionAttributeValues={":u": plan["ExpressionAttributeValues"][":u"],
+                                               ":full": {user_id: plan["ExpressionAttributeValues"][":e"]},
+                                               ":zero": 0, ":one": 1},
+                    ReturnValues="ALL_NEW",
+                )
+            _cache.put("channel", channel_id, r.get("Attributes"))
+            return True
+        except Exception as e:
+            _cache.invalidate("channel", channel_id)
+            if "ConditionalCheckFailed" not in str(e):
+                logger.warning(f"update_roster({channel_id}, {user_id}) failed: {e}")
+                return False
+        try:
+            channel = channels_tbl.get_item(Key={"channel_id": channel_id}, ConsistentRead=True).get("Item")
+        except Exception as e:
+            logger.warning(f"update_roster({channel_id}) re-read failed: {e}")
+            return False
+        _cache.put("channel", channel_id, channel)
+    logger.warning(f"update_roster({channel_id}, {user_id}): gave up after concurrent updates")
+    return False
+
+
+def _roster_write(channel: Optional[Dict[str, Any]], user_id: str, username: Optional[str],
+                  first_name: Optional[str], last_name: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Параметры update_item для отметки автора по копии канала; None — запись не нужна."""
+    roster = (channel or {}).get("roster") or {}
+    now_ms = int(time.time() * 1000)
+    entry = {"username": username or "", "first_name": first_name or "",
+             "last_name": last_name or "", "seen": now_ms}
+    cur = roster.get(user_id)
+    renamed = not cur or any((cur.get(k) or "") != entry[k] for k in ("username", "first_name", "last_name"))
+    if not renamed and now_ms - int(cur.get("seen") or 0) < ROSTER_SEEN_SEC * 1000:
+        return None
+    names = {"#r": "roster", "#u": user_id, "#rv": "roster_rev"}
+    vals: Dict[str, Any] = {":u": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), ":e": entry}
+    sets = ["updated_at = :u", "#r.#u = :e"]
+    if renamed:
+        sets.append("#rv = if_not_exists(#rv, :zero) + :one")
+        vals.update({":zero": 0, ":one": 1})
+    expr = "SET " + ", ".join(sets)
+    if cur:
+        # Автор уже в составе: не воскрешать его, если параллельный ход успел вытеснить
+        cond = "attribute_exists(#r.#u)"
+    else:
+        # Новый автор меняет состав: только если он тот же, по которому считали вытеснение
+        rev = int((channel or {}).get("roster_rev") or 0)
+        vals[":rev"] = rev
+        cond = "#rv = :rev" if rev else "(attribute_not_exists(#rv) OR #rv = :rev)"
+        others = sorted((u for u in roster if u != user_id), key=lambda u: int(roster[u].get("seen") or 0))
+        evict = others[:max(0, len(others) + 1 - ROSTER_MAX)]
+        if evict:
+            names.update({f"#x{i}": u for i, u in enumerate(evict)})
+            expr += " REMOVE " + ", ".join(f"#r.#x{i}" for i in range(len(evict)))
+    return {"UpdateExpression": expr, "ConditionExpression": cond,
+            "ExpressionAttributeNames": names, "ExpressionAttributeValues": vals}
+
+def get_thread(thread_id: str, *, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+    hit = _cached("thread", thread_id, use_cache)
+    if hit is not _MISS:
+        return hit
     try:
         r = threads_tbl.get_item(Key={"thread_id": thread_id})
-        return r.get("Item")
+        item = r.get("Item")
+        _cache.put("thread", thread_id, item)
+        return item
     except Exception as e:
         logger.warning(f"get_thread({thread_id}) failed: {e}")
         return None
 
-def save_thread(thread_id: str, thread_title: Optional[str] = "") -> None:
+def save_thread(thread_id: str, thread_title: Optional[str] = "", *, defer: bool = False) -> None:
     now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
     item = {
         "thread_id": thread_id,
@@ -109,73 +438,141 @@ def save_thread(thread_id: str, thread_title: Optional[str] = "") -> None:
         "created_at": now,
         "updated_at": now,
     }
+    if _defer_put(defer, THREADS_TABLE, item, "thread", thread_id):
+        return
     try:
         threads_tbl.put_item(Item=item)
+        _cache.put("thread", thread_id, item)
     except Exception as e:
+        _cache.invalidate("thread", thread_id)
         logger.warning(f"save_thread({thread_id}) failed: {e}")
 
-def update_user_names(
+def _update_user(**kwargs) -> Optional[Dict[str, Any]]:
+    """update_item по Users с write-through: новое состояние записи (ALL_NEW) сразу в кэш
+    и возвращается, при ошибке — сбрасываем закэшированное."""
+    user_id = kwargs["Key"]["user_id"]
+    try:
+        r = users_tbl.update_item(ReturnValues="ALL_NEW", **kwargs)
+    except Exception:
+        _cache.invalidate("user", user_id)
+        raise
+    attrs = r.get("Attributes")
+    if attrs:
+        _cache.put("user", user_id, attrs)
+    else:
+        _cache.invalidate("user", user_id)
+    turn = current_turn()
+    if turn is not None:
+        turn.note_user(user_id, attrs)
+    return attrs
+
+_PATH_INVALID = "document path provided in the update expression is invalid"
+
+
+def _profile_known(user_id: str, pending: Optional[Dict[str, Any]] = None) -> Optional[bool]:
+    """Есть ли у записи map `profile` — по снимку хода или кэшу контейнера; None — неизвестно.
+    pending — отложенный upsert: снимок уже показывает его имена, знание — на момент отложения."""
+    if pending is not None:
+        return pending["profile_known"]
+    turn = current_turn()
+    item = turn.peek_user(user_id) if turn is not None else _MISS
+    if item is _MISS:
+        item = _cached("user", user_id, True)
+    if item is _MISS:
+        return None
+    return bool(item and "profile" in item)
+
+
+def upsert_user(
     user_id: str,
     username: Optional[str],
-    first_name: Optional[str],
-    last_name: Optional[str]
-) -> None:
-    """Обновляет имя и username пользователя, если они изменились."""
-    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    first_name: Optional[str] = None,
+    last_name: Optional[str] = None,
+    *,
+    increment_messages: bool = False,
+    defer: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """Пользователь одним UpdateItem (ReturnValues=ALL_NEW): username и имена (None — не
+    трогаем), profile через if_not_exists, +1 к message_count. Возвращает запись целиком или
+    None (ошибка либо defer).
 
-    update_expr_parts = ["updated_at = :u"]
-    expr_vals = {":u": now}
-    expr_names = {}
+    Точечные пути (#p.first_name) и `#p = if_not_exists(#p, …)` в одном выражении DynamoDB не
+    допускает (пути пересекаются), поэтому форма выбирается по тому, что известно о записи
+    (снимок хода, кэш контейнера): profile есть — точечный SET, записи/profile нет — profile
+    целиком. Неизвестно — точечный SET и, если profile не оказалось, второй вызов. «Нет» может
+    быть устаревшим (кэш «записи нет», а её уже завёл другой контейнер) — profile целиком пишется
+    только условно, и при провале условия тоже идёт точечный SET.
+
+    defer=True — внутри хода запись откладывается до TurnContext.flush() (имена в снимке
+    видны сразу); не отложенный upsert того же пользователя забирает её себе.
+    """
+    turn = current_turn()
+    if defer and turn is not None and turn.buffer_writes:
+        turn.defer_upsert(user_id, username, first_name, last_name, increment_messages)
+        return None
+    pending = turn.take_upsert(user_id) if turn is not None else None
+    if pending and pending["increment_messages"]:
+        increment_messages = True
 
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    base = ["updated_at = :u", "created_at = if_not_exists(created_at, :u)"]
+    vals: Dict[str, Any] = {":u": now}
     if username is not None:
-        update_expr_parts.append("username = :un")
-        expr_vals[":un"] = username or ""
-
-    if first_name is not None:
-        update_expr_parts.append("#p.#fn = :fn")
-        expr_vals[":fn"] = first_name or ""
-        expr_names["#p"] = "profile"
-        expr_names["#fn"] = "first_name"
-
-    if last_name is not None:
-        if "#p" not in expr_names:
-            expr_names["#p"] = "profile"
-        update_expr_parts.append("#p.#ln = :ln")
-        expr_vals[":ln"] = last_name or ""
-        expr_names["#ln"] = "last_name"
+        base.append("username = :un")
+        vals[":un"] = username or ""
+
+    def _nested():
+        parts, v = list(base), dict(vals)
+        if first_name is not None:
+            parts.append("#p.first_name = :fn")
+            v[":fn"] = first_name or ""
+        if last_name is not None:
+            parts.append("#p.last_name = :ln")
+            v[":ln"] = last_name or ""
+        if increment_messages:
+            parts.append("#p.message_count = if_not_exists(#p.message_count, :zero) + :one")
+            v[":zero"], v[":one"] = 0, 1
+        return _update_user(Key={"user_id": user_id}, UpdateExpression="SET " + ", ".join(parts),
+                            ExpressionAttributeNames={"#p": "profile"}, ExpressionAttributeValues=v)
+
+    def _init():
+        prof = dict(_EMPTY_PROFILE, first_name=first_name or "", last_name=last_name or "",
+                    message_count=int(increment_messages))
+        return _update_user(Key={"user_id": user_id},
+                            UpdateExpression="SET " + ", ".join(base + ["#p = :prof"]),
+                            ConditionExpression="attribute_not_exists(#p)",
+                            ExpressionAttributeNames={"#p": "profile"},
+                            ExpressionAttributeValues={**vals, ":prof": prof})
+
+    def _init_or_nested():
+        try:
+            return _init()
+        except Exception as e:
+            if "ConditionalCheckFailed" not in str(e):
+                raise
+            return _nested()
 
     try:
-        users_tbl.update_item(
-            Key={"user_id": user_id},
-            UpdateExpression="SET " + ", ".join(update_expr_parts),
-            ExpressionAttributeValues=expr_vals,
-            ExpressionAttributeNames=expr_names if expr_names else None,
-        )
+        if _profile_known(user_id, pending) is False:
+            return _init_or_nested()
+        try:
+            return _nested()
+        except Exception as e:
+            if _PATH_INVALID not in str(e):
+                raise
+            return _init_or_nested()
     except Exception as e:
-        if "document path provided in the update expression is invalid" in str(e):
-            # profile атрибута нет — инициализируем и повторяем
-            try:
-                users_tbl.update_item(
-                    Key={"user_id": user_id},
-                    UpdateExpression="SET #p = if_not_exists(#p, :empty)",
-                    ExpressionAttributeNames={"#p": "profile"},
-                    ExpressionAttributeValues={":empty": {
-                        "first_name": "", "last_name": "",
-                        "communication_style": "", "interests": [],
-                        "long_term_summary": "", "last_topics": [],
-                        "message_count": 0,
-                    }},
-                )
-                users_tbl.update_item(
-                    Key={"user_id": user_id},
-                    UpdateExpression="SET " + ", ".join(update_expr_parts),
-                    ExpressionAttributeValues=expr_vals,
-                    ExpressionAttributeNames=expr_names if expr_names else None,
-                )
-            except Exception as e2:
-                logger.warning(f"update_user_names({user_id}) retry failed: {e2}")
-        else:
-            logger.warning(f"update_user_names({user_id}) failed: {e}")
+        logger.warning(f"upsert_user({user_id}) failed: {e}")
+        return None
+
+def update_user_names(
+    user_id: str,
+    username: Optional[str],
+    first_name: Optional[str],
+    last_name: Optional[str]
+) -> None:
+    """Обновляет имя и username пользователя (и заводит profile, если его нет)."""
+    upsert_user(user_id, username, first_name, last_name)
 
 def update_user_profile(
     user_id: str,
@@ -184,9 +581,24 @@ def update_user_profile(
     interests: Optional[List[str]] = None,
     long_term_summary: Optional[str] = None,
     last_topics: Optional[List[str]] = None,
+    long_term_at: Optional[int] = None,
+    facts: Optional[List[str]] = None,
     increment_messages: bool = False,
+    defer: bool = False,
 ) -> None:
-    """Обновляет профиль пользователя с долгосрочной информацией."""
+    """Обновляет профиль пользователя с долгосрочной информацией.
+
+    defer=True — внутри хода изменения копятся и сливаются в один UpdateItem на пользователя
+    при TurnContext.flush(); чтения хода видят их сразу."""
+    fields = {k: v for k, v in (
+        ("communication_style", communication_style), ("interests", interests),
+        ("long_term_summary", long_term_summary), ("last_topics", last_topics),
+        ("long_term_at", long_term_at), ("facts", facts),
+    ) if v is not None}
+    turn = current_turn()
+    if defer and turn is not None and turn.buffer_writes:
+        turn.defer_profile_update(user_id, fields, increment_messages)
+        return
     now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
     update_expr_parts = ["updated_at = :u"]
@@ -209,47 +621,46 @@ def update_user_profile(
         update_expr_parts.append("#p.last_topics = :lt")
         expr_vals[":lt"] = last_topics
 
+    if long_term_at is not None:
+        # message_count на момент обновления долгосрочного профиля (см. maintenance_lambda)
+        update_expr_parts.append("#p.long_term_at = :lta")
+        expr_vals[":lta"] = long_term_at
+
+    if facts is not None:
+        update_expr_parts.append("#p.facts = :f")
+        expr_vals[":f"] = facts
+
     if increment_messages:
         update_expr_parts.append("#p.message_count = if_not_exists(#p.message_count, :zero) + :one")
         expr_vals[":zero"] = 0
         expr_vals[":one"] = 1
 
     try:
-        users_tbl.update_item(
+        _update_user(
             Key={"user_id": user_id},
             UpdateExpression="SET " + ", ".join(update_expr_parts),
             ExpressionAttributeValues=expr_vals,
             ExpressionAttributeNames=expr_names,
         )
     except Exception as e:
-        if "document path provided in the update expression is invalid" in str(e):
-            # profile атрибута нет (старый пользователь) — инициализируем и повторяем
+        if _PATH_INVALID in str(e):
+            # profile атрибута нет (старый пользователь) — заводим его сразу с новыми полями
+            prof = dict(_EMPTY_PROFILE, **fields, message_count=int(increment_messages))
             try:
-                users_tbl.update_item(
+                _update_user(
                     Key={"user_id": user_id},
-                    UpdateExpression="SET #p = if_not_exists(#p, :empty)",
+                    UpdateExpression="SET updated_at = :u, #p = if_not_exists(#p, :prof)",
                     ExpressionAttributeNames={"#p": "profile"},
-                    ExpressionAttributeValues={":empty": {
-                        "first_name": "", "last_name": "",
-                        "communication_style": "", "interests": [],
-                        "long_term_summary": "", "last_topics": [],
-                        "message_count": 0,
-                    }},
-                )
-                users_tbl.update_item(
-                    Key={"user_id": user_id},
-                    UpdateExpression="SET " + ", ".join(update_expr_parts),
-                    ExpressionAttributeValues=expr_vals,
-                    ExpressionAttributeNames=expr_names,
+                    ExpressionAttributeValues={":u": now, ":prof": prof},
                 )
             except Exception as e2:
                 logger.warning(f"update_user_profile({user_id}) retry failed: {e2}")
         else:
             logger.warning(f"update_user_profile({user_id}) failed: {e}")
 
-def get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
+def get_user_profile(user_id: str, *, use_cache: bool = True, snapshot: bool = True) -> Optional[Dict[str, Any]]:
     """Возвращает профиль пользователя или None."""
-    user = get_user(user_id)
+    user = get_user(user_id, use_cache=use_cache, snapshot=snapshot)
     if user:
         return user.get("profile", {})
     return None
@@ -267,7 +678,7 @@ _EMPTY_PROFILE = {
 def _init_profile_if_missing(user_id: str) -> None:
     """Инициализирует map `profile` у старого пользователя (если его нет)."""
     try:
-        users_tbl.update_item(
+        _update_user(
             Key={"user_id": user_id},
             UpdateExpression="SET #p = if_not_exists(#p, :empty)",
             ExpressionAttributeNames={"#p": "profile"},
@@ -277,11 +688,178 @@ def _init_profile_if_missing(user_id: str) -> None:
         logger.warning(f"_init_profile_if_missing({user_id}) failed: {e}")
 
 
+# ---------- Факты ----------
+# FACTS_STORE=profile (по умолчанию) — список profile.facts; FACTS_STORE=items — элемент на
+# факт в таблице Facts: (user_id, fact_id), где fact_id — хэш нормализованного текста, так что
+# дубль отсекается условным put-ом без чтения списка. В элементе — время записи и последнего
+# использования и счётчик использований; сверх FACTS_MAX_PER_USER вытесняются давно не
+# использованные. Факты из profile.facts (до переключения) видны в обоих режимах и
+# переносятся в таблицу при первой записи факта.
+
+FACTS_STORE = os.getenv("FACTS_STORE", "profile")
+FACTS_TABLE = os.getenv("FACTS_TABLE", "Facts")
+FACTS_MAX_PER_USER = int(os.getenv("FACTS_MAX_PER_USER", "100"))
+FACTS_TOUCH_SEC = int(os.getenv("FACTS_TOUCH_SEC", "3600"))
+
+facts_tbl = _ThreadLocalTable(FACTS_TABLE)
+
+
+def normalize_fact(fact: str) -> str:
+    text = str(fact or "").lower().replace("ё", "е")
+    return " ".join(re.findall(r"\w+", text))
+
+
+def fact_id(fact: str) -> str:
+    return hashlib.sha1(normalize_fact(fact).encode("utf-8")).hexdigest()[:16]
+
+
+def facts_from_profile(profile: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """profile.facts в виде элементов Facts; порядок списка — вместо времени записи."""
+    facts = [str(f).strip() for f in ((profile or {}).get("facts") or []) if str(f).strip()]
+    return [{"fact_id": fact_id(f), "fact": f, "created_ms": i, "used_ms": i, "uses": 0, "_legacy": True}
+            for i, f in enumerate(facts)]
+
+
+def _fact_recency(item: Dict[str, Any]) -> Tuple[int, int]:
+    return int(item.get("used_ms") or item.get("created_ms") or 0), int(item.get("uses") or 0)
+
+
+def _batch_delete(table: str, keys: List[Dict[str, Any]]) -> None:
+    for i in range(0, len(keys), 25):
+        request = {table: [{"DeleteRequest": {"Key": k}} for k in keys[i:i + 25]]}
+        for attempt in range(4):
+            try:
+                r = _thread_resource().batch_write_item(RequestItems=request)
+            except Exception as e:
+                logger.warning(f"batch_delete({table}, {len(keys)}) failed: {e}")
+                break
+            request = r.get("UnprocessedItems") or {}
+            if not request:
+                break
+            time.sleep(0.05 * (2 ** attempt))
+
+
+def get_user_fact_items(user_id: str, *, use_cache: bool = True,
+                        profile: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Факты пользователя элементами (fact_id, fact, created_ms, used_ms, uses).
+    profile — уже прочитанный профиль (для фактов из profile.facts), иначе читается."""
+    if profile is None:
+        profile = get_user_profile(user_id, use_cache=use_cache) or {}
+    if FACTS_STORE != "items":
+        return facts_from_profile(profile)
+    hit = _cached("facts", user_id, use_cache)
+    if hit is _MISS:
+        try:
+            hit = _query_fact_items(user_id)
+        except Exception as e:
+            logger.warning(f"get_user_fact_items({user_id}) failed: {e}")
+            return facts_from_profile(profile)
+        _cache.put("facts", user_id, hit)
+    return merge_fact_items(hit, profile)
+
+
+def _query_fact_items(user_id: str, *, consistent_read: bool = False) -> List[Dict[str, Any]]:
+    items, kwargs = [], {"KeyConditionExpression": Key("user_id").eq(user_id),
+                         "ConsistentRead": consistent_read}
+    while True:
+        r = facts_tbl.query(**kwargs)
+        items.extend(r.get("Items", []))
+        if not r.get("LastEvaluatedKey"):
+            return items
+        kwargs["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+
+
+def _evict_fact_items(user_id: str) -> int:
+    """Сверх FACTS_MAX_PER_USER удаляет давно не использованные факты. Только на записи
+    факта — чтение (горячий путь хода) ничего не пишет. → сколько удалено."""
+    try:
+        items = _query_fact_items(user_id, consistent_read=True)
+    except Exception as e:
+        logger.warning(f"facts({user_id}) eviction skipped: {e}")
+        return 0
+    if len(items) <= FACTS_MAX_PER_USER:
+        return 0
+    items.sort(key=_fact_recency, reverse=True)
+    evicted = items[FACTS_MAX_PER_USER:]
+    _batch_delete(FACTS_TABLE, [{"user_id": user_id, "fact_id": it["fact_id"]} for it in evicted])
+    logger.info(f"facts({user_id}): evicted {len(evicted)} least recently used")
+    return len(evicted)
+
+
+def merge_fact_items(items: List[Dict[str, Any]], profile: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Элементы Facts + ещё не перенесённые факты из profile.facts."""
+    known = {it["fact_id"] for it in items}
+    return list(items) + [it for it in facts_from_profile(profile) if it["fact_id"] not in known]
+
+
 def get_user_facts(user_id: str) -> List[str]:
     """Список явно сохранённых фактов о пользователе."""
-    prof = get_user_profile(user_id) or {}
-    facts = prof.get("facts") or []
-    return [str(f).strip() for f in facts if str(f).strip()]
+    return [it["fact"] for it in get_user_fact_items(user_id)]
+
+
+def touch_user_facts(user_id: str, facts: List[Dict[str, Any]]) -> int:
+    """Отмечает использование фактов (FACTS_STORE=items): used_ms и счётчик uses. Не чаще
+    раза в FACTS_TOUCH_SEC на факт — иначе это запись на каждый ход. → сколько отмечено."""
+    now_ms = int(time.time() * 1000)
+    due = [f["fact_id"] for f in facts
+           if not f.get("_legacy") and now_ms - int(f.get("used_ms") or 0) > FACTS_TOUCH_SEC * 1000]
+    if FACTS_STORE != "items" or not due:
+        return 0
+    for fid in due:
+        try:
+            facts_tbl.update_item(
+                Key={"user_id": user_id, "fact_id": fid},
+                UpdateExpression="SET used_ms = :now ADD uses :one",
+                ConditionExpression="attribute_exists(fact_id)",
+                ExpressionAttributeValues={":now": now_ms, ":one": 1},
+            )
+        except Exception as e:
+            if "ConditionalCheckFailed" not in str(e):
+                logger.warning(f"touch_user_facts({user_id}) failed: {e}")
+    _cache.invalidate("facts", user_id)
+    return len(due)
+
+
+def _add_fact_item(user_id: str, fact: str) -> bool:
+    now_ms = int(time.time() * 1000)
+    try:
+        facts_tbl.put_item(
+            Item={"user_id": user_id, "fact_id": fact_id(fact), "fact": fact,
+                  "created_ms": now_ms, "used_ms": now_ms, "uses": 0},
+            ConditionExpression="attribute_not_exists(fact_id)",
+        )
+    except Exception as e:
+        if "ConditionalCheckFailed" in str(e):
+            return True  # уже есть — считаем успехом
+        logger.warning(f"add_user_fact({user_id}) failed: {e}")
+        return False
+    _cache.invalidate("facts", user_id)
+    # Перенос фактов из profile.facts: те же fact_id, так что повтор переноса безопасен
+    legacy = facts_from_profile(get_user_profile(user_id))
+    if legacy:
+        _batch_put([(FACTS_TABLE, {"user_id": user_id, "fact_id": it["fact_id"], "fact": it["fact"],
+                                   "created_ms": now_ms - len(legacy) + i, "used_ms": now_ms - len(legacy) + i,
+                                   "uses": 0}, None, None)
+                    for i, it in enumerate(legacy) if it["fact_id"] != fact_id(fact)])
+        update_user_profile(user_id, facts=[])
+    _evict_fact_items(user_id)
+    return True
+
+
+def _remove_fact_items(user_id: str, query: Optional[str]) -> int:
+    items = get_user_fact_items(user_id, use_cache=False)
+    q = normalize_fact(query or "")
+    matched = [it for it in items if not q or q in normalize_fact(it["fact"])]
+    if not matched:
+        return 0
+    _batch_delete(FACTS_TABLE, [{"user_id": user_id, "fact_id": it["fact_id"]}
+                                for it in matched if not it.get("_legacy")])
+    if any(it.get("_legacy") for it in matched):
+        gone = {it["fact_id"] for it in matched}
+        update_user_profile(user_id, facts=[it["fact"] for it in items
+                                            if it.get("_legacy") and it["fact_id"] not in gone])
+    _cache.invalidate("facts", user_id)
+    return len(matched)
 
 
 def add_user_fact(user_id: str, fact: str) -> bool:
@@ -289,13 +867,17 @@ def add_user_fact(user_id: str, fact: str) -> bool:
     fact = (fact or "").strip()
     if not fact:
         return False
+    if FACTS_STORE == "items":
+        return _add_fact_item(user_id, fact)
     existing = get_user_facts(user_id)
-    if any(fact.lower() == e.lower() for e in existing):
+    if any(fact_id(fact) == fact_id(e) for e in existing):
         return True  # уже есть — считаем успехом
+    # Пишем сразу и внутри хода: «Запомнил.» модель скажет пользователю по результату —
+    # отложенная запись, не пережившая flush(), была бы нарушенным обещанием
     now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
     def _do():
-        users_tbl.update_item(
+        _update_user(
             Key={"user_id": user_id},
             UpdateExpression=(
                 "SET #p.#f = list_append(if_not_exists(#p.#f, :empty), :new), updated_at = :u"
@@ -323,6 +905,8 @@ def add_user_fact(user_id: str, fact: str) -> bool:
 def remove_user_facts(user_id: str, query: Optional[str] = None) -> int:
     """Удаляет факты, подходящие под `query` (подстрока, регистронезависимо).
     Если query пустой — очищает все факты. Возвращает число удалённых."""
+    if FACTS_STORE == "items":
+        return _remove_fact_items(user_id, query)
     facts = get_user_facts(user_id)
     if not facts:
         return 0
@@ -335,9 +919,10 @@ def remove_user_facts(user_id: str, query: Optional[str] = None) -> int:
         removed = len(facts) - len(kept)
     if removed == 0:
         return 0
+    # Сразу, как и add_user_fact: результат инструмента видит пользователь
     now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
     try:
-        users_tbl.update_item(
+        _update_user(
             Key={"user_id": user_id},
             UpdateExpression="SET #p.#f = :k, updated_at = :u",
             ExpressionAttributeNames={"#p": "profile", "#f": "facts"},
@@ -348,7 +933,7 @@ def remove_user_facts(user_id: str, query: Optional[str] = None) -> int:
         if "document path provided in the update expression is invalid" in str(e):
             _init_profile_if_missing(user_id)
             try:
-                users_tbl.update_item(
+                _update_user(
                     Key={"user_id": user_id},
                     UpdateExpression="SET #p.#f = :k, updated_at = :u",
                     ExpressionAttributeNames={"#p": "profile", "#f": "facts"},
@@ -371,7 +956,15 @@ def save_message(
     from_user: Optional[str] = None,
     from_username: Optional[str] = None,
     to_user: Optional[str] = None,
-) -> None:
+    tokens: Optional[int] = None,
+    tokens_tag: Optional[str] = None,
+    defer: bool = False,
+) -> Optional[int]:
+    """Сохраняет реплику; возвращает её timestamp (ms) или None при ошибке.
+    tokens — оценка токенов контента (claude_utils.calibrated_tokens), чтобы trim не считал
+    заново; tokens_tag — отпечаток оценщика (claude_utils.tokens_tag): при другом пересчитают.
+    defer=True — внутри хода запись уходит в TurnContext.flush(); в истории хода реплика
+    видна сразу."""
     ts_ms = int(time.time() * 1000)
     now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
     # TTL: 1 year in seconds from now
@@ -387,13 +980,32 @@ def save_message(
         "created_at": now,
         "expire_at": expire_at,
     }
+    if tokens is not None:
+        item["tokens"] = int(tokens)
+        if tokens_tag:
+            item["tokens_v"] = tokens_tag
+    if _defer_put(defer, MESSAGES_TABLE, item):
+        return ts_ms
     try:
         messages_tbl.put_item(Item=item)
+        turn = current_turn()
+        if turn is not None:
+            turn.note_message(item)
+        return ts_ms
     except Exception as e:
         logger.warning(f"save_message({dialog_key}, {role}) failed: {e}")
+        return None
 
-def get_dialog_history(dialog_key: str, *, limit: int = 50, consistent_read: bool = False) -> List[Dict[str, Any]]:
+def get_dialog_history(dialog_key: str, *, limit: int = 50, consistent_read: bool = False,
+                       snapshot: bool = True) -> List[Dict[str, Any]]:
+    """Последние `limit` реплик по возрастанию времени. Внутри хода (TurnContext) отдаются
+    из снимка, если он покрывает запрос; snapshot=False — всегда из таблицы."""
+    turn = current_turn() if snapshot else None
+    if turn is not None:
+        return turn.history(dialog_key, limit, consistent_read=consistent_read)
     try:
+        if MESSAGES_LAYOUT == "pages":
+            return _paged_history(dialog_key, limit, consistent_read)
         r = messages_tbl.query(
             KeyConditionExpression=Key("dialog_key").eq(dialog_key),
             ScanIndexForward=False,  # newest first
@@ -407,22 +1019,293 @@ def get_dialog_history(dialog_key: str, *, limit: int = 50, consistent_read: boo
         logger.warning(f"get_dialog_history({dialog_key}) failed: {e}")
         return []
 
-def save_summary(dialog_key: str, summary: str) -> None:
+# ---------- Страницы истории (MESSAGES_LAYOUT=pages) ----------
+# История в 120 реплик — это строго согласованный Query по 120 элементам, каждый со своими
+# dialog_key/created_at/expire_at/from_username/to_user. В раскладке pages закрытые реплики
+# сворачиваются в страницы (MESSAGE_PAGES_TABLE): по MESSAGE_PAGE_SIZE реплик в компактном
+# JSON под zlib. Хвост — реплики новее последней страницы — остаётся обычными элементами
+# Messages: запись реплики не меняется (дешёвый put, а не перезапись растущего элемента),
+# свёрнутые элементы не удаляются (удаление стоило бы WCU; их уберёт TTL), чтение просто
+# не берёт их — хвост читается начиная с `last_ts` последней страницы. Поэтому раскладку
+# можно включить на живой таблице: диалог без страниц читается как раньше.
+# Сворачивает maintenance-задача compact_history (worker ставит её, когда хвост дорос до
+# страницы). Оценка выигрыша по выгрузке Messages — history_bench.py.
+
+MESSAGES_LAYOUT      = os.getenv("MESSAGES_LAYOUT", "items")  # items | pages
+MESSAGE_PAGE_SIZE    = int(os.getenv("MESSAGE_PAGE_SIZE", "50"))
+MESSAGE_PAGES_TABLE  = os.getenv("MESSAGE_PAGES_TABLE", "MessagePages")
+# Страница не должна упереться в лимит элемента DynamoDB (400 КБ)
+_PAGE_MAX_BYTES = 300_000
+# Страниц за одну задачу compact_history: длинный диалог на только что включённой раскладке
+# сворачивается за несколько задач (следующую worker поставит сам), а не одной до таймаута
+MESSAGE_COMPACT_PAGES = 8
+
+message_pages_tbl = _ThreadLocalTable(MESSAGE_PAGES_TABLE)
+
+# Короткие ключи реплики в странице; dialog_key, created_at, expire_at не храним
+_PAGE_FIELDS = (("t", "timestamp"), ("r", "role"), ("c", "content"), ("u", "from_user"),
+                ("n", "from_username"), ("to", "to_user"), ("k", "tokens"), ("kv", "tokens_v"))
+
+# Длина хвоста (реплик после последней страницы) по последнему чтению в этом контейнере
+_unpaged: "OrderedDict[str, int]" = OrderedDict()
+_unpaged_lock = threading.Lock()
+
+
+def pack_page(messages: List[Dict[str, Any]]) -> bytes:
+    """Реплики → zlib(компактный JSON); пустые поля не пишутся."""
+    rows = []
+    for m in messages:
+        row = {}
+        for short, name in _PAGE_FIELDS:
+            v = m.get(name)
+            if v not in (None, ""):
+                row[short] = int(v) if name in ("timestamp", "tokens") else v
+        rows.append(row)
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def unpack_page(dialog_key: str, blob: Any) -> List[Dict[str, Any]]:
+    """Обратно в вид элементов Messages (без created_at/expire_at)."""
+    raw = blob.value if hasattr(blob, "value") else bytes(blob)
+    out = []
+    for row in json.loads(zlib.decompress(raw).decode("utf-8")):
+        m = {"dialog_key": dialog_key, "from_user": "", "from_username": "", "to_user": ""}
+        for short, name in _PAGE_FIELDS:
+            if short in row:
+                m[name] = row[short]
+        out.append(m)
+    return out
+
+
+def history_unpaged(dialog_key: str) -> int:
+    """Сколько реплик диалога ещё не свёрнуто (по последнему чтению в контейнере; 0 — неизвестно)."""
+    with _unpaged_lock:
+        return _unpaged.get(dialog_key, 0)
+
+
+def _note_unpaged(dialog_key: str, n: int) -> None:
+    with _unpaged_lock:
+        _unpaged.pop(dialog_key, None)
+        _unpaged[dialog_key] = n
+        while len(_unpaged) > DDB_CACHE_MAX_ITEMS:
+            _unpaged.popitem(last=False)
+
+
+def _latest_pages(dialog_key: str, n: int) -> List[Dict[str, Any]]:
+    """n последних страниц, новые первыми. Страницы неизменяемы — хватает eventual read:
+    пропущенная только что записанная страница лишь удлинит хвост (его элементы на месте)."""
+    r = message_pages_tbl.query(
+        KeyConditionExpression=Key("dialog_key").eq(dialog_key),
+        ScanIndexForward=False,
+        Limit=n,
+    )
+    return r.get("Items", [])
+
+
+def _tail_items(dialog_key: str, after_ts: int, limit: int, *, newest_first: bool,
+                consistent_read: bool) -> List[Dict[str, Any]]:
+    r = messages_tbl.query(
+        KeyConditionExpression=Key("dialog_key").eq(dialog_key) & Key("timestamp").gt(after_ts),
+        ScanIndexForward=not newest_first,
+        Limit=limit,
+        ConsistentRead=consistent_read,
+    )
+    return r.get("Items", [])
+
+
+def _paged_history(dialog_key: str, limit: int, consistent_read: bool) -> List[Dict[str, Any]]:
+    """Страницы (с запасом: столько, сколько нужно при пустом хвосте) + хвост после них."""
+    pages = _latest_pages(dialog_key, max(1, -(-limit // MESSAGE_PAGE_SIZE)))
+    after = int(pages[0]["last_ts"]) if pages else 0
+    tail = _tail_items(dialog_key, after, limit, newest_first=True, consistent_read=consistent_read)
+    _note_unpaged(dialog_key, len(tail))
+    items = sorted(tail, key=lambda x: x["timestamp"])
+    for page in pages:
+        if len(items) >= limit:
+            break
+        items = unpack_page(dialog_key, page["z"]) + items
+    return items[-limit:]
+
+
+def compact_history(dialog_key: str) -> int:
+    """Сворачивает полные страницы хвоста диалога (не больше MESSAGE_COMPACT_PAGES);
+    возвращает число свёрнутых реплик. Идемпотентна: ключ страницы — timestamp первой
+    реплики, запись условная."""
+    if MESSAGES_LAYOUT != "pages":
+        return 0
+    paged = 0
+    pages = _latest_pages(dialog_key, 1)
+    after = int(pages[0]["last_ts"]) if pages else 0
+    for i in range(MESSAGE_COMPACT_PAGES + 1):
+        batch = _tail_items(dialog_key, after, MESSAGE_PAGE_SIZE, newest_first=False, consistent_read=True)
+        if len(batch) < MESSAGE_PAGE_SIZE:
+            break
+        if i == MESSAGE_COMPACT_PAGES:
+            # остаток доберёт следующая задача: хвост не короче страницы — worker её поставит
+            _note_unpaged(dialog_key, MESSAGE_PAGE_SIZE)
+            return paged
+        blob = pack_page(batch)
+        while len(blob) > _PAGE_MAX_BYTES and len(batch) > 1:
+            batch = batch[:len(batch) // 2]
+            blob = pack_page(batch)
+        last_ts = int(batch[-1]["timestamp"])
+        try:
+            message_pages_tbl.put_item(
+                Item={
+                    "dialog_key": dialog_key,
+                    "page": int(batch[0]["timestamp"]),
+                    "last_ts": last_ts,
+                    "n": len(batch),
+                    "z": blob,
+                    "expire_at": max(int(m.get("expire_at") or 0) for m in batch),
+                },
+                ConditionExpression="attribute_not_exists(#pg)",
+                ExpressionAttributeNames={"#pg": "page"},
+            )
+        except Exception as e:
+            if "ConditionalCheckFailed" not in str(e):
+                raise
+        paged += len(batch)
+        after = last_ts
+    _note_unpaged(dialog_key, len(batch))
+    return paged
+
+# ---------- Индекс памяти (recall_utils) ----------
+# RECALL_ENABLED=1: обратный индекс по всей истории диалога для подмешивания давних реплик
+# (BM25, см. recall_utils). Элемент RecallIndex — термин диалога: (dialog_key, term) →
+# постинги `p` (упакованы recall_utils) и `df`; статистика диалога (число реплик, их
+# суммарная длина, курсор проиндексированного) — элемент с term = RECALL_STATS_KEY.
+
+RECALL_ENABLED = os.getenv("RECALL_ENABLED", "0") == "1"
+RECALL_TABLE = os.getenv("RECALL_TABLE", "RecallIndex")
+RECALL_STATS_KEY = "#stats"  # термины — только буквы и цифры, с ним не совпадут
+
+recall_tbl = _ThreadLocalTable(RECALL_TABLE)
+
+
+def _batch_get(table: str, keys: List[Dict[str, Any]], *, consistent_read: bool = False,
+               what: str = "batch_get") -> List[Dict[str, Any]]:
+    """BatchGetItem по 100 ключей с дочиткой UnprocessedKeys; порядок не сохраняется."""
+    out: List[Dict[str, Any]] = []
+    for i in range(0, len(keys), 100):
+        request = {table: {"Keys": keys[i:i + 100], "ConsistentRead": consistent_read}}
+        for attempt in range(4):
+            try:
+                r = _thread_resource().batch_get_item(RequestItems=request)
+            except Exception as e:
+                logger.warning(f"{what}({len(keys)}) failed: {e}")
+                break
+            out.extend(r.get("Responses", {}).get(table, []))
+            request = r.get("UnprocessedKeys") or {}
+            if not request:
+                break
+            time.sleep(0.05 * (2 ** attempt))
+    return out
+
+
+def get_recall_terms(dialog_key: str, terms: List[str], *,
+                     consistent_read: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Элементы терминов диалога и его статистика (ключ RECALL_STATS_KEY) → {term: item}."""
+    keys = [{"dialog_key": dialog_key, "term": t} for t in dict.fromkeys([RECALL_STATS_KEY, *terms])]
+    items = _batch_get(RECALL_TABLE, keys, consistent_read=consistent_read, what="get_recall_terms")
+    return {it["term"]: it for it in items}
+
+
+def put_recall_terms(items: List[Dict[str, Any]]) -> None:
+    for i in range(0, len(items), 25):
+        _batch_put([(RECALL_TABLE, it, None, None) for it in items[i:i + 25]])
+
+
+def save_recall_stats(dialog_key: str, *, docs: int, total_len: int, cursor: int,
+                      prev_cursor: int) -> bool:
+    """Статистика индекса; условие на прежний курсор — параллельная задача не затрёт
+    чужое продвижение. False — курсор уже сдвинули."""
+    try:
+        recall_tbl.put_item(
+            Item={"dialog_key": dialog_key, "term": RECALL_STATS_KEY,
+                  "n": int(docs), "len": int(total_len), "cursor": int(cursor)},
+            ConditionExpression="attribute_not_exists(#c) OR #c = :prev",
+            ExpressionAttributeNames={"#c": "cursor"},
+            ExpressionAttributeValues={":prev": int(prev_cursor)},
+        )
+        return True
+    except Exception as e:
+        if "ConditionalCheckFailed" not in str(e):
+            logger.warning(f"save_recall_stats({dialog_key}) failed: {e}")
+        return False
+
+
+def messages_after(dialog_key: str, after_ts: int, limit: int) -> List[Dict[str, Any]]:
+    """Реплики новее after_ts, старые первыми (элементы Messages есть в обеих раскладках)."""
+    return _tail_items(dialog_key, int(after_ts), limit, newest_first=False, consistent_read=True)
+
+
+def get_messages_at(dialog_key: str, timestamps: List[int]) -> Dict[int, Dict[str, Any]]:
+    """Реплики по их timestamp одним BatchGetItem → {timestamp: item}; удалённых TTL нет."""
+    keys = [{"dialog_key": dialog_key, "timestamp": int(ts)} for ts in dict.fromkeys(timestamps)]
+    items = _batch_get(MESSAGES_TABLE, keys, what="get_messages_at")
+    return {int(it["timestamp"]): it for it in items}
+
+
+# Одна скользящая сводка на диалог: фиксированный sort key выше любого timestamp, поэтому
+# запрос «самая свежая» (ScanIndexForward=False, Limit=1) возвращает её и для диалогов,
+# где остались строки прежней раскладки (по строке на пересуммаризацию).
+ROLLING_SUMMARY_TS = 2 ** 53 - 1
+
+
+def summary_cursor(item: Optional[Dict[str, Any]]) -> int:
+    """Timestamp (ms) последней реплики, вошедшей в сводку; 0 — сводки нет.
+    Строка прежней раскладки покрывает всё, что было до её создания."""
+    it = item or {}
+    if it.get("cursor") is not None:
+        return int(it["cursor"])
+    ts = int(it.get("timestamp") or 0)
+    return 0 if ts == ROLLING_SUMMARY_TS else ts
+
+
+def summary_updated_ms(item: Optional[Dict[str, Any]]) -> int:
+    """Когда сводка последний раз обновлялась (ms) — для троттлинга по времени."""
+    it = item or {}
+    if it.get("updated_ms") is not None:
+        return int(it["updated_ms"])
+    ts = int(it.get("timestamp") or 0)
+    return 0 if ts == ROLLING_SUMMARY_TS else ts
+
+
+def save_summary(dialog_key: str, summary: str, *, cursor: Optional[int] = None) -> bool:
+    """Перезаписывает скользящую сводку диалога; cursor — timestamp последней свёрнутой
+    реплики (по умолчанию «сейчас»).
+    Условие на cursor не даёт запоздавшей задаче откатить сводку назад; False — не записано."""
     ts_ms = int(time.time() * 1000)
     now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    # TTL: 1 year in seconds from now
+    # TTL: 1 year in seconds from now (продлевается каждым обновлением)
     expire_at = int(time.time()) + 365 * 24 * 3600
     item = {
         "dialog_key": dialog_key,
-        "timestamp": ts_ms,
+        "timestamp": ROLLING_SUMMARY_TS,
         "summary": summary,
+        "cursor": int(cursor if cursor is not None else ts_ms),
+        "updated_ms": ts_ms,
         "created_at": now,
         "expire_at": expire_at,
     }
     try:
-        summaries_tbl.put_item(Item=item)
+        summaries_tbl.put_item(
+            Item=item,
+            ConditionExpression="attribute_not_exists(#c) OR #c <= :c",
+            ExpressionAttributeNames={"#c": "cursor"},
+            ExpressionAttributeValues={":c": item["cursor"]},
+        )
+        _cache.put("summary", dialog_key, item)
+        turn = current_turn()
+        if turn is not None:
+            turn.note_summary(dialog_key, item)
+        return True
     except Exception as e:
-        logger.warning(f"save_summary({dialog_key}) failed: {e}")
+        _cache.invalidate("summary", dialog_key)
+        if "ConditionalCheckFailed" not in str(e):
+            logger.warning(f"save_summary({dialog_key}) failed: {e}")
+        return False
 
 def get_latest_summary(dialog_key: str) -> Optional[str]:
     try:
@@ -439,8 +1322,16 @@ def get_latest_summary(dialog_key: str) -> Optional[str]:
         logger.warning(f"get_latest_summary({dialog_key}) failed: {e}")
         return None
 
-def get_latest_summary_item(dialog_key: str) -> Optional[Dict[str, Any]]:
-    """Последний элемент сводки целиком (с `timestamp`) или None — для троттлинга по времени."""
+def get_latest_summary_item(dialog_key: str, *, use_cache: bool = True,
+                            snapshot: bool = True) -> Optional[Dict[str, Any]]:
+    """Последний элемент сводки целиком или None; курсор и время обновления —
+    summary_cursor() / summary_updated_ms() (понимают и строки прежней раскладки)."""
+    turn = current_turn() if snapshot else None
+    if turn is not None:
+        return turn.summary_item(dialog_key, use_cache=use_cache)
+    hit = _cached("summary", dialog_key, use_cache)
+    if hit is not _MISS:
+        return hit
     try:
         r = summaries_tbl.query(
             KeyConditionExpression=Key("dialog_key").eq(dialog_key),
@@ -448,17 +1339,24 @@ def get_latest_summary_item(dialog_key: str) -> Optional[Dict[str, Any]]:
             Limit=1
         )
         items = r.get("Items", [])
-        return items[0] if items else None
+        item = items[0] if items else None
+        _cache.put("summary", dialog_key, item)
+        return item
     except Exception as e:
         logger.warning(f"get_latest_summary_item({dialog_key}) failed: {e}")
         return None
 
 # ---------- Settings ----------
 
-def get_settings(dialog_key: str) -> Optional[Dict[str, Any]]:
+def get_settings(dialog_key: str, *, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+    hit = _cached("settings", dialog_key, use_cache)
+    if hit is not _MISS:
+        return hit
     try:
         r = settings_tbl.get_item(Key={"dialog_key": dialog_key})
-        return r.get("Item")
+        item = r.get("Item")
+        _cache.put("settings", dialog_key, item)
+        return item
     except Exception as e:
         logger.warning(f"get_settings({dialog_key}) failed: {e}")
         return None
@@ -474,7 +1372,9 @@ def save_settings(dialog_key: str, *, mode: str, meta: Optional[Dict[str, Any]]
     }
     try:
         settings_tbl.put_item(Item=item)
+        _cache.put("settings", dialog_key, item)
     except Exception as e:
+        _cache.invalidate("settings", dialog_key)
         logger.warning(f"save_settings({dialog_key}) failed: {e}")
 
 def update_settings(dialog_key: str, **kwargs) -> Dict[str, Any]:
@@ -502,12 +1402,392 @@ def update_settings(dialog_key: str, **kwargs) -> Dict[str, Any]:
             ExpressionAttributeNames=names or None,
             ReturnValues="ALL_NEW",
         )
-        return r.get("Attributes", {})
+        attrs = r.get("Attributes", {})
+        _cache.put("settings", dialog_key, attrs)
+        return attrs
     except Exception as e:
+        _cache.invalidate("settings", dialog_key)
         logger.warning(f"update_settings({dialog_key}) failed: {e}")
         # Fallback: create with defaults if missing
         try:
             save_settings(dialog_key, mode=mode or "mention", meta=meta or {})
         except Exception:
             pass
-        return get_settings(dialog_key) or {"dialog_key": dialog_key, "mode": mode or "mention", "meta": meta or {}}
+        return get_settings(dialog_key, use_cache=False) or {"dialog_key": dialog_key, "mode": mode or "mention", "meta": meta or {}}
+
+# ---------- Ход как единица работы ----------
+# Один ход worker-а раньше читал одно и то же по нескольку раз: историю для контекста и
+# снова для сводки/долгосрочного профиля (задачи обслуживания без очереди выполняются
+# в том же вызове), профиль автора — после уже прочитанного get_user, факты — заново
+# внутри add_user_fact. TurnContext держит снимок чтений хода, поверх которого видны
+# записи этого же хода, и откладывает записи до flush(): отложенные put-ы уходят одним
+# BatchWriteItem (сразу по нескольким таблицам), изменения профиля — одним UpdateItem
+# на пользователя.
+#
+#   with TurnContext() as turn:   # активен в текущем потоке: get_dialog_history,
+#       ...                       # get_user(_profile/_facts), batch_get_users,
+#       turn.flush()              # get_latest_summary_item читают из снимка
+#
+# Из других потоков (пул чтений _fanout) — явно: turn.history(...), turn.user(...).
+
+TURN_BUFFER_WRITES = os.getenv("TURN_BUFFER_WRITES", "1") == "1"
+
+_turn_local = threading.local()
+
+
+def current_turn() -> Optional["TurnContext"]:
+    """TurnContext, активный в текущем потоке, или None."""
+    return getattr(_turn_local, "turn", None)
+
+
+def _defer_put(defer: bool, table: str, item: Dict[str, Any],
+               ns: Optional[str] = None, key: Optional[str] = None) -> bool:
+    """Откладывает put в активный ход (если defer и буферизация включена)."""
+    turn = current_turn() if defer else None
+    if turn is None or not turn.buffer_writes:
+        return False
+    turn.defer_put(table, item, ns, key)
+    return True
+
+
+class TurnContext:
+    """Снимок чтений и буфер записей одного хода. Потокобезопасен (чтения — из пула)."""
+
+    def __init__(self, *, buffer_writes: bool = TURN_BUFFER_WRITES):
+        self.buffer_writes = buffer_writes
+        self._lock = threading.RLock()
+        # dialog_key → (limit запроса, история полная?, реплики по возрастанию)
+        self._history: Dict[str, Tuple[int, bool, List[Dict[str, Any]]]] = {}
+        self._own: Dict[str, List[Dict[str, Any]]] = {}  # реплики, записанные ходом
+        self._users: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._summaries: Dict[str, Optional[Dict[str, Any]]] = {}
+        # Прочитаны мимо кэша тёплого контейнера или записаны ходом: годятся для use_cache=False
+        self._fresh: set = set()
+        self._puts: List[Tuple[str, Dict[str, Any], Optional[str], Optional[str]]] = []
+        self._profile_updates: Dict[str, Dict[str, Any]] = {}
+        self._upserts: Dict[str, Dict[str, Any]] = {}  # отложенные upsert_user
+        self._rosters: Dict[str, Dict[str, Any]] = {}  # отложенные update_roster по каналу
+        self.loaded = 0
+        self.served = 0
+        self.written = 0
+        self._prev: Optional["TurnContext"] = None
+
+    def __enter__(self) -> "TurnContext":
+        self._prev = current_turn()
+        _turn_local.turn = self
+        return self
+
+    @contextlib.contextmanager
+    def active(self):
+        """Делает ход активным в текущем потоке без flush на выходе (для пула чтений)."""
+        prev = current_turn()
+        _turn_local.turn = self
+        try:
+            yield self
+        finally:
+            _turn_local.turn = prev
+
+    def __exit__(self, *exc) -> None:
+        try:
+            self.flush()
+        finally:
+            _turn_local.turn = self._prev
+        logger.info("TURN reads loaded=%d served=%d writes=%d", self.loaded, self.served, self.written)
+
+    # --- чтения ---
+
+    def history(self, dialog_key: str, limit: int, *, consistent_read: bool = True) -> List[Dict[str, Any]]:
+        with self._lock:
+            snap = self._history.get(dialog_key)
+            if snap and (snap[1] or limit <= snap[0]):
+                self.served += 1
+                return list(snap[2][-limit:])
+        items = get_dialog_history(dialog_key, limit=limit, consistent_read=consistent_read, snapshot=False)
+        with self._lock:
+            self.loaded += 1
+            seen = {m.get("timestamp") for m in items}
+            items = items + [m for m in self._own.get(dialog_key, []) if m.get("timestamp") not in seen]
+            items.sort(key=lambda x: x["timestamp"])
+            snap = self._history.get(dialog_key)
+            if not snap or limit >= snap[0]:
+                # Ошибка чтения ([]) не выдаётся за «история полная»
+                self._history[dialog_key] = (limit, 0 < len(items) < limit, items)
+            return list(items[-limit:])
+
+    def user(self, user_id: str, *, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if user_id in self._users and (use_cache or ("user", user_id) in self._fresh):
+                self.served += 1
+                return copy.deepcopy(self._users[user_id])
+        item = get_user(user_id, use_cache=use_cache, snapshot=False)
+        with self._lock:
+            self.loaded += 1
+            if user_id not in self._users or not use_cache:
+                self._users[user_id] = self._apply_pending(user_id, item)
+            if not use_cache:
+                self._fresh.add(("user", user_id))
+            return copy.deepcopy(self._users[user_id])
+
+    def users(self, user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            missing = [u for u in dict.fromkeys(user_ids) if u and u not in self._users]
+        if missing:
+            found = batch_get_users(missing, snapshot=False)
+            with self._lock:
+                self.loaded += 1
+                for u in missing:
+                    self._users.setdefault(u, self._apply_pending(u, found.get(u)))
+        with self._lock:
+            self.served += int(not missing)
+            return {u: copy.deepcopy(self._users[u]) for u in user_ids if self._users.get(u)}
+
+    def peek_user(self, user_id: str) -> Any:
+        """Запись из снимка без чтения из таблицы; _MISS — пользователя в снимке нет."""
+        with self._lock:
+            return copy.deepcopy(self._users[user_id]) if user_id in self._users else _MISS
+
+    def profile(self, user_id: str) -> Optional[Dict[str, Any]]:
+        user = self.user(user_id)
+        return user.get("profile", {}) if user else None
+
+    def summary_item(self, dialog_key: str, *, use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if dialog_key in self._summaries and (use_cache or ("summary", dialog_key) in self._fresh):
+                self.served += 1
+                return copy.deepcopy(self._summaries[dialog_key])
+        item = get_latest_summary_item(dialog_key, use_cache=use_cache, snapshot=False)
+        with self._lock:
+            self.loaded += 1
+            if dialog_key not in self._summaries or not use_cache:
+                self._summaries[dialog_key] = item
+            if not use_cache:
+                self._fresh.add(("summary", dialog_key))
+            return copy.deepcopy(self._summaries[dialog_key])
+
+    # --- записи (видны чтениям хода сразу) ---
+
+    def note_message(self, item: Dict[str, Any]) -> None:
+        dkey = item["dialog_key"]
+        with self._lock:
+            self._own.setdefault(dkey, []).append(item)
+            snap = self._history.get(dkey)
+            if snap and all(m.get("timestamp") != item["timestamp"] for m in snap[2]):
+                items = sorted(snap[2] + [item], key=lambda x: x["timestamp"])
+                self._history[dkey] = (snap[0], snap[1], items)
+
+    def note_user(self, user_id: str, item: Optional[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._users[user_id] = self._apply_pending(user_id, copy.deepcopy(item))
+            self._fresh.add(("user", user_id))
+
+    def note_summary(self, dialog_key: str, item: Dict[str, Any]) -> None:
+        with self._lock:
+            self._summaries[dialog_key] = copy.deepcopy(item)
+            self._fresh.add(("summary", dialog_key))
+
+    def defer_put(self, table: str, item: Dict[str, Any], ns: Optional[str], key: Optional[str]) -> None:
+        with self._lock:
+            self._puts.append((table, item, ns, key))
+        if table == MESSAGES_TABLE:
+            self.note_message(item)
+        elif ns == "user" and key:
+            self.note_user(key, item)
+
+    def defer_upsert(self, user_id: str, username: Optional[str], first_name: Optional[str],
+                     last_name: Optional[str], increment_messages: bool) -> None:
+        with self._lock:
+            prev = self._upserts.get(user_id)
+            if prev is not None:
+                known = prev["profile_known"]
+            elif user_id in self._users:
+                known = bool(self._users[user_id] and "profile" in self._users[user_id])
+            else:
+                known = None
+            self._upserts[user_id] = {
+                "username": username, "first_name": first_name, "last_name": last_name,
+                "increment_messages": increment_messages or bool((prev or {}).get("increment_messages")),
+                "profile_known": known,
+            }
+            user = self._users.get(user_id) or {"user_id": user_id, "profile": dict(_EMPTY_PROFILE)}
+            prof = user.setdefault("profile", dict(_EMPTY_PROFILE))
+            if username is not None:
+                user["username"] = username or ""
+            for k, v in (("first_name", first_name), ("last_name", last_name)):
+                if v is not None:
+                    prof[k] = v or ""
+            if increment_messages:
+                prof["message_count"] = int(prof.get("message_count", 0) or 0) + 1
+            self._users[user_id] = user
+
+    def take_upsert(self, user_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._upserts.pop(user_id, None)
+
+    def defer_roster(self, channel_id: str, user_id: str, username: Optional[str],
+                     first_name: Optional[str], last_name: Optional[str],
+                     channel: Optional[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._rosters[channel_id] = {"user_id": user_id, "username": username, "first_name": first_name,
+                                         "last_name": last_name, "channel": channel}
+
+    def defer_profile_update(self, user_id: str, fields: Dict[str, Any], increment_messages: bool) -> None:
+        with self._lock:
+            pending = self._profile_updates.setdefault(user_id, {})
+            pending.update(fields)
+            if increment_messages:
+                pending["increment_messages"] = True
+            user = self._users.get(user_id)
+            if user is not None:
+                self._users[user_id] = self._apply_pending(user_id, user, {**fields, "increment_messages": increment_messages})
+
+    def _apply_pending(self, user_id: str, item: Optional[Dict[str, Any]],
+                       pending: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Накладывает отложенные изменения профиля на прочитанную запись."""
+        pending = self._profile_updates.get(user_id) if pending is None else pending
+        if not item or not pending:
+            return item
+        prof = item.setdefault("profile", {})
+        for k, v in pending.items():
+            if k == "increment_messages":
+                if v:
+                    prof["message_count"] = int(prof.get("message_count", 0) or 0) + 1
+            else:
+                prof[k] = copy.deepcopy(v)
+        return item
+
+    def flush(self) -> None:
+        """Пишет отложенное: put-ы — BatchWriteItem по 25, затем по UpdateItem на пользователя
+        (upsert_user), на профиль и на состав чата (после put-а нового канала)."""
+        with self._lock:
+            puts, self._puts = self._puts, []
+            upserts = {u: {k: v for k, v in p.items() if k != "profile_known"}
+                       for u, p in self._upserts.items()}
+            updates, self._profile_updates = self._profile_updates, {}
+            rosters, self._rosters = self._rosters, {}
+        if not (puts or upserts or updates or rosters):
+            return
+        t0 = time.perf_counter()
+        for i in range(0, len(puts), 25):
+            _batch_put(puts[i:i + 25])
+        with self.active():
+            for user_id, kw in upserts.items():
+                upsert_user(user_id, **kw)  # сам забирает отложенное (take_upsert)
+            for user_id, fields in updates.items():
+                update_user_profile(user_id, **fields)
+            for channel_id, kw in rosters.items():
+                update_roster(channel_id, **kw)
+        self.written += len(puts) + len(upserts) + len(updates) + len(rosters)
+        logger.info("TURN flush puts=%d upserts=%d profile_updates=%d rosters=%d %dms",
+                    len(puts), len(upserts), len(updates), len(rosters), (time.perf_counter() - t0) * 1000)
+
+
+def _batch_put(puts: List[Tuple[str, Dict[str, Any], Optional[str], Optional[str]]]) -> None:
+    """Один BatchWriteItem (до 25 put-ов, любые таблицы) с дочиткой UnprocessedItems;
+    write-through в кэш чтений — как у одиночных save_*."""
+    request: Dict[str, List[Dict[str, Any]]] = {}
+    for table, item, _, _ in puts:
+        request.setdefault(table, []).append({"PutRequest": {"Item": item}})
+    ok = False
+    for attempt in range(4):
+        try:
+            r = _thread_resource().batch_write_item(RequestItems=request)
+        except Exception as e:
+            logger.warning(f"batch_write({len(puts)}) failed: {e}")
+            break
+        request = r.get("UnprocessedItems") or {}
+        if not request:
+            ok = True
+            break
+        time.sleep(0.05 * (2 ** attempt))
+    else:
+        logger.warning(f"batch_write({len(puts)}): {sum(map(len, request.values()))} item(s) unprocessed")
+    for _, item, ns, key in puts:
+        if ns and key:
+            if ok:
+                _cache.put(ns, key, item)
+            else:
+                _cache.invalidate(ns, key)
+
+# ---------- Updates (идемпотентность обработки) ----------
+# SQS может доставить один update повторно (таймаут worker, standard-очередь, истёкшее окно
+# дедупликации FIFO). Журнал по update_id: запись «захватывается» условным update на время
+# UPDATE_LEASE_SEC и хранит пройденный этап, чтобы повтор продолжил с места остановки.
+
+# Лиза должна быть чуть дольше timeout worker-а: пока вызов может быть жив, повтор ждёт
+UPDATE_LEASE_SEC = int(os.getenv("UPDATE_LEASE_SEC", "65"))
+UPDATE_LEDGER_TTL_SEC = int(os.getenv("UPDATE_LEDGER_TTL_SEC", str(4 * 24 * 3600)))
+
+# Этапы по порядку: claimed → saved (реплика в истории) → replied (ответ отправлен) →
+# maintained (задачи обслуживания поставлены) → done
+UPDATE_STAGES = ("claimed", "saved", "replied", "maintained", "done")
+
+
+def update_stage_reached(item: Optional[Dict[str, Any]], stage: str) -> bool:
+    cur = (item or {}).get("stage") or "claimed"
+    return UPDATE_STAGES.index(cur) >= UPDATE_STAGES.index(stage)
+
+
+def claim_update(update_id: str) -> Tuple[str, Dict[str, Any]]:
+    """Захватывает update_id для обработки → (status, item).
+
+    status: "new" — первая доставка; "resume" — повтор незавершённой обработки (этап в
+    item["stage"]); "done" — уже обработан; "busy" — прямо сейчас обрабатывается другим
+    вызовом (лиза не истекла). Если журнал недоступен — "new" (обработка как раньше).
+    """
+    now = int(time.time())
+    try:
+        r = updates_tbl.update_item(
+            Key={"update_id": update_id},
+            UpdateExpression=(
+                "SET #st = if_not_exists(#st, :claimed), #lease = :lease, "
+                "#att = if_not_exists(#att, :zero) + :one, #exp = if_not_exists(#exp, :exp)"
+            ),
+            ConditionExpression="attribute_not_exists(#id) OR (#st <> :done AND #lease < :now)",
+            ExpressionAttributeNames={
+                "#id": "update_id", "#st": "stage", "#lease": "lease_until",
+                "#att": "attempts", "#exp": "expire_at",
+            },
+            ExpressionAttributeValues={
+                ":claimed": "claimed", ":done": "done", ":now": now,
+                ":lease": now + UPDATE_LEASE_SEC, ":zero": 0, ":one": 1,
+                ":exp": now + UPDATE_LEDGER_TTL_SEC,
+            },
+            ReturnValues="ALL_NEW",
+        )
+        item = r.get("Attributes") or {}
+        return ("new" if int(item.get("attempts", 1)) <= 1 else "resume"), item
+    except Exception as e:
+        if "ConditionalCheckFailed" not in str(e):
+            logger.warning(f"claim_update({update_id}) failed: {e}")
+            return "new", {}
+    try:
+        item = updates_tbl.get_item(Key={"update_id": update_id}, ConsistentRead=True).get("Item") or {}
+    except Exception as e:
+        logger.warning(f"claim_update({update_id}) read failed: {e}")
+        item = {}
+    return ("done" if item.get("stage") == "done" else "busy"), item
+
+
+def set_update_stage(update_id: str, stage: str, **fields: Any) -> None:
+    """Фиксирует пройденный этап (и данные для продолжения: saved_ts, text, tasks …)."""
+    names = {"#st": "stage"}
+    vals: Dict[str, Any] = {":st": stage}
+    parts = ["#st = :st"]
+    for i, (k, v) in enumerate(fields.items()):
+        names[f"#f{i}"] = k
+        vals[f":f{i}"] = v
+        parts.append(f"#f{i} = :f{i}")
+    if stage == "done":
+        # Лиза больше не нужна: повтор увидит done и сразу выйдет
+        parts.append("#lease = :zero")
+        names["#lease"] = "lease_until"
+        vals[":zero"] = 0
+    try:
+        updates_tbl.update_item(
+            Key={"update_id": update_id},
+            UpdateExpression="SET " + ", ".join(parts),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=vals,
+        )
+    except Exception as e:
+        logger.warning(f"set_update_stage({update_id}, {stage}) failed: {e}")
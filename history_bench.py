@@ -0,0 +1,163 @@
+# history_bench.py  —  цена чтения истории: элементы Messages против страниц (MESSAGES_LAYOUT)
+"""Сколько RCU стоит загрузка истории хода в каждой раскладке — по выгрузке Messages.
+
+  python history_bench.py <messages.jsonl> [--limit 120] [--page-size 50]
+
+messages.jsonl — элемент Messages на строку: обычный JSON или DynamoDB JSON, например
+  aws dynamodb scan --table-name Messages --output json | jq -c '.Items[]' > messages.jsonl
+
+Для каждого диалога проигрывается его история: на каждой реплике пользователя — чтение
+последних `--limit` реплик (как STEP5 worker-а, ConsistentRead), после каждого ответа —
+сворачивание хвоста, когда тот дорос до страницы (как задача compact_history).
+  items — один строго согласованный Query по `limit` элементам;
+  pages — Query страниц (eventual, неизменяемы) + строго согласованный Query хвоста.
+Размер элементов — по правилам DynamoDB (имена атрибутов + значения), Query округляет
+суммарный размер до 4 КБ; страницы упаковываются тем же dynamo_utils.pack_page.
+Печатает RCU на ход в обеих раскладках и цену сворачивания в WCU на реплику.
+"""
+
+import base64
+import json
+import math
+import sys
+from collections import defaultdict
+from decimal import Decimal
+from typing import Any, Dict, List, Tuple
+
+from dynamo_utils import pack_page, MESSAGE_PAGE_SIZE
+
+_TYPED = {"S", "N", "B", "BOOL", "NULL", "L", "M", "SS", "NS", "BS"}
+
+
+def _untype(v: Dict[str, Any]) -> Any:
+    (t, x), = v.items()
+    if t == "S":
+        return x
+    if t == "N":
+        return Decimal(x)
+    if t == "B":
+        return base64.b64decode(x)
+    if t == "BOOL":
+        return bool(x)
+    if t == "NULL":
+        return None
+    if t == "L":
+        return [_untype(e) for e in x]
+    if t == "M":
+        return {k: _untype(e) for k, e in x.items()}
+    return set(x)
+
+
+def load_items(path: str) -> List[Dict[str, Any]]:
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            it = json.loads(line, parse_float=Decimal)
+            it = it.get("Item", it)
+            if all(isinstance(v, dict) and len(v) == 1 and next(iter(v)) in _TYPED for v in it.values()):
+                it = {k: _untype(v) for k, v in it.items()}
+            items.append(it)
+    return items
+
+
+def value_size(v: Any) -> int:
+    """Размер значения по правилам DynamoDB."""
+    if v is None or isinstance(v, bool):
+        return 1
+    if isinstance(v, (int, float, Decimal)):
+        digits = len(str(abs(Decimal(v)).normalize()).replace(".", "").lstrip("0")) or 1
+        return (digits + 1) // 2 + 1
+    if isinstance(v, str):
+        return len(v.encode("utf-8"))
+    if isinstance(v, (bytes, bytearray)):
+        return len(v)
+    if isinstance(v, dict):
+        return 3 + sum(len(k.encode("utf-8")) + value_size(e) + 1 for k, e in v.items())
+    if isinstance(v, (list, tuple, set)):
+        return 3 + sum(value_size(e) + 1 for e in v)
+    return len(str(v).encode("utf-8"))
+
+
+def item_size(item: Dict[str, Any]) -> int:
+    return sum(len(k.encode("utf-8")) + value_size(v) for k, v in item.items())
+
+
+def query_rcu(total_bytes: int, *, consistent: bool) -> float:
+    """Query: суммарный размер, округлённый до 4 КБ; минимум одна единица."""
+    units = max(1, math.ceil(total_bytes / 4096))
+    return units if consistent else units / 2
+
+
+def _page_item(dkey: str, msgs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {"dialog_key": dkey, "page": int(msgs[0]["timestamp"]), "last_ts": int(msgs[-1]["timestamp"]),
+            "n": len(msgs), "z": pack_page(msgs),
+            "expire_at": max(int(m.get("expire_at") or 0) for m in msgs)}
+
+
+def simulate(msgs: List[Dict[str, Any]], limit: int, page_size: int) -> Tuple[List[float], List[float], int]:
+    """→ (RCU items по ходам, RCU pages по ходам, WCU на запись страниц)."""
+    sizes = [item_size(m) for m in msgs]
+    dkey = str(msgs[0].get("dialog_key") or "")
+    pages: List[Tuple[int, int]] = []  # (индекс после последней реплики страницы, размер)
+    tail_from = 0
+    items_rcu, pages_rcu, page_wcu = [], [], 0
+    for i, m in enumerate(msgs):
+        n = i + 1
+        if m.get("role") == "user":
+            items_rcu.append(query_rcu(sum(sizes[max(0, n - limit):n]), consistent=True))
+            want = max(1, -(-limit // page_size))
+            read_pages = pages[-want:]
+            tail = sizes[max(tail_from, n - limit):n]
+            cost = query_rcu(sum(tail), consistent=True)
+            if pages:
+                cost += query_rcu(sum(sz for _, sz in read_pages), consistent=False)
+            pages_rcu.append(cost)
+        elif n - tail_from >= page_size:
+            while n - tail_from >= page_size:
+                page = _page_item(dkey, msgs[tail_from:tail_from + page_size])
+                sz = item_size(page)
+                pages.append((tail_from + page_size, sz))
+                page_wcu += max(1, math.ceil(sz / 1024))
+                tail_from += page_size
+    return items_rcu, pages_rcu, page_wcu
+
+
+def main(path: str, limit: int, page_size: int) -> None:
+    by_dialog: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for it in load_items(path):
+        if it.get("dialog_key") and it.get("timestamp") is not None:
+            by_dialog[str(it["dialog_key"])].append(it)
+    items_rcu: List[float] = []
+    pages_rcu: List[float] = []
+    page_wcu = n_msgs = msg_wcu = 0
+    for msgs in by_dialog.values():
+        msgs.sort(key=lambda x: int(x["timestamp"]))
+        a, b, w = simulate(msgs, limit, page_size)
+        items_rcu += a
+        pages_rcu += b
+        page_wcu += w
+        n_msgs += len(msgs)
+        msg_wcu += sum(max(1, math.ceil(item_size(m) / 1024)) for m in msgs)
+    turns = len(items_rcu)
+    if not turns:
+        print("no user messages")
+        return
+    pick = lambda xs, q: sorted(xs)[min(int(q * len(xs)), len(xs) - 1)]
+    print(f"dialogs={len(by_dialog)} messages={n_msgs} turns={turns} limit={limit} page={page_size}")
+    for name, xs in (("items", items_rcu), ("pages", pages_rcu)):
+        print(f"{name:6} RCU/turn mean={sum(xs) / turns:.2f} p50={pick(xs, 0.5):.1f} "
+              f"p90={pick(xs, 0.9):.1f} total={sum(xs):.0f}")
+    print(f"saved  {1 - sum(pages_rcu) / sum(items_rcu):.0%} of history RCU")
+    print(f"writes WCU/msg items={msg_wcu / n_msgs:.2f} + pages={page_wcu / n_msgs:.2f} "
+          f"(реплики пишутся так же, страницы — сверху)")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or args[0].startswith("-"):
+        print(__doc__)
+        sys.exit(2)
+    opt = lambda name, default: int(args[args.index(name) + 1]) if name in args else default
+    main(args[0], opt("--limit", 120), opt("--page-size", MESSAGE_PAGE_SIZE))
@@ -0,0 +1,129 @@
+# http_utils.py  —  общий HTTP-транспорт: keep-alive сессии, таймауты, повторы, метрики
+"""Один пул соединений на хост, живущий в тёплом контейнере между вызовами Lambda.
+
+Раньше каждый вызов Telegram / OpenAI STT / OpenWeatherMap шёл через голый
+`requests.get/post` — новый DNS-запрос и TLS-рукопожатие на каждый из 3–6 вызовов хода.
+
+  get(url, timeout=(connect, read), ...)   — идемпотентный: до HTTP_RETRIES повторов
+  post(url, timeout=..., idempotent=False) — повторяется только то, что точно не ушло
+                                             (ConnectTimeout); idempotent=True — как get
+  log_http_stats()                         — строка `HTTP host=… n=… err=… retry=… avg=… max=…`
+
+requests импортируется при первом запросе (холодный старт, см. coldstart.py).
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+HTTP_READ_TIMEOUT    = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_RETRIES         = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_SEC     = float(os.getenv("HTTP_BACKOFF_SEC", "0.3"))
+# Соединений на хост: потоки WORKER_CONCURRENCY + heartbeat-ы «печатает…»
+HTTP_POOL_SIZE       = int(os.getenv("HTTP_POOL_SIZE", "16"))
+
+# Ответы, которые имеет смысл повторить (для идемпотентных запросов)
+_RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
+Timeout = Union[float, Tuple[float, float]]
+
+_sessions: Dict[str, Any] = {}
+_sessions_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, float]] = {}
+
+
+def _session(host: str):
+    s = _sessions.get(host)
+    if s is not None:
+        return s
+    with _sessions_lock:
+        s = _sessions.get(host)
+        if s is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _sessions[host] = s
+    return s
+
+
+def _record(host: str, ms: float, *, error: bool, retry: bool) -> None:
+    with _stats_lock:
+        st = _stats.setdefault(host, {"n": 0, "err": 0, "retry": 0, "ms": 0.0, "max": 0.0})
+        st["n"] += 1
+        st["err"] += int(error)
+        st["retry"] += int(retry)
+        st["ms"] += ms
+        st["max"] = max(st["max"], ms)
+
+
+def request(method: str, url: str, *, timeout: Optional[Timeout] = None,
+            retries: int = HTTP_RETRIES, idempotent: bool = True, **kwargs: Any):
+    """HTTP-запрос через пул хоста, до `retries` повторов с экспоненциальной паузой.
+
+    Идемпотентный запрос повторяется после сбоя соединения, таймаута или 5xx,
+    неидемпотентный — только после ConnectTimeout (запрос не ушёл — дубля не будет).
+    Ответ 5xx после исчерпания повторов возвращается как есть, исключения пробрасываются.
+    """
+    import requests
+
+    host = urlsplit(url).hostname or ""
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    elif not isinstance(timeout, tuple):
+        timeout = (min(HTTP_CONNECT_TIMEOUT, float(timeout)), float(timeout))
+    for attempt in range(1 + max(retries, 0)):
+        last = attempt >= retries
+        t0 = time.perf_counter()
+        try:
+            r = _session(host).request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            again = not last and (idempotent or isinstance(e, requests.exceptions.ConnectTimeout))
+            _record(host, (time.perf_counter() - t0) * 1000, error=True, retry=again)
+            if not again:
+                raise
+        else:
+            again = not last and idempotent and r.status_code in _RETRY_STATUSES
+            _record(host, (time.perf_counter() - t0) * 1000, error=r.status_code >= 500, retry=again)
+            if not again:
+                return r
+        time.sleep(HTTP_BACKOFF_SEC * (2 ** attempt) * (0.5 + random.random()))
+    raise AssertionError("unreachable")
+
+
+def get(url: str, *, timeout: Optional[Timeout] = None, retries: int = HTTP_RETRIES, **kwargs: Any):
+    return request("GET", url, timeout=timeout, retries=retries, idempotent=True, **kwargs)
+
+
+def post(url: str, *, timeout: Optional[Timeout] = None, idempotent: bool = False,
+         retries: int = HTTP_RETRIES, **kwargs: Any):
+    return request("POST", url, timeout=timeout, retries=retries, idempotent=idempotent, **kwargs)
+
+
+def http_stats(reset: bool = False) -> Dict[str, Dict[str, float]]:
+    with _stats_lock:
+        out = {h: dict(st) for h, st in _stats.items()}
+        if reset:
+            _stats.clear()
+    return out
+
+
+def log_http_stats(reset: bool = True) -> None:
+    """Пишет в лог счётчики по хостам (за вызов Lambda при reset=True)."""
+    for host, st in sorted(http_stats(reset=reset).items()):
+        logger.info(
+            "HTTP host=%s n=%d err=%d retry=%d avg=%dms max=%dms",
+            host, st["n"], st["err"], st["retry"], st["ms"] / max(st["n"], 1), st["max"],
+        )
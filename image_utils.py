@@ -0,0 +1,255 @@
+# image_utils.py  —  подготовка картинок для Claude: уменьшение, перекодирование, кэш
+"""Картинка из Telegram → image-блок, который не дороже, чем нужно.
+
+Раньше файл (до 3.5 МБ) уходил в модель как есть: платили за загрузку разрешения, которое
+модель всё равно уменьшит до 1568 px / ~1.15 Мпикс, а пересланную картинку качали заново.
+Теперь:
+  - уменьшаем до того же предела (claude_utils.IMAGE_MAX_EDGE / IMAGE_MAX_PIXELS) —
+    цена в токенах та же, байт в разы меньше; JPEG декодируется сразу в уменьшенном виде
+    (draft), поворот по EXIF применяется;
+  - перекодируем: без прозрачности — JPEG (IMAGE_JPEG_QUALITY), с прозрачностью — WebP;
+    если результат не меньше исходника, а тот уже в пределах — оставляем исходник;
+  - кэшируем результат по file_unique_id (общий для пересылок и разных file_id) в памяти
+    тёплого контейнера, IMAGE_CACHE_MAX_BYTES;
+  - скачивание и декодирование идут в пуле потоков (prepare_images / submit_image):
+    несколько картинок хода готовятся параллельно, Pillow отпускает GIL на тяжёлых операциях.
+
+Pillow — необязательная зависимость: без него картинка уходит как раньше (без уменьшения),
+но кэш и пул работают.
+"""
+
+import io
+import os
+import base64
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from claude_utils import IMAGE_MAX_EDGE, IMAGE_MAX_PIXELS, image_size
+from telegram_utils import get_file_bytes
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PREPROCESS      = os.getenv("IMAGE_PREPROCESS", "1") == "1"
+IMAGE_JPEG_QUALITY    = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(24 * 1024 * 1024)))
+IMAGE_WORKERS         = int(os.getenv("IMAGE_WORKERS", "4"))
+# Исходник больше этого уменьшать нечем (Pillow нет) — в модель не отправляем
+IMAGE_RAW_MAX_BYTES   = 3_500_000
+# Скачиваем с запасом: после уменьшения и крупный файл становится дешёвым (лимит getFile — 20 МБ)
+IMAGE_DOWNLOAD_MAX_BYTES = 20_000_000
+
+# Claude принимает image-блоки только этих типов
+_MIME_BY_EXT = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png",
+                "gif": "image/gif", "webp": "image/webp"}
+
+
+class PreparedImage(NamedTuple):
+    data: str          # base64
+    media_type: str
+    width: Optional[int]
+    height: Optional[int]
+    nbytes: int        # размер после подготовки
+    src_bytes: int     # размер исходника
+
+    def block(self) -> dict:
+        return {"type": "image", "source": {"type": "base64", "media_type": self.media_type,
+                                            "data": self.data}}
+
+
+class _ImageCache:
+    """LRU по байтам: file_unique_id → PreparedImage."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, PreparedImage]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[PreparedImage]:
+        with self._lock:
+            img = self._data.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def put(self, key: str, img: PreparedImage) -> None:
+        size = len(img.data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.data)
+            self._data[key] = img
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, ev = self._data.popitem(last=False)
+                self._bytes -= len(ev.data)
+
+
+_cache = _ImageCache(IMAGE_CACHE_MAX_BYTES)
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+# Готовящиеся картинки: key → [Future, сколько ходов его ждёт]. Future общий для ходов,
+# поэтому снимать его (release_image) можно, только когда он не нужен никому.
+_inflight: Dict[str, list] = {}
+_inflight_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=max(IMAGE_WORKERS, 1),
+                                           thread_name_prefix="image")
+    return _pool
+
+
+def _target_size(w: int, h: int) -> Tuple[int, int]:
+    """Размер, до которого модель уменьшила бы картинку сама (см. TokenEstimator.image_tokens)."""
+    k = min(1.0, IMAGE_MAX_EDGE / max(w, h))
+    if w * h * k * k > IMAGE_MAX_PIXELS:
+        k = (IMAGE_MAX_PIXELS / (w * h)) ** 0.5
+    return max(int(w * k), 1), max(int(h * k), 1)
+
+
+def _mime_for(file_path: Optional[str], data: bytes) -> Optional[str]:
+    ext = (file_path.rsplit(".", 1)[-1] if file_path and "." in file_path else "").lower()
+    mime = _MIME_BY_EXT.get(ext)
+    if mime:
+        return mime
+    if data[:2] == b"\xff\xd8":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    return None
+
+
+def _raw(data: bytes, mime: Optional[str]) -> Optional[PreparedImage]:
+    """Без Pillow или при ошибке декодирования: исходник как есть, если он годится."""
+    if not mime or len(data) > IMAGE_RAW_MAX_BYTES:
+        return None
+    w, h = image_size(data) or (None, None)
+    return PreparedImage(base64.b64encode(data).decode("ascii"), mime, w, h, len(data), len(data))
+
+
+def transcode(data: bytes, mime: Optional[str] = None) -> Optional[PreparedImage]:
+    """Уменьшение и перекодирование (CPU). None — картинку отправить нельзя."""
+    if not IMAGE_PREPROCESS:
+        return _raw(data, mime)
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return _raw(data, mime)
+    try:
+        img = Image.open(io.BytesIO(data))
+        w0, h0 = img.size
+        tw, th = _target_size(w0, h0)
+        within = (tw, th) == (w0, h0)
+        if img.format == "JPEG":
+            img.draft("RGB", (tw, th))  # декодер JPEG сразу уменьшает в 2/4/8 раз (не меньше tw×th)
+        img = ImageOps.exif_transpose(img)
+        if (img.width > img.height) != (w0 > h0):  # EXIF-поворот на 90°
+            tw, th = th, tw
+        alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        img = img.convert("RGBA" if alpha else "RGB")
+        if img.size != (tw, th):
+            img = img.resize((tw, th), Image.LANCZOS)
+        out = io.BytesIO()
+        if alpha:
+            img.save(out, format="WEBP", quality=IMAGE_JPEG_QUALITY, method=2)
+            out_mime = "image/webp"
+        else:
+            img.save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            out_mime = "image/jpeg"
+        enc = out.getvalue()
+    except Exception as e:
+        logger.warning("Image transcode failed, sending original: %s", e)
+        return _raw(data, mime)
+    # Исходник уже в пределах и меньше — перекодирование только потеряло бы качество
+    if mime and within and len(enc) >= len(data) and len(data) <= IMAGE_RAW_MAX_BYTES:
+        return _raw(data, mime)
+    return PreparedImage(base64.b64encode(enc).decode("ascii"), out_mime, tw, th, len(enc), len(data))
+
+
+def prepare_image(file_id: str, unique_id: Optional[str] = None) -> Optional[PreparedImage]:
+    """Скачивает и готовит картинку; результат кэшируется по file_unique_id (или file_id)."""
+    if not file_id:
+        return None
+    key = unique_id or file_id
+    hit = _cache.get(key)
+    if hit is not None:
+        return hit
+    data, file_path = get_file_bytes(file_id, max_bytes=IMAGE_DOWNLOAD_MAX_BYTES)
+    if not data:
+        return None
+    img = transcode(data, _mime_for(file_path, data))
+    if img is not None:
+        _cache.put(key, img)
+    return img
+
+
+def submit_image(file_id: str, unique_id: Optional[str] = None) -> "Future[Optional[PreparedImage]]":
+    """prepare_image в пуле; одна и та же картинка (file_unique_id), уже готовящаяся
+    в другом потоке, второй раз не качается — возвращается тот же Future. Каждый вызов —
+    ссылка на него; отказаться от ожидания — release_image, а не Future.cancel()."""
+    key = unique_id or file_id
+    with _inflight_lock:
+        entry = _inflight.get(key)
+        if entry is None:
+            fut = _executor().submit(prepare_image, file_id, unique_id)
+            entry = _inflight[key] = [fut, 0]
+            fut.add_done_callback(lambda f, k=key: _forget(k, f))
+        entry[1] += 1
+        return entry[0]
+
+
+def release_image(file_id: str, unique_id: Optional[str] = None) -> None:
+    """Ход больше не ждёт картинку (submit_image). Последний отказавшийся снимает её
+    подготовку, если та ещё не началась; начатая докачивается в кэш."""
+    key = unique_id or file_id
+    with _inflight_lock:
+        entry = _inflight.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _inflight[key]
+    entry[0].cancel()  # вне лока: cancel() сразу зовёт _forget
+
+
+def _forget(key: str, fut: Future) -> None:
+    with _inflight_lock:
+        entry = _inflight.get(key)
+        if entry is not None and entry[0] is fut:
+            del _inflight[key]
+
+
+def prepare_images(refs: Sequence[Tuple[str, Optional[str]]]) -> List[Optional[PreparedImage]]:
+    """Несколько картинок параллельно; порядок результата — порядок refs."""
+    if len(refs) == 1:
+        return [prepare_image(*refs[0])]
+    futures = [submit_image(fid, uid) for fid, uid in refs]
+    out: List[Optional[PreparedImage]] = []
+    for f in futures:
+        try:
+            out.append(f.result())
+        except Exception as e:
+            logger.warning("prepare_image failed: %s", e)
+            out.append(None)
+    return out
+
+
+def cache_stats() -> Tuple[int, int]:
+    """(hits, misses) кэша картинок с начала жизни контейнера."""
+    return _cache.hits, _cache.misses
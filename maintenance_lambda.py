@@ -0,0 +1,265 @@
+
+import time
+_INIT_T0 = time.perf_counter()  # замер холодного старта, см. coldstart.py
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import boto3
+
+from dynamo_utils import (
+    get_dialog_history,
+    get_latest_summary_item, save_summary, summary_cursor, summary_updated_ms,
+    get_user_profile, update_user_profile,
+    compact_history,
+)
+from claude_utils import (
+    summarize_history,
+    stored_tokens,
+    create_long_term_summary,
+    extract_topics,
+)
+from recall_utils import index_messages
+from coldstart import mark_init, log_invocation
+
+mark_init(_INIT_T0)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+MIN_MSGS_FOR_SUMMARY   = int(os.getenv("MIN_MSGS_FOR_SUMMARY", "12"))
+SUMMARY_HISTORY_LIMIT  = int(os.getenv("SUMMARY_HISTORY_LIMIT", "60"))
+# Троттлинг: не перегенерировать краткую сводку чаще, чем раз в N секунд
+SUMMARY_MIN_INTERVAL_SEC = int(os.getenv("SUMMARY_MIN_INTERVAL_SEC", "600"))
+# Сводка скользящая: в неё дописываются реплики после курсора. Обновляем, когда их
+# набралось SUMMARY_MIN_NEW_TOKENS и прошёл интервал, или SUMMARY_FORCE_TOKENS — сразу.
+SUMMARY_MIN_NEW_TOKENS = int(os.getenv("SUMMARY_MIN_NEW_TOKENS", "1500"))
+SUMMARY_FORCE_TOKENS = int(os.getenv("SUMMARY_FORCE_TOKENS", "6000"))
+# Долгосрочный профиль (private) обновляется раз в LONG_TERM_EVERY сообщений
+LONG_TERM_EVERY = int(os.getenv("LONG_TERM_EVERY", "50"))
+
+# Очередь обслуживания памяти. Задачи выполняет maintenance_lambda, а не worker: вызовы модели
+# (сводка, профиль, темы) не держат FIFO-группу и конкурентность worker-а. Без очереди задачи
+# не выполняются (warning) — разве что явно включён MAINTENANCE_INLINE=1: тогда worker
+# выполняет их сам после ответа (для отладки и малых установок; таймаут worker-а должен
+# покрывать ответ плюс сводку, профиль и темы).
+MAINTENANCE_QUEUE_URL = os.getenv("MAINTENANCE_QUEUE_URL")
+MAINTENANCE_QUEUE_IS_FIFO = os.getenv("MAINTENANCE_QUEUE_IS_FIFO", "0") == "1"
+MAINTENANCE_INLINE = os.getenv("MAINTENANCE_INLINE", "0") == "1"
+
+TASK_SUMMARY = "summary"
+TASK_LONG_TERM = "long_term_profile"
+TASK_COMPACT = "compact_history"
+TASK_RECALL = "recall_index"
+
+_sqs = None
+_sqs_lock = threading.Lock()
+
+
+def _sqs_client():
+    """SQS-клиент создаётся при первой постановке задачи: ходы без задач его не ждут.
+    Под локом — задачи ставятся из потоков worker-а, а boto3.client() на общей сессии
+    не потокобезопасен (сам клиент — да)."""
+    global _sqs
+    with _sqs_lock:
+        if _sqs is None:
+            _sqs = boto3.client("sqs")
+    return _sqs
+
+
+# ---------- Проверки «пора ли» (идемпотентны: повтор задачи ничего не ломает) ----------
+
+def unsummarized(history: List[Dict[str, Any]], summary_item: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Реплики истории после курсора сводки — то, что ещё не свёрнуто в неё."""
+    cursor = summary_cursor(summary_item)
+    return [m for m in history if int(m.get("timestamp") or m.get("_ts") or 0) > cursor]
+
+
+def summary_due(summary_item: Optional[Dict[str, Any]], *, until_ts: Optional[int] = None,
+                new_tokens: Optional[int] = None) -> bool:
+    """Пора дописать сводку.
+
+    until_ts (ms) — реплика, отрезанная trim-ом: сводка обязана её покрыть, если курсор раньше.
+    Иначе решают рост и время: после курсора набралось SUMMARY_MIN_NEW_TOKENS и прошёл
+    SUMMARY_MIN_INTERVAL_SEC — или набралось SUMMARY_FORCE_TOKENS. new_tokens=None —
+    рост неизвестен, только время (как раньше).
+    """
+    if until_ts and summary_cursor(summary_item) < int(until_ts):
+        return True
+    if new_tokens is not None:
+        if new_tokens < SUMMARY_MIN_NEW_TOKENS:
+            return False
+        if new_tokens >= SUMMARY_FORCE_TOKENS:
+            return True
+    last_ts = summary_updated_ms(summary_item)
+    return not last_ts or (int(time.time() * 1000) - last_ts > SUMMARY_MIN_INTERVAL_SEC * 1000)
+
+
+def long_term_due(profile: Optional[Dict[str, Any]]) -> bool:
+    """С прошлого обновления долгосрочного профиля набралось LONG_TERM_EVERY сообщений.
+
+    Раньше было `mc % LONG_TERM_EVERY == 0` — пропущенное (или повторённое) сообщение
+    срывало/дублировало обновление. Теперь сравниваем с сохранённым `long_term_at`.
+    """
+    prof = profile or {}
+    mc = int(prof.get("message_count", 0) or 0)
+    done_at = int(prof.get("long_term_at", 0) or 0)
+    return mc >= LONG_TERM_EVERY and mc - done_at >= LONG_TERM_EVERY
+
+
+# ---------- Задачи ----------
+
+def _run_summary(task: Dict[str, Any]) -> str:
+    """Краткая сводка диалога — скользящая: в прежнюю сводку дописываются только реплики
+    после её курсора, а не пересказываются последние SUMMARY_HISTORY_LIMIT заново.
+
+    until_ts задаёт worker, когда trim отрезал реплики, которых сводка не покрывает:
+    тогда сворачиваем окно до самой свежей отрезанной реплики включительно (раньше это делал
+    worker синхронно, ДО ответа). Без until_ts — по росту токенов после курсора и времени.
+    """
+    dkey, until_ts = task["dialog_key"], task.get("until_ts")
+    # Мимо кэша тёплого контейнера: решаем по актуальной записи, а не по копии до TTL
+    item = get_latest_summary_item(dkey, use_cache=False)
+    if until_ts and summary_cursor(item) >= int(until_ts):
+        return "summary not due"
+    hist = get_dialog_history(dkey, limit=120, consistent_read=True)
+    window = unsummarized(hist, item)
+    if until_ts:
+        window = [m for m in window if int(m.get("timestamp") or 0) <= int(until_ts)]
+    elif not summary_due(item, new_tokens=sum(stored_tokens(m) for m in window)):
+        return "summary not due"
+    elif not summary_cursor(item) and len(window) < MIN_MSGS_FOR_SUMMARY:
+        return "summary: too few messages"
+    if not window:
+        return "summary: nothing to summarize"
+    previous = str((item or {}).get("summary") or "")
+    # Первая сводка — по последним репликам; дальше — старейшая несвёрнутая порция,
+    # чтобы курсор не перепрыгнул реплики (остаток свернёт следующая задача).
+    window = window[:SUMMARY_HISTORY_LIMIT] if previous else window[-SUMMARY_HISTORY_LIMIT:]
+    sm = summarize_history(window, previous=previous or None)
+    if not sm or sm.startswith("⚠️"):
+        # Ошибка модели не должна затереть накопленную сводку и сдвинуть курсор
+        return "summary: model failed"
+    if not save_summary(dkey, sm, cursor=int(window[-1]["timestamp"])):
+        return "summary: superseded"
+    return f"summary folded ({len(window)} new)"
+
+
+def _run_long_term(task: Dict[str, Any]) -> str:
+    dkey, user_id = task["dialog_key"], str(task["user_id"])
+    prof = get_user_profile(user_id, use_cache=False) or {}
+    if not long_term_due(prof):
+        return "long-term not due"
+    mc = int(prof.get("message_count", 0) or 0)
+    hist = get_dialog_history(dkey, limit=80, consistent_read=True)
+    user_info = {"first_name": prof.get("first_name", ""), "username": task.get("username")}
+    long_summary = create_long_term_summary(hist[-80:], user_info)
+    recent_topics = extract_topics(hist[-20:])
+    update_user_profile(
+        user_id,
+        long_term_summary=long_summary if long_summary else None,
+        last_topics=recent_topics if recent_topics else None,
+        long_term_at=mc,
+    )
+    return f"long-term updated (mc={mc})"
+
+
+def _run_compact(task: Dict[str, Any]) -> str:
+    """Сворачивает хвост истории в страницы (dynamo_utils, MESSAGES_LAYOUT=pages)."""
+    return f"compacted {compact_history(task['dialog_key'])} message(s)"
+
+
+def _run_recall(task: Dict[str, Any]) -> str:
+    """Дописывает реплики после курсора в индекс памяти (recall_utils, RECALL_ENABLED=1)."""
+    return f"indexed {index_messages(task['dialog_key'])} message(s)"
+
+
+_HANDLERS = {
+    TASK_SUMMARY: _run_summary,
+    TASK_LONG_TERM: _run_long_term,
+    TASK_COMPACT: _run_compact,
+    TASK_RECALL: _run_recall,
+}
+
+
+def run_task(task: Dict[str, Any]) -> str:
+    handler = _HANDLERS.get(task.get("type"))
+    if handler is None:
+        logger.warning("Unknown maintenance task: %r", task)
+        return "unknown task"
+    return handler(task)
+
+
+def enqueue_tasks(tasks: List[Dict[str, Any]]) -> bool:
+    """Отправляет задачи в очередь обслуживания; False — какую-то отправить не удалось.
+
+    Без очереди задачи выполняются сразу только при MAINTENANCE_INLINE=1, иначе пропускаются.
+    Для FIFO-очереди MessageGroupId = dialog_key (задачи диалога не идут параллельно),
+    а дедупликация — по типу задачи, ключу и until_ts либо окну SUMMARY_MIN_INTERVAL_SEC.
+    """
+    ok = True
+    for task in tasks:
+        if not MAINTENANCE_QUEUE_URL:
+            if not MAINTENANCE_INLINE:
+                logger.warning("MAINT %s skipped: MAINTENANCE_QUEUE_URL is not set", task.get("type"))
+                continue
+            try:
+                logger.info("MAINT inline %s -> %s", task.get("type"), run_task(task))
+            except Exception as e:
+                logger.warning("MAINT inline %s failed: %s", task.get("type"), e)
+            continue
+        params = {
+            "QueueUrl": MAINTENANCE_QUEUE_URL,
+            "MessageBody": json.dumps(task, ensure_ascii=False),
+        }
+        if MAINTENANCE_QUEUE_IS_FIFO:
+            bucket = task.get("until_ts") or int(time.time()) // max(SUMMARY_MIN_INTERVAL_SEC, 1)
+            params["MessageGroupId"] = task["dialog_key"]
+            params["MessageDeduplicationId"] = f"{task['type']}:{task['dialog_key']}:{bucket}"
+        try:
+            _sqs_client().send_message(**params)
+            logger.info("MAINT enqueued %s for %s", task["type"], task["dialog_key"])
+        except Exception as e:
+            logger.warning("MAINT enqueue %s failed: %s", task.get("type"), e)
+            ok = False
+    return ok
+
+
+def lambda_handler(event, context):
+    log_invocation("maintenance")
+    records = (event or {}).get("Records", []) if isinstance(event, dict) else []
+    if not records:
+        logger.info("No SQS records")
+        return {"statusCode": 200, "body": "no records"}
+
+    # Дедупликация в пределах батча: одна задача каждого типа на диалог. Дубли сливаются:
+    # until_ts — наибольший (сводка должна покрыть всё отрезанное), а при ошибке повторяются
+    # все записи слитой задачи.
+    merged: Dict[tuple, Dict[str, Any]] = {}
+    ids: Dict[tuple, List[str]] = {}
+    for r in records:
+        try:
+            task = json.loads(r.get("body") or "{}")
+        except ValueError as e:
+            logger.warning("Bad maintenance payload, dropped: %s", e)
+            continue
+        key = (task.get("type"), task.get("dialog_key"), str(task.get("user_id") or ""))
+        ids.setdefault(key, []).append(r.get("messageId"))
+        first = merged.setdefault(key, task)
+        if first is not task:
+            logger.info("MAINT duplicate %s merged", key)
+            if task.get("until_ts") and int(task["until_ts"]) > int(first.get("until_ts") or 0):
+                first["until_ts"] = int(task["until_ts"])
+
+    failed = []
+    for key, task in merged.items():
+        try:
+            logger.info("MAINT %s %s -> %s", task.get("type"), task.get("dialog_key"), run_task(task))
+        except Exception as e:
+            logger.exception("MAINT task failed: %r", e)
+            failed.extend(ids[key])
+
+    return {"batchItemFailures": [{"itemIdentifier": mid} for mid in failed if mid]}
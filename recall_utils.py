@@ -0,0 +1,239 @@
+# recall_utils.py  —  лексическая память диалога: BM25 по всей истории (RECALL_ENABLED)
+"""Давние реплики диалога, относящиеся к текущему сообщению, — в промпт без роста окна.
+
+В контекст идут последние HISTORY_LIMIT реплик, обрезанные до MAX_CONTEXT_TOKENS, а всё
+старше доживает только в сводке. Теперь по всей истории ведётся обратный индекс (таблица
+RecallIndex, см. dynamo_utils): элемент на термин диалога с постингами (timestamp, tf,
+длина реплики) и элемент статистики с курсором проиндексированного.
+  - Термины — словоформы русского/английского без стоп-слов, усечённые до основы
+    простым отсечением окончаний (без словарей и зависимостей).
+  - Индексирует задача обслуживания recall_index пачками по мере записи реплик
+    (save_message): реплики после курсора сливаются в постинги — один BatchGet и один
+    BatchWrite на пачку вместо обновления каждого термина на каждую реплику. Повтор
+    идемпотентен: постинги — словарь по timestamp. Хвост за курсором и так в окне истории.
+  - Запрос: термины текущего сообщения → BatchGet их элементов (eventual) → BM25 →
+    лучшие RECALL_TOP_K реплик одним BatchGet из Messages. Worker берёт из них только
+    реплики старше окна, попавшего в промпт, в пределах RECALL_TOKEN_BUDGET.
+Частые термины держат только последние RECALL_MAX_POSTINGS постингов (df считается
+полностью): их вес в BM25 мал, а элемент остаётся в пределах одного-двух КБ.
+
+Те же термины ранжируют факты о собеседнике (rank_facts) — в промпт идут FACTS_TOP_K.
+"""
+
+import logging
+import math
+import os
+import re
+import struct
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from dynamo_utils import (
+    RECALL_STATS_KEY,
+    get_recall_terms, put_recall_terms, save_recall_stats,
+    messages_after, get_messages_at,
+)
+from claude_utils import content_tokens
+
+logger = logging.getLogger(__name__)
+
+RECALL_TOP_K        = int(os.getenv("RECALL_TOP_K", "3"))
+RECALL_TOKEN_BUDGET = int(os.getenv("RECALL_TOKEN_BUDGET", "400"))
+# Задача индексации ставится, когда за курсором набралось столько реплик
+RECALL_INDEX_EVERY  = int(os.getenv("RECALL_INDEX_EVERY", "20"))
+RECALL_MAX_POSTINGS = int(os.getenv("RECALL_MAX_POSTINGS", "500"))
+# Ниже этого BM25-веса совпадение — шум (одно частое слово)
+RECALL_MIN_SCORE    = float(os.getenv("RECALL_MIN_SCORE", "2.0"))
+RECALL_INDEX_BATCH  = 200   # реплик за одну задачу; остаток доберёт следующая
+# Фактов о собеседнике в промпт — не больше стольких, самых подходящих к сообщению
+FACTS_TOP_K         = int(os.getenv("FACTS_TOP_K", "8"))
+_MAX_QUERY_TERMS    = 16
+_MAX_TERM_LEN       = 40
+_SNIPPET_CHARS      = 300
+_K1, _B = 1.2, 0.75
+
+# ---------- Термины ----------
+
+_WORD = re.compile(r"[0-9a-zа-я]+")
+
+_STOP = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне
+было вот от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас
+нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя
+их чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого
+какой совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда
+можно при наконец два об другой хоть после над больше тот через эти нас про всего них какая
+много разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им
+более всегда конечно всю между это просто очень спасибо привет пожалуйста ок
+the a an and or of to in on at for is are was were be been it its this that with as by from
+not no do does did have has had i you he she we they me my your our their what which who how
+so if but can will just about there here ok thanks hi
+""".split())
+
+# Окончания — от длинных к коротким; основа не короче трёх букв
+_RU_ENDINGS = sorted(set("""
+иями ями ами иях ях ах ией ей ой ий ый ая яя ое ее ые ие ую юю ого его ому ему ыми ими ых их
+ом ем ам ям ов ев ию ия ья ье ью ешь ете ишь ите ет ит ут ют ат ят ла ло ли ть ти а я о е ы и у ю ь й
+""".split()), key=len, reverse=True)
+_EN_ENDINGS = ("ing", "ed", "es", "ly", "s")
+
+
+def _stem(w: str) -> str:
+    if w.isdigit():
+        return w
+    if w.isascii():
+        for e in _EN_ENDINGS:
+            if w.endswith(e) and len(w) - len(e) >= 3:
+                return w[:-len(e)]
+        return w
+    if len(w) > 5 and w.endswith(("ся", "сь")):
+        w = w[:-2]
+    for e in _RU_ENDINGS:
+        if w.endswith(e) and len(w) - len(e) >= 3:
+            return w[:-len(e)]
+    return w
+
+
+def tokenize(text: Any) -> List[str]:
+    """Основы значимых слов текста, в порядке появления (с повторами)."""
+    words = _WORD.findall(str(text or "").lower().replace("ё", "е"))
+    return [_stem(w)[:_MAX_TERM_LEN] for w in words if len(w) > 1 and w not in _STOP]
+
+
+# ---------- Постинги ----------
+
+_POSTING = struct.Struct("<QBH")  # timestamp ms, tf (до 255), длина реплики в терминах
+
+
+def pack_postings(postings: Dict[int, Tuple[int, int]]) -> bytes:
+    return b"".join(_POSTING.pack(ts, min(tf, 255), min(dl, 65535))
+                    for ts, (tf, dl) in sorted(postings.items()))
+
+
+def unpack_postings(blob: Any) -> Dict[int, Tuple[int, int]]:
+    if blob is None:
+        return {}
+    raw = blob.value if hasattr(blob, "value") else bytes(blob)
+    return {ts: (tf, dl) for ts, tf, dl in _POSTING.iter_unpack(raw)}
+
+
+# ---------- Индексация (задача recall_index) ----------
+
+def index_messages(dialog_key: str) -> int:
+    """Сливает реплики после курсора в индекс; → сколько проиндексировано."""
+    stats = get_recall_terms(dialog_key, [], consistent_read=True).get(RECALL_STATS_KEY) or {}
+    cursor = int(stats.get("cursor") or 0)
+    msgs = messages_after(dialog_key, cursor, RECALL_INDEX_BATCH)
+    if not msgs:
+        return 0
+    new: Dict[str, Dict[int, Tuple[int, int]]] = defaultdict(dict)
+    total_len = 0
+    for m in msgs:
+        words = tokenize(m.get("content"))
+        total_len += len(words)
+        for term, tf in Counter(words).items():
+            new[term][int(m["timestamp"])] = (tf, len(words))
+    existing = get_recall_terms(dialog_key, list(new), consistent_read=True)
+    items = []
+    for term, add in new.items():
+        old = existing.get(term) or {}
+        postings = unpack_postings(old.get("p"))
+        df = int(old.get("df") or len(postings)) + sum(1 for ts in add if ts not in postings)
+        postings.update(add)
+        if len(postings) > RECALL_MAX_POSTINGS:
+            postings = dict(sorted(postings.items())[-RECALL_MAX_POSTINGS:])
+        items.append({"dialog_key": dialog_key, "term": term, "p": pack_postings(postings), "df": df})
+    put_recall_terms(items)
+    last_ts = int(msgs[-1]["timestamp"])
+    if not save_recall_stats(dialog_key, docs=int(stats.get("n") or 0) + len(msgs),
+                             total_len=int(stats.get("len") or 0) + total_len,
+                             cursor=last_ts, prev_cursor=cursor):
+        logger.info("recall index %s: cursor moved by a concurrent task", dialog_key)
+    return len(msgs)
+
+
+# ---------- Поиск ----------
+
+class RecallResult(NamedTuple):
+    hits: List[Dict[str, Any]]  # реплики Messages (+ "_score"), лучшие первыми
+    indexed_until: int          # курсор индекса: реплики новее ещё не проиндексированы
+
+
+def recall(dialog_key: str, query: str, *, k: int = RECALL_TOP_K) -> RecallResult:
+    """Реплики диалога, лучше всего совпадающие с query по BM25. Без терминов в запросе
+    читается только статистика — курсор нужен worker-у, чтобы решить, пора ли индексировать."""
+    t0 = time.perf_counter()
+    qterms = list(dict.fromkeys(tokenize(query)))[:_MAX_QUERY_TERMS]
+    items = get_recall_terms(dialog_key, qterms)
+    stats = items.pop(RECALL_STATS_KEY, None) or {}
+    docs = int(stats.get("n") or 0)
+    cursor = int(stats.get("cursor") or 0)
+    if not docs or not items:
+        return RecallResult([], cursor)
+    avgdl = max(1.0, int(stats.get("len") or 0) / docs)
+    scores: Dict[int, float] = defaultdict(float)
+    for term in qterms:
+        it = items.get(term)
+        if not it:
+            continue
+        postings = unpack_postings(it.get("p"))
+        df = max(int(it.get("df") or 0), len(postings))
+        idf = math.log(1 + (docs - df + 0.5) / (df + 0.5))
+        for ts, (tf, dl) in postings.items():
+            scores[ts] += idf * tf * (_K1 + 1) / (tf + _K1 * (1 - _B + _B * dl / avgdl))
+    top = sorted((ts for ts, sc in scores.items() if sc >= RECALL_MIN_SCORE),
+                 key=lambda ts: scores[ts], reverse=True)[:k]
+    found = get_messages_at(dialog_key, top) if top else {}
+    hits = [dict(found[ts], _score=scores[ts]) for ts in top if ts in found]
+    logger.info("RECALL terms=%d matched=%d hits=%d %dms", len(qterms), len(scores), len(hits),
+                (time.perf_counter() - t0) * 1000)
+    return RecallResult(hits, cursor)
+
+
+def render_recall(hits: List[Dict[str, Any]], *, before_ts: int,
+                  budget: int = RECALL_TOKEN_BUDGET) -> str:
+    """Блок промпта хода из найденных реплик старше before_ts (то, чего нет в окне), по
+    убыванию веса, пока укладываемся в budget токенов; в блоке — по времени."""
+    picked, used = [], 0
+    for m in hits:
+        ts = int(m.get("timestamp") or 0)
+        if not ts or ts >= before_ts:
+            continue
+        text = " ".join(str(m.get("content") or "").split())
+        if len(text) > _SNIPPET_CHARS:
+            text = text[:_SNIPPET_CHARS].rstrip() + "…"
+        who = "Ассистент" if m.get("role") == "assistant" else (
+            "@" + m["from_username"] if m.get("from_username") else "Собеседник")
+        day = time.strftime("%d.%m.%Y", time.gmtime(ts / 1000))
+        line = f"- [{day}] {who}: {text}"
+        cost = content_tokens(line)
+        if used + cost > budget:
+            continue
+        picked.append((ts, line))
+        used += cost
+    if not picked:
+        return ""
+    return ("Из давних реплик этого диалога (могут быть неактуальны; опирайся на них, только "
+            "если они относятся к делу):\n" + "\n".join(line for _, line in sorted(picked)))
+
+
+# ---------- Факты о собеседнике ----------
+
+def rank_facts(facts: List[Dict[str, Any]], query: str, *, k: int = FACTS_TOP_K) -> List[Dict[str, Any]]:
+    """k фактов (элементы dynamo_utils.get_user_fact_items) для промпта: сначала совпавшие
+    с сообщением по терминам, затем недавно использованные/записанные. Порядок результата —
+    по времени записи, у совпавших выставлен "_rel" > 0."""
+    if not facts or k <= 0:
+        return []
+    qterms = set(tokenize(query))
+    by_recency = sorted(facts, key=lambda f: (int(f.get("used_ms") or f.get("created_ms") or 0),
+                                              int(f.get("uses") or 0)))
+    scored = []
+    for pos, f in enumerate(by_recency):
+        fterms = set(tokenize(f.get("fact")))
+        rel = len(qterms & fterms) / math.sqrt(len(fterms)) if fterms and qterms else 0.0
+        scored.append((rel, pos, dict(f, _rel=rel)))
+    top = sorted(scored, key=lambda x: (x[0], x[1]), reverse=True)[:k]
+    return sorted((f for _, _, f in top), key=lambda f: int(f.get("created_ms") or 0))
+
@@ -2,10 +2,13 @@
 
 import os
 import json
-import base64
+import time
 import logging
-import requests
-from typing import Optional, Tuple
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import http_utils
+from http_utils import HTTP_CONNECT_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
@@ -18,12 +21,175 @@ SEND_URL   = API_BASE + "/sendMessage"
 ACTION_URL = API_BASE + "/sendChatAction"
 GETFILE_URL = API_BASE + "/getFile"
 REACTION_URL = API_BASE + "/setMessageReaction"
+EDIT_URL   = API_BASE + "/editMessageText"
+DELETE_URL = API_BASE + "/deleteMessage"
 
 REQUEST_TIMEOUT = 30
+# (connect, read) по методам Bot API: служебные вызовы не должны висеть по 30 с
+_TIMEOUTS = {
+    "sendMessage":        (HTTP_CONNECT_TIMEOUT, 15),
+    "editMessageText":    (HTTP_CONNECT_TIMEOUT, 10),
+    "deleteMessage":      (HTTP_CONNECT_TIMEOUT, 5),
+    "sendChatAction":     (HTTP_CONNECT_TIMEOUT, 5),
+    "setMessageReaction": (HTTP_CONNECT_TIMEOUT, 5),
+    "getFile":            (HTTP_CONNECT_TIMEOUT, 10),
+    "file":               (HTTP_CONNECT_TIMEOUT, REQUEST_TIMEOUT),
+}
 DEFAULT_PARSE_MODE = os.getenv("TELEGRAM_PARSE_MODE") or None  # None -> plain text
 
-# Claude принимает image-блоки только этих типов
-_ALLOWED_IMAGE_MIME = {"image/jpeg", "image/png", "image/gif", "image/webp"}
+# Стриминг ответа: не чаще одного editMessageText в STREAM_EDIT_INTERVAL_SEC на сообщение
+# (лимиты Telegram на правки), первый кусок постим, как только набралось STREAM_FIRST_CHARS.
+STREAM_EDIT_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_INTERVAL_SEC", "1.0"))
+STREAM_FIRST_CHARS = int(os.getenv("STREAM_FIRST_CHARS", "40"))
+TELEGRAM_TEXT_LIMIT = 4000  # реальный лимит 4096, держим запас
+
+# Индикатор «печатает…» Telegram гасит через ~5 с, а генерация с web_search и несколькими
+# итерациями tool use идёт дольше. ChatActionHeartbeat повторяет действие раз в
+# CHAT_ACTION_INTERVAL_SEC, пока в чат не ушло первое сообщение (send_message гасит
+# heartbeat-ы чата сам), но не дольше CHAT_ACTION_MAX_SEC. send_chat_action не шлёт одно
+# и то же действие в чат чаще раза в CHAT_ACTION_MIN_GAP_SEC.
+CHAT_ACTION_INTERVAL_SEC = float(os.getenv("CHAT_ACTION_INTERVAL_SEC", "4"))
+CHAT_ACTION_MIN_GAP_SEC = float(os.getenv("CHAT_ACTION_MIN_GAP_SEC", "3"))
+CHAT_ACTION_MAX_SEC = float(os.getenv("CHAT_ACTION_MAX_SEC", "120"))
+
+# Лимиты Bot API на отправку: ~1 сообщение/с в чат (короткие всплески допустимы), 20/мин в
+# группу, ~30/с на бота. Превышение — 429 с parameters.retry_after, и раньше такая часть
+# ответа просто терялась. Сообщения и правки берут токен из трёх корзин (чат, группа,
+# глобальная) и при нехватке ждут, но не дольше TG_SEND_DEADLINE_SEC; 429 ставит чат на паузу
+# retry_after для всех потоков контейнера. Служебные вызовы (действия, реакции, удаление)
+# корзины не тратят, а во время паузы чата пропускаются.
+TG_CHAT_PER_SEC      = float(os.getenv("TG_CHAT_PER_SEC", "1"))
+TG_CHAT_BURST        = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_GROUP_PER_MIN     = float(os.getenv("TG_GROUP_PER_MIN", "20"))
+TG_GROUP_BURST       = float(os.getenv("TG_GROUP_BURST", "5"))
+TG_GLOBAL_PER_SEC    = float(os.getenv("TG_GLOBAL_PER_SEC", "30"))
+TG_SEND_DEADLINE_SEC = float(os.getenv("TG_SEND_DEADLINE_SEC", "20"))
+
+_LIMITED_METHODS = frozenset({"sendMessage", "editMessageText"})
+
+
+class TelegramRetryLater(Exception):
+    """Сообщение не ушло из-за лимитов Telegram за отведённое время — отправить позже."""
+
+    def __init__(self, chat_id: int, retry_after: float):
+        super().__init__(f"rate limited in chat {chat_id}"
+                         + (f", retry after {retry_after:.1f}s" if retry_after > 0 else ""))
+        self.chat_id = chat_id
+        self.retry_after = retry_after
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "ts")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.ts = now
+
+    def wait(self, now: float) -> float:
+        """Через сколько секунд будет токен (0 — уже есть). Отрицательный запас — это
+        токены, уже обещанные ждущим отправкам."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.ts) * self.rate >= self.capacity
+
+
+class _RateLimiter:
+    """Корзины по чатам в памяти тёплого контейнера (общие для потоков и вызовов)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._global = _TokenBucket(TG_GLOBAL_PER_SEC, TG_GLOBAL_PER_SEC, time.monotonic())
+        self._chats: Dict[int, _TokenBucket] = {}
+        self._groups: Dict[int, _TokenBucket] = {}
+        self._paused: Dict[int, float] = {}  # chat_id -> monotonic «до», по retry_after
+
+    def _buckets(self, chat_id: int, now: float) -> List[_TokenBucket]:
+        out = [self._global]
+        b = self._chats.get(chat_id)
+        if b is None:
+            b = self._chats[chat_id] = _TokenBucket(TG_CHAT_PER_SEC, TG_CHAT_BURST, now)
+        out.append(b)
+        if chat_id < 0:  # группы, супергруппы и каналы
+            g = self._groups.get(chat_id)
+            if g is None:
+                g = self._groups[chat_id] = _TokenBucket(TG_GROUP_PER_MIN / 60.0, TG_GROUP_BURST, now)
+            out.append(g)
+        return out
+
+    def acquire(self, chat_id: int, *, max_wait: float, limited: bool = True) -> Optional[float]:
+        """Резервирует отправку: сколько подождать перед ней, или None — не уложиться в max_wait."""
+        now = time.monotonic()
+        with self._lock:
+            pause = max(0.0, self._paused.get(chat_id, 0.0) - now)
+            if not limited:
+                return pause if pause <= max_wait else None
+            buckets = self._buckets(chat_id, now)
+            delay = max([pause] + [b.wait(now) for b in buckets])
+            if delay > max_wait:
+                return None
+            for b in buckets:
+                b.tokens -= 1
+            if len(self._chats) > 4096:  # не копим корзины всех чатов, что когда-то писали
+                for d in (self._chats, self._groups):
+                    for k in [k for k, b in d.items() if b.full(now)]:
+                        del d[k]
+            return delay
+
+    def pause(self, chat_id: int, retry_after: float) -> None:
+        with self._lock:
+            until = time.monotonic() + retry_after
+            self._paused[chat_id] = max(self._paused.get(chat_id, 0.0), until)
+            now = time.monotonic()
+            for k in [k for k, t in self._paused.items() if t <= now]:
+                del self._paused[k]
+
+    def retry_in(self, chat_id: int) -> float:
+        with self._lock:
+            return max(0.0, self._paused.get(chat_id, 0.0) - time.monotonic())
+
+
+_limiter = _RateLimiter()
+
+
+def _retry_after(r) -> Optional[float]:
+    if getattr(r, "status_code", None) != 429:
+        return None
+    try:
+        return float(((r.json() or {}).get("parameters") or {}).get("retry_after") or 1)
+    except Exception:
+        return 1.0
+
+
+def _tg_post(method: str, payload: Dict, *, wait: bool = True, idempotent: bool = False):
+    """POST в Bot API через лимитер. wait=False — не ждать корзину/паузу (лучше пропустить).
+
+    Возвращает ответ или бросает TelegramRetryLater, если в срок отправить не вышло
+    (корзина пуста или 429 с retry_after за дедлайном).
+    """
+    chat_id = int(payload.get("chat_id") or 0)
+    limited = method in _LIMITED_METHODS
+    deadline = time.monotonic() + (TG_SEND_DEADLINE_SEC if wait else 0.0)
+    while True:
+        delay = _limiter.acquire(chat_id, max_wait=max(0.0, deadline - time.monotonic()),
+                                 limited=limited)
+        if delay is None:
+            raise TelegramRetryLater(chat_id, max(_limiter.retry_in(chat_id), 1.0))
+        if delay > 0:
+            time.sleep(delay)
+        r = http_utils.post(f"{API_BASE}/{method}", json=payload, timeout=_TIMEOUTS[method],
+                            idempotent=idempotent)
+        retry_after = _retry_after(r)
+        if retry_after is None:
+            return r
+        _limiter.pause(chat_id, retry_after)
+        logger.warning("Telegram 429 on %s (chat=%s), retry_after=%ss", method, chat_id, retry_after)
+        if time.monotonic() + retry_after > deadline:
+            raise TelegramRetryLater(chat_id, retry_after)
 
 
 def get_file_bytes(file_id: str, *, max_bytes: int = 20_000_000) -> Tuple[Optional[bytes], Optional[str]]:
@@ -35,7 +201,7 @@ def get_file_bytes(file_id: str, *, max_bytes: int = 20_000_000) -> Tuple[Option
     if not file_id:
         return None, None
     try:
-        r = requests.get(GETFILE_URL, params={"file_id": file_id}, timeout=REQUEST_TIMEOUT)
+        r = http_utils.get(GETFILE_URL, params={"file_id": file_id}, timeout=_TIMEOUTS["getFile"])
         r.raise_for_status()
         info = r.json()
         if not info.get("ok"):
@@ -50,7 +216,7 @@ def get_file_bytes(file_id: str, *, max_bytes: int = 20_000_000) -> Tuple[Option
             logger.warning("Telegram file too large: %s bytes", file_size)
             return None, None
 
-        fr = requests.get(f"{FILE_BASE}/{file_path}", timeout=REQUEST_TIMEOUT)
+        fr = http_utils.get(f"{FILE_BASE}/{file_path}", timeout=_TIMEOUTS["file"])
         fr.raise_for_status()
         data = fr.content
         if len(data) > max_bytes:
@@ -62,47 +228,17 @@ def get_file_bytes(file_id: str, *, max_bytes: int = 20_000_000) -> Tuple[Option
         return None, None
 
 
-def get_file_base64(file_id: str, *, max_bytes: int = 3_500_000) -> Tuple[Optional[str], Optional[str]]:
-    """Скачивает файл Telegram по file_id и возвращает (base64, mime) или (None, None).
-
-    Ограничение по размеру (max_bytes) — чтобы не упереться в лимиты Claude/Lambda.
-    """
-    if not file_id:
-        return None, None
-    try:
-        r = requests.get(GETFILE_URL, params={"file_id": file_id}, timeout=REQUEST_TIMEOUT)
-        r.raise_for_status()
-        info = r.json()
-        if not info.get("ok"):
-            logger.warning("getFile not ok: %s", info)
-            return None, None
-        result = info.get("result", {})
-        file_path = result.get("file_path")
-        file_size = result.get("file_size") or 0
-        if not file_path:
-            return None, None
-        if file_size and file_size > max_bytes:
-            logger.warning("Telegram file too large: %s bytes", file_size)
-            return None, None
-
-        fr = requests.get(f"{FILE_BASE}/{file_path}", timeout=REQUEST_TIMEOUT)
-        fr.raise_for_status()
-        data = fr.content
-        if len(data) > max_bytes:
-            logger.warning("Downloaded file too large: %s bytes", len(data))
-            return None, None
-
-        ext = (file_path.rsplit(".", 1)[-1] if "." in file_path else "").lower()
-        mime = {
-            "jpg": "image/jpeg", "jpeg": "image/jpeg",
-            "png": "image/png", "gif": "image/gif", "webp": "image/webp",
-        }.get(ext, "image/jpeg")
-        if mime not in _ALLOWED_IMAGE_MIME:
-            mime = "image/jpeg"
-        return base64.b64encode(data).decode("ascii"), mime
-    except Exception as e:
-        logger.warning("get_file_base64(%s) failed: %s", file_id, e)
-        return None, None
+def split_telegram(text: str, limit: int = TELEGRAM_TEXT_LIMIT):
+    if not text:
+        return
+    buf, total = [], 0
+    for line in text.splitlines(True):
+        if total + len(line) > limit and buf:
+            yield "".join(buf)
+            buf, total = [], 0
+        buf.append(line); total += len(line)
+    if buf:
+        yield "".join(buf)
 
 def send_message(
     chat_id: int,
@@ -113,16 +249,21 @@ def send_message(
     reply_to: Optional[int] = None,
     parse_mode: Optional[str] = DEFAULT_PARSE_MODE,
     disable_web_page_preview: bool = False,
-    disable_notification: bool = False
-) -> None:
-    """Отправляет сообщение в Telegram.
+    disable_notification: bool = False,
+    requeue: bool = False
+) -> Optional[int]:
+    """Отправляет сообщение в Telegram. Возвращает message_id отправленного или None.
     В обсуждениях/форумах поддерживаются ОДНОВРЕМЕННО message_thread_id и reply_to_message_id.
     Для каналов без thread_id/reply_to — по умолчанию не постим (можно включить при необходимости).
+    requeue — не уложились в лимиты Telegram за TG_SEND_DEADLINE_SEC: бросить
+    TelegramRetryLater (вызывающий отправит позже) вместо None.
     """
     # ► Фильтр: не постим новый пост в канал
     if chat_type == "channel" and thread_id is None and reply_to is None:
         logger.info("Skip sending: channel post (chat_id=%s)", chat_id)
-        return
+        return None
+    # Сообщение само снимает «печатает…» — повторять его дальше незачем
+    stop_chat_actions(chat_id, thread_id)
 
     payload = {
         "chat_id": chat_id,
@@ -137,16 +278,189 @@ def send_message(
     if reply_to is not None:
         payload["reply_to_message_id"] = reply_to
 
+    r = None
     try:
-        r = requests.post(SEND_URL, json=payload, timeout=REQUEST_TIMEOUT)
+        r = _tg_post("sendMessage", payload)
         r.raise_for_status()
+        return ((r.json() or {}).get("result") or {}).get("message_id")
+    except TelegramRetryLater as e:
+        if requeue:
+            raise
+        logger.warning("send_message dropped (chat_id=%s): %s", chat_id, e)
+        return None
     except Exception as e:
         logger.warning(
             f"send_message failed for chat_id={chat_id}, "
             f"thread_id={thread_id}, reply_to={reply_to}: {e} — {getattr(r, 'text', '')}"
         )
+        return None
+
+def edit_message_text(
+    chat_id: int,
+    message_id: int,
+    text: str,
+    *,
+    parse_mode: Optional[str] = DEFAULT_PARSE_MODE,
+    disable_web_page_preview: bool = False,
+    wait: bool = True,
+    requeue: bool = False,
+) -> bool:
+    """Заменяет текст ранее отправленного сообщения. True при успехе (и если текст уже такой).
+    wait=False — промежуточная правка: при исчерпанном лимите чата не ждать, а пропустить.
+    requeue — как у send_message: лимиты Telegram → TelegramRetryLater вместо False."""
+    payload = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "disable_web_page_preview": disable_web_page_preview,
+    }
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    r = None
+    try:
+        r = _tg_post("editMessageText", payload, wait=wait, idempotent=True)
+        if r.status_code == 400 and "message is not modified" in (r.text or ""):
+            return True
+        r.raise_for_status()
+        return True
+    except TelegramRetryLater:
+        if requeue:
+            raise
+        return False
+    except Exception as e:
+        logger.warning(
+            f"edit_message_text failed for chat_id={chat_id}, "
+            f"message_id={message_id}: {e} — {getattr(r, 'text', '')}"
+        )
+        return False
+
+def delete_message(chat_id: int, message_id: int) -> bool:
+    try:
+        r = _tg_post("deleteMessage", {"chat_id": chat_id, "message_id": message_id},
+                     idempotent=True)
+        return r.status_code == 200
+    except Exception as e:
+        logger.warning("delete_message failed (chat=%s msg=%s): %s", chat_id, message_id, e)
+        return False
+
+
+class StreamingReply:
+    """Прогрессивная отправка ответа: первый кусок постится рано, дальше — правками.
+
+    update(text) вызывается с НАКОПЛЕННЫМ текстом на каждом фрагменте стрима (дёшево:
+    правки троттлятся). Текст режется тем же split_telegram, что и обычная отправка, —
+    перевалив за лимит, часть «замерзает», а хвост уходит новым сообщением.
+    finish(text) приводит отправленное к финальному тексту (с DEFAULT_PARSE_MODE;
+    промежуточные правки идут plain text — незакрытая разметка Telegram не принимает).
+    """
+
+    def __init__(self, chat_id: int, *, chat_type: str,
+                 thread_id: Optional[int] = None, reply_to: Optional[int] = None):
+        self.chat_id = chat_id
+        self.chat_type = chat_type
+        self.thread_id = thread_id
+        self.reply_to = reply_to
+        self.sent: List[Tuple[int, str]] = []  # (message_id, текст в Telegram)
+        self._last_push = 0.0
+        self._failed = False
+        self.rate_limited = False  # часть не ушла из-за лимитов Telegram — можно дослать позже
+        self.retry_after = 0.0     # …через столько секунд (retry_after от Telegram)
+
+    @property
+    def started(self) -> bool:
+        return bool(self.sent)
+
+    def update(self, text: str) -> None:
+        if self._failed or not (text or "").strip():
+            return
+        if not self.sent and len(text.strip()) < STREAM_FIRST_CHARS:
+            return
+        now = time.monotonic()
+        if self.sent and now - self._last_push < STREAM_EDIT_INTERVAL_SEC:
+            return
+        self._last_push = now
+        self._sync([p for p in split_telegram(text) if p.strip()], parse_mode=None)
+
+    def finish(self, text: str) -> bool:
+        """Доводит отправленное до финального текста. False — часть не удалось запостить
+        (или довести правкой): она и остаток — parts[len(self.sent):]."""
+        parts = [p for p in split_telegram(text) if p.strip()]
+        self._failed = False
+        self.rate_limited = False
+        self._sync(parts, parse_mode=DEFAULT_PARSE_MODE, final=True)
+        if self._failed:
+            return False
+        # Финальный текст короче промежуточного (напр., текст до tool_use) — лишнее удаляем
+        for mid, _ in self.sent[len(parts):]:
+            delete_message(self.chat_id, mid)
+        del self.sent[len(parts):]
+        return True
+
+    def _sync(self, parts: List[str], *, parse_mode: Optional[str], final: bool = False) -> None:
+        for i, part in enumerate(parts):
+            if i < len(self.sent):
+                mid, shown = self.sent[i]
+                if shown == part and not (final and parse_mode):
+                    continue
+                if not final:
+                    # Промежуточные правки при исчерпанном лимите чата пропускаем
+                    if edit_message_text(self.chat_id, mid, part, parse_mode=parse_mode, wait=False):
+                        self.sent[i] = (mid, part)
+                    continue
+                if not self._final_edit(mid, part, parse_mode):
+                    # В чате остался устаревший кусок: убираем его (и следующие), а эту часть
+                    # с остатком досылает вызывающий — как не запостившуюся
+                    for stale, _ in self.sent[i:]:
+                        delete_message(self.chat_id, stale)
+                    del self.sent[i:]
+                    self._failed = True
+                    return
+                self.sent[i] = (mid, part)
+            else:
+                try:
+                    mid = send_message(self.chat_id, part, chat_type=self.chat_type,
+                                       thread_id=self.thread_id, reply_to=self.reply_to,
+                                       parse_mode=parse_mode, requeue=True)
+                except TelegramRetryLater as e:
+                    logger.warning("StreamingReply: %s", e)
+                    mid, self.rate_limited, self.retry_after = None, True, e.retry_after
+                if mid is None:
+                    # Не удалось запостить — дальше не стримим; остаток после finish()
+                    # досылает вызывающий (обычной отправкой или повтором после 429)
+                    self._failed = True
+                    return
+                self.sent.append((mid, part))
+
+    def _final_edit(self, mid: int, part: str, parse_mode: Optional[str]) -> bool:
+        """Финальная правка; если разметку (или сам запрос) Telegram не принял — ещё раз plain text."""
+        try:
+            if edit_message_text(self.chat_id, mid, part, parse_mode=parse_mode, requeue=True):
+                return True
+            return bool(parse_mode) and edit_message_text(self.chat_id, mid, part, parse_mode=None,
+                                                          requeue=True)
+        except TelegramRetryLater as e:
+            logger.warning("StreamingReply: %s", e)
+            self.rate_limited, self.retry_after = True, e.retry_after
+            return False
+
+_action_lock = threading.Lock()
+_last_action: Dict[Tuple[int, Optional[int], str], float] = {}
+# По (chat_id, thread_id): темы форума одного чата обрабатываются параллельно, и отправка в
+# одну тему не должна гасить «печатает…» в другой
+_heartbeats: Dict[Tuple[int, Optional[int]], List["ChatActionHeartbeat"]] = {}
+
 
 def send_chat_action(chat_id: int, *, action: str = "typing", thread_id: Optional[int] = None) -> None:
+    key = (chat_id, thread_id, action)
+    now = time.monotonic()
+    with _action_lock:
+        if now - _last_action.get(key, float("-inf")) < CHAT_ACTION_MIN_GAP_SEC:
+            return
+        if len(_last_action) > 1024:  # тёплый контейнер: не копим ключи всех чатов
+            for k in [k for k, t in _last_action.items() if now - t >= CHAT_ACTION_MIN_GAP_SEC]:
+                del _last_action[k]
+        _last_action[key] = now
+
     payload = {
         "chat_id": chat_id,
         "action":  action
@@ -154,15 +468,71 @@ def send_chat_action(chat_id: int, *, action: str = "typing", thread_id: Optiona
     if thread_id is not None:
         payload["message_thread_id"] = thread_id
 
+    r = None
     try:
-        r = requests.post(ACTION_URL, json=payload, timeout=REQUEST_TIMEOUT)
+        r = _tg_post("sendChatAction", payload, wait=False, idempotent=True)
         r.raise_for_status()
+    except TelegramRetryLater:
+        return  # чат на паузе по 429 — индикатор подождёт
     except Exception as e:
         logger.warning(
             f"send_chat_action failed for chat_id={chat_id}, "
             f"thread_id={thread_id}, action={action}: {e} — {getattr(r, 'text', '')}"
         )
 
+
+class ChatActionHeartbeat:
+    """Фоновый повтор send_chat_action (см. CHAT_ACTION_INTERVAL_SEC).
+
+    hb = ChatActionHeartbeat(chat_id, thread_id=...).start() … hb.stop(); либо `with`.
+    Останавливается сам при отправке сообщения в этот чат (ту же тему) и по CHAT_ACTION_MAX_SEC.
+    """
+
+    def __init__(self, chat_id: int, *, thread_id: Optional[int] = None, action: str = "typing"):
+        self.chat_id = chat_id
+        self.thread_id = thread_id
+        self.action = action
+        self._stop = threading.Event()
+
+    def start(self) -> "ChatActionHeartbeat":
+        with _action_lock:
+            _heartbeats.setdefault((self.chat_id, self.thread_id), []).append(self)
+        threading.Thread(target=self._run, name=f"chat-action-{self.chat_id}", daemon=True).start()
+        return self
+
+    def _run(self) -> None:
+        deadline = time.monotonic() + CHAT_ACTION_MAX_SEC
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            send_chat_action(self.chat_id, action=self.action, thread_id=self.thread_id)
+            self._stop.wait(CHAT_ACTION_INTERVAL_SEC)
+        self.stop()
+
+    def stop(self) -> None:
+        self._stop.set()
+        with _action_lock:
+            hbs = _heartbeats.get((self.chat_id, self.thread_id)) or []
+            if self in hbs:
+                hbs.remove(self)
+            if not hbs:
+                _heartbeats.pop((self.chat_id, self.thread_id), None)
+
+    def __enter__(self) -> "ChatActionHeartbeat":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def stop_chat_actions(chat_id: int, thread_id: Optional[int] = None) -> None:
+    """Гасит heartbeat-ы чата в теме thread_id и сбрасывает троттлинг её действий (сообщение
+    ушло — Telegram сам снял индикатор, следующий можно слать сразу)."""
+    with _action_lock:
+        hbs = list(_heartbeats.get((chat_id, thread_id)) or [])
+        for k in [k for k in _last_action if k[:2] == (chat_id, thread_id)]:
+            del _last_action[k]
+    for hb in hbs:
+        hb.stop()
+
 def set_message_reaction(chat_id: int, message_id: int, emoji: str, *, is_big: bool = False) -> bool:
     """Ставит эмодзи-реакцию на сообщение/пост (Bot API 7.0+).
 
@@ -178,7 +548,7 @@ def set_message_reaction(chat_id: int, message_id: int, emoji: str, *, is_big: b
         "is_big": is_big,
     }
     try:
-        r = requests.post(REACTION_URL, json=payload, timeout=REQUEST_TIMEOUT)
+        r = _tg_post("setMessageReaction", payload, wait=False, idempotent=True)
         if r.status_code != 200:
             logger.info("set_message_reaction non-200 (chat=%s msg=%s emoji=%s): %s",
                         chat_id, message_id, emoji, getattr(r, "text", "")[:200])
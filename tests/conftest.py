@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Модули репозитория лежат в корне (как в zip-е Lambda)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LAZY_INIT", "1")
+os.environ.setdefault("TELEGRAM_TOKEN", "test")
@@ -0,0 +1,111 @@
+"""Страницы истории: pack_page / unpack_page и compact_history на заглушке таблицы."""
+import copy
+from decimal import Decimal
+
+import pytest
+
+import dynamo_utils as d
+
+DKEY = "chat:1"
+BASE_TS = 1_700_000_000_000
+
+
+def _message(i):
+    # Числа из DynamoDB приходят Decimal
+    m = {"dialog_key": DKEY, "timestamp": Decimal(BASE_TS + i), "role": "user" if i % 2 == 0 else "assistant",
+         "content": f"реплика {i} " * (1 + i % 7), "from_user": "7" if i % 2 == 0 else "",
+         "from_username": "bob" if i % 2 == 0 else "", "to_user": "" if i % 2 == 0 else "7",
+         "created_at": "2024-01-01T00:00:00Z", "expire_at": Decimal(2_000_000_000 + i),
+         "tokens": Decimal(10 + i), "tokens_v": "abcd1234"}
+    if i % 5 == 0:
+        del m["tokens"], m["tokens_v"]
+    return m
+
+
+class _PagesTable:
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None):
+        key = (Item["dialog_key"], Item["page"])
+        if ConditionExpression and key in self.items:
+            raise Exception("An error occurred (ConditionalCheckFailedException)")
+        self.items[key] = copy.deepcopy(Item)
+
+    def query(self, KeyConditionExpression, ScanIndexForward=True, Limit=None):
+        items = sorted(self.items.values(), key=lambda x: x["page"], reverse=not ScanIndexForward)
+        return {"Items": copy.deepcopy(items[:Limit])}
+
+
+@pytest.fixture
+def store(monkeypatch):
+    messages = [_message(i) for i in range(173)]
+    pages = _PagesTable()
+
+    def tail_items(dialog_key, after_ts, limit, *, newest_first, consistent_read):
+        items = sorted((m for m in messages if m["timestamp"] > after_ts),
+                       key=lambda m: m["timestamp"], reverse=newest_first)
+        return copy.deepcopy(items[:limit])
+
+    monkeypatch.setattr(d, "MESSAGES_LAYOUT", "pages")
+    monkeypatch.setattr(d, "MESSAGE_PAGE_SIZE", 50)
+    monkeypatch.setattr(d, "message_pages_tbl", pages)
+    monkeypatch.setattr(d, "_tail_items", tail_items)
+    return messages, pages
+
+
+def _fields(m):
+    out = {k: m.get(k, "") for k in ("dialog_key", "role", "content", "from_user", "from_username",
+                                       "to_user", "tokens_v")}
+    out["timestamp"] = int(m["timestamp"])
+    out["tokens"] = int(m["tokens"]) if m.get("tokens") is not None else None
+    return out
+
+
+def test_page_round_trip_with_decimals():
+    messages = [_message(i) for i in range(12)]
+    back = d.unpack_page(DKEY, d.pack_page(messages))
+    assert [_fields(m) for m in back] == [_fields(m) for m in messages]
+    assert all(type(m["timestamp"]) is int for m in back)
+    assert all("created_at" not in m and "expire_at" not in m for m in back)
+
+
+def test_unpack_accepts_binary_wrapper():
+    class _Binary:  # boto3.dynamodb.types.Binary
+        def __init__(self, value):
+            self.value = value
+
+    messages = [_message(i) for i in range(3)]
+    assert d.unpack_page(DKEY, _Binary(d.pack_page(messages))) == d.unpack_page(DKEY, d.pack_page(messages))
+
+
+def test_compact_packs_full_pages_only(store):
+    messages, pages = store
+    assert d.compact_history(DKEY) == 150
+    assert len(pages.items) == 3
+    assert d.history_unpaged(DKEY) == 23
+    first = pages.items[(DKEY, BASE_TS)]
+    assert first["n"] == 50 and first["last_ts"] == BASE_TS + 49
+    assert first["expire_at"] == 2_000_000_000 + 49
+    assert d.unpack_page(DKEY, first["z"])[0]["content"] == messages[0]["content"]
+
+
+def test_compact_is_idempotent(store):
+    d.compact_history(DKEY)
+    assert d.compact_history(DKEY) == 0
+
+
+def test_compact_stops_at_page_limit(store, monkeypatch):
+    _, pages = store
+    monkeypatch.setattr(d, "MESSAGE_COMPACT_PAGES", 2)
+    assert d.compact_history(DKEY) == 100
+    assert len(pages.items) == 2
+    # Остаток не короче страницы — worker поставит следующую задачу
+    assert d.history_unpaged(DKEY) + 1 >= d.MESSAGE_PAGE_SIZE
+    assert d.compact_history(DKEY) == 50
+    assert d.history_unpaged(DKEY) == 23
+
+
+def test_compact_is_noop_for_items_layout(store, monkeypatch):
+    monkeypatch.setattr(d, "MESSAGES_LAYOUT", "items")
+    assert d.compact_history(DKEY) == 0
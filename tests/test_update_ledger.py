@@ -0,0 +1,116 @@
+"""Журнал update-ов: dynamo_utils.claim_update / set_update_stage на заглушке таблицы."""
+import copy
+from decimal import Decimal
+
+import pytest
+
+import dynamo_utils as d
+
+
+class _UpdatesTable:
+    """Заглушка таблицы Updates: условие захвата — как в claim_update, SET — любой."""
+
+    def __init__(self):
+        self.items = {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues, ConditionExpression=None, ReturnValues=None):
+        uid, v = Key["update_id"], ExpressionAttributeValues
+        item = self.items.get(uid)
+        if ConditionExpression:
+            if item is not None and not (item["stage"] != v[":done"] and item["lease_until"] < v[":now"]):
+                raise Exception("An error occurred (ConditionalCheckFailedException)")
+            item = self.items.setdefault(uid, {"update_id": uid})
+            item.setdefault("stage", v[":claimed"])
+            item["lease_until"] = Decimal(v[":lease"])
+            item["attempts"] = item.get("attempts", Decimal(0)) + v[":one"]
+            item.setdefault("expire_at", Decimal(v[":exp"]))
+            return {"Attributes": copy.deepcopy(item)}
+        item = self.items.setdefault(uid, {"update_id": uid})
+        for part in UpdateExpression[len("SET "):].split(", "):
+            name, val = part.split(" = ")
+            item[ExpressionAttributeNames[name]] = copy.deepcopy(v[val])
+        return {}
+
+    def get_item(self, Key, ConsistentRead=False):
+        item = self.items.get(Key["update_id"])
+        return {"Item": copy.deepcopy(item)} if item else {}
+
+
+@pytest.fixture
+def table(monkeypatch):
+    t = _UpdatesTable()
+    monkeypatch.setattr(d, "updates_tbl", t)
+    return t
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(d.time, "time", lambda: now[0])
+    return now
+
+
+def test_first_delivery_is_new(table, clock):
+    status, item = d.claim_update("1")
+    assert status == "new"
+    assert item["stage"] == "claimed"
+    assert item["lease_until"] == int(clock[0]) + d.UPDATE_LEASE_SEC
+
+
+def test_busy_while_lease_is_held(table, clock):
+    d.claim_update("1")
+    clock[0] += d.UPDATE_LEASE_SEC - 1
+    status, _ = d.claim_update("1")
+    assert status == "busy"
+
+
+def test_resume_after_lease_expiry_keeps_stage_and_fields(table, clock):
+    d.claim_update("1")
+    d.set_update_stage("1", "saved", saved_ts=123, text="привет")
+    clock[0] += d.UPDATE_LEASE_SEC + 1
+    status, item = d.claim_update("1")
+    assert status == "resume"
+    assert item["stage"] == "saved"
+    assert item["saved_ts"] == 123 and item["text"] == "привет"
+    assert int(item["attempts"]) == 2
+
+
+def test_released_lease_resumes_immediately(table, clock):
+    d.claim_update("1")
+    d.set_update_stage("1", "replied", unsent=["часть"], lease_until=0)
+    status, item = d.claim_update("1")
+    assert status == "resume"
+    assert item["unsent"] == ["часть"]
+
+
+def test_done_is_final(table, clock):
+    d.claim_update("1")
+    d.set_update_stage("1", "done")
+    assert table.items["1"]["lease_until"] == 0
+    clock[0] += d.UPDATE_LEASE_SEC + 1
+    status, item = d.claim_update("1")
+    assert status == "done"
+    assert int(item["attempts"]) == 1
+
+
+def test_ledger_unavailable_processes_as_new(monkeypatch):
+    class _Broken:
+        def update_item(self, **kw):
+            raise Exception("ResourceNotFoundException")
+
+    monkeypatch.setattr(d, "updates_tbl", _Broken())
+    assert d.claim_update("1") == ("new", {})
+
+
+@pytest.mark.parametrize("cur,stage,reached", [
+    (None, "claimed", True),
+    ("saved", "replied", False),
+    ("replied", "saved", True),
+    ("replied", "maintained", False),
+    ("maintained", "replied", True),
+    ("done", "maintained", True),
+])
+def test_stage_order(cur, stage, reached):
+    item = {"stage": cur} if cur else {}
+    assert d.update_stage_reached(item, stage) is reached
@@ -0,0 +1,131 @@
+# token_bench.py  —  точность локальной оценки токенов (claude_utils.TokenEstimator)
+"""Насколько локальная оценка токенов расходится с реальностью.
+
+  python token_bench.py usage <лог CloudWatch> [...]
+      По строкам `Claude usage ... prompt=… est=…` из логов worker-а: ошибка оценки
+      запроса (est) против фактического входа первого запроса хода (prompt). В prompt
+      входят ещё и определения инструментов, поэтому отдельно печатается медианный
+      сдвиг в токенах — это их цена, а не ошибка оценки текста.
+
+  python token_bench.py texts <samples.jsonl> [--fit] [--cache FILE]
+      Тексты ({"text": ...} на строку; подойдёт выгрузка Messages) против count_tokens
+      API (нужен ANTHROPIC_API_KEY; ответы кэшируются в FILE по хэшу текста). Сравнивает
+      старую оценку «4 символа = токен» с текущей; --fit подбирает цены символов
+      (TOKEN_RATES) методом наименьших квадратов.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+from typing import Dict, List, Sequence, Tuple
+
+from claude_utils import TokenEstimator, get_estimator, count_tokens_cached, _DEFAULT_RATES
+
+_USAGE_RE = re.compile(r"Claude usage .*?prompt=(\d+) est=(\d+)")
+
+
+def _stats(pairs: Sequence[Tuple[int, int]]) -> str:
+    """pairs: (оценка, факт) → bias / MAPE / p50 / p90 относительной ошибки."""
+    rel = sorted((est - real) / real for est, real in pairs if real > 0)
+    if not rel:
+        return "n=0"
+    abs_rel = sorted(abs(x) for x in rel)
+    pick = lambda xs, q: xs[min(int(q * len(xs)), len(xs) - 1)]
+    return (f"n={len(rel)} bias={sum(rel) / len(rel):+.1%} mape={sum(abs_rel) / len(abs_rel):.1%} "
+            f"p50={pick(abs_rel, 0.5):.1%} p90={pick(abs_rel, 0.9):.1%} "
+            f"under={sum(1 for x in rel if x < 0) / len(rel):.0%}")
+
+
+def bench_usage(paths: List[str]) -> None:
+    pairs = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                m = _USAGE_RE.search(line)
+                if m and int(m.group(1)) > 0:
+                    pairs.append((int(m.group(2)), int(m.group(1))))
+    print("est vs prompt:", _stats(pairs))
+    if pairs:
+        gaps = sorted(real - est for est, real in pairs)
+        print(f"median gap (tools, служебное): {gaps[len(gaps) // 2]} tokens")
+
+
+def _load_cache(path: str) -> Dict[str, int]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _true_counts(texts: List[str], cache_path: str) -> List[Tuple[str, int]]:
+    cache = _load_cache(cache_path)
+    out = []
+    for t in texts:
+        key = hashlib.sha1(t.encode("utf-8")).hexdigest()
+        if key not in cache:
+            n = count_tokens_cached(t)
+            if n is None:
+                continue
+            cache[key] = n
+        out.append((t, cache[key]))
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    return out
+
+
+def _solve(a: List[List[float]], b: List[float]) -> List[float]:
+    """Гаусс с выбором главного элемента; матрица маленькая (классы символов)."""
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        piv = max(range(col, n), key=lambda r: abs(m[r][col]))
+        m[col], m[piv] = m[piv], m[col]
+        if abs(m[col][col]) < 1e-12:
+            continue
+        for r in range(n):
+            if r != col:
+                k = m[r][col] / m[col][col]
+                m[r] = [x - k * y for x, y in zip(m[r], m[col])]
+    return [m[i][n] / m[i][i] if abs(m[i][i]) > 1e-12 else 0.0 for i in range(n)]
+
+
+def fit_rates(samples: List[Tuple[str, int]], ridge: float = 1.0) -> Dict[str, float]:
+    """Цены символов по (текст, истинные токены): ridge-МНК к ценам по умолчанию."""
+    est = TokenEstimator()
+    keys = list(_DEFAULT_RATES)
+    rows = [[est.char_counts(t).get(k, 0) for k in keys] for t, _ in samples]
+    prior = [_DEFAULT_RATES[k] for k in keys]
+    ata = [[sum(r[i] * r[j] for r in rows) + (ridge if i == j else 0.0) for j in range(len(keys))]
+           for i in range(len(keys))]
+    atb = [sum(r[i] * y for r, (_, y) in zip(rows, samples)) + ridge * prior[i] for i in range(len(keys))]
+    return {k: round(max(v, 0.0), 3) for k, v in zip(keys, _solve(ata, atb))}
+
+
+def bench_texts(path: str, *, fit: bool, cache_path: str) -> None:
+    with open(path, encoding="utf-8") as f:
+        texts = [str(json.loads(line).get("text") or json.loads(line).get("content") or "")
+                 for line in f if line.strip()]
+    samples = [(t, n) for t, n in _true_counts([t for t in texts if t.strip()], cache_path) if n > 0]
+    print("legacy len/4:", _stats([(len(t) // 4, n) for t, n in samples]))
+    print("estimator:   ", _stats([(get_estimator().text_tokens(t), n) for t, n in samples]))
+    if fit and samples:
+        rates = fit_rates(samples)
+        fitted = TokenEstimator(rates)
+        print("fitted:      ", _stats([(fitted.text_tokens(t), n) for t, n in samples]))
+        print("TOKEN_RATES=" + ",".join(f"{k}={v}" for k, v in rates.items()))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) >= 2 and args[0] == "usage":
+        bench_usage(args[1:])
+    elif len(args) >= 2 and args[0] == "texts":
+        cache = args[args.index("--cache") + 1] if "--cache" in args else os.path.join(
+            os.path.dirname(os.path.abspath(args[1])), ".token_bench_cache.json")
+        bench_texts(args[1], fit="--fit" in args, cache_path=cache)
+    else:
+        print(__doc__)
+        sys.exit(2)
@@ -1,17 +1,38 @@
 
+import time
+_INIT_T0 = time.perf_counter()  # замер холодного старта, см. coldstart.py
+
 import json
 import os
 import logging
-import boto3
 from typing import Any, Dict, Optional
 
+from coldstart import mark_init, log_invocation
+
+mark_init(_INIT_T0)
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")
 SQS_IS_FIFO = os.getenv("SQS_IS_FIFO", "0") == "1"
+# LAZY_INIT=1: boto3 импортируется и клиент создаётся при первой постановке в очередь —
+# update-ы без сообщения (my_chat_member, callback_query …) и битые запросы его не ждут.
+LAZY_INIT = os.getenv("LAZY_INIT", "1") == "1"
+
+sqs = None
 
-sqs = boto3.client("sqs")
+
+def _sqs_client():
+    global sqs
+    if sqs is None:
+        import boto3
+        sqs = boto3.client("sqs")
+    return sqs
+
+
+if not LAZY_INIT:
+    _sqs_client()
 
 def _parse_for_keys(update: Dict[str, Any]) -> Dict[str, Any]:
     msg = (update or {}).get("message") or (update or {}).get("edited_message") or (update or {}).get("channel_post") or {}
@@ -42,6 +63,7 @@ def _parse_for_keys(update: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 def lambda_handler(event, context):
+    log_invocation("webhook")
     try:
         body = event.get("body") if isinstance(event, dict) else None
         update = json.loads(body) if isinstance(body, str) else (event if isinstance(event, dict) else {})
@@ -55,6 +77,10 @@ def lambda_handler(event, context):
         return {"statusCode": 500, "body": "SQS not configured"}
 
     keys = _parse_for_keys(update)
+    if not keys["chat_id"]:
+        # Worker такие update-ы всё равно пропускает («No chat/message id») — не гоняем их через SQS
+        logger.info("No message in update %s, ignored", keys["update_id"] or "?")
+        return {"statusCode": 200, "body": "ignored"}
     # SQS не принимает атрибуты с пустым значением — добавляем только непустые
     msg_attrs = {
         k: {"DataType": "String", "StringValue": v}
@@ -72,7 +98,7 @@ def lambda_handler(event, context):
         params["MessageDeduplicationId"] = keys["update_id"] or params["MessageGroupId"]
 
     try:
-        resp = sqs.send_message(**params)
+        resp = _sqs_client().send_message(**params)
         logger.info("ENQUEUED to SQS: %s", resp.get("MessageId"))
         return {"statusCode": 200, "body": "queued"}
     except Exception as e:
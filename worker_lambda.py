@@ -1,50 +1,76 @@
 
+import time
+_INIT_T0 = time.perf_counter()  # замер холодного старта, см. coldstart.py
+
 import datetime
 import json
 import logging
+import math
 import os
-import time
-from typing import Any, Dict, Optional
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import boto3
 
 from dynamo_utils import (
-    get_user, save_user,
-    get_channel, save_channel,
+    get_channel, save_channel, update_roster,
     get_thread, save_thread,
     save_message, get_dialog_history,
-    get_latest_summary, get_latest_summary_item, save_summary,
     get_settings, save_settings, update_settings,
-    update_user_names,
-    update_user_profile,
-    get_user_profile,
+    upsert_user,
+    TurnContext, log_cache_stats,
+    MESSAGES_LAYOUT, MESSAGE_PAGE_SIZE, history_unpaged, summary_cursor, RECALL_ENABLED,
     get_user_facts, add_user_fact, remove_user_facts,
+    FACTS_STORE, get_user_fact_items, merge_fact_items, touch_user_facts,
+    claim_update, set_update_stage, update_stage_reached,
 )
 from claude_utils import (
-    num_tokens_from_messages,
+    content_tokens,
+    calibrated_tokens,
+    stored_tokens,
+    tokens_tag,
+    get_estimator,
+    TokenBudgeter,
+    build_system,
     generate_response,
-    summarize_history,
-    create_long_term_summary,
-    extract_topics,
-    choose_reaction,
+    choose_reactions,
+    reaction_worthy,
+)
+from maintenance_lambda import (
+    TASK_SUMMARY, TASK_LONG_TERM, TASK_COMPACT, TASK_RECALL, MIN_MSGS_FOR_SUMMARY,
+    summary_due, long_term_due, enqueue_tasks, unsummarized,
+)
+from recall_utils import (
+    RecallResult, recall, render_recall, rank_facts, RECALL_TOKEN_BUDGET, RECALL_INDEX_EVERY,
 )
 from telegram_utils import (
-    send_message, send_chat_action, get_file_base64, get_file_bytes, set_message_reaction,
+    send_message, get_file_bytes, set_message_reaction,
+    split_telegram, StreamingReply, ChatActionHeartbeat, stop_chat_actions,
+    TelegramRetryLater, TG_SEND_DEADLINE_SEC,
 )
+from image_utils import PreparedImage, release_image, submit_image
+from coldstart import mark_init, log_invocation
+import http_utils
+from http_utils import HTTP_CONNECT_TIMEOUT, log_http_stats
+
+mark_init(_INIT_T0)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "6000"))
 MAX_OUTPUT_TOKENS  = int(os.getenv("MAX_OUTPUT_TOKENS",  "800"))
-MIN_MSGS_FOR_SUMMARY   = int(os.getenv("MIN_MSGS_FOR_SUMMARY", "12"))
-SUMMARY_HISTORY_LIMIT  = int(os.getenv("SUMMARY_HISTORY_LIMIT", "60"))
-# Троттлинг: не перегенерировать краткую сводку чаще, чем раз в N секунд (раньше — каждый ход)
-SUMMARY_MIN_INTERVAL_SEC = int(os.getenv("SUMMARY_MIN_INTERVAL_SEC", "600"))
-# Долгосрочный профиль (private) обновляется раз в LONG_TERM_EVERY сообщений
-LONG_TERM_EVERY = int(os.getenv("LONG_TERM_EVERY", "50"))
 BASE_SYSTEM_PROMPT     = os.getenv("BASE_SYSTEM_PROMPT", "").strip()
 BOT_USERNAME = (os.getenv("BOT_USERNAME") or "").lstrip("@").lower()
 BOT_ID = int(os.getenv("BOT_ID", "0")) or None
 GROUP_SCOPE_DEFAULT = os.getenv("GROUP_SCOPE_DEFAULT", "hybrid").lower()
+# Prompt caching истории: начало окна истории выравнивается на «якорные» реплики пользователя
+# (в среднем одна на HISTORY_CACHE_CHUNK), поэтому trim сдвигает окно порциями, а не на одну
+# реплику за ход — префикс истории остаётся байт-в-байт одинаковым между соседними ходами. 0 — выкл.
+HISTORY_CACHE_CHUNK = int(os.getenv("HISTORY_CACHE_CHUNK", "8"))
+HISTORY_LIMIT = 120
 
 OPENWEATHERMAP_API_KEY = os.getenv("OPENWEATHERMAP_API_KEY", "")
 WEATHER_DEFAULT_CITY   = os.getenv("WEATHER_DEFAULT_CITY", "Moscow")
@@ -63,30 +89,206 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 STT_MODEL = os.getenv("STT_MODEL", "gpt-4o-mini-transcribe")
 VOICE_MAX_DURATION_SEC = int(os.getenv("VOICE_MAX_DURATION_SEC", "300"))
 
+# Параллельная обработка батча SQS: записи группируются по dialog_key, разные диалоги идут
+# в пуле потоков (не больше WORKER_CONCURRENCY), внутри диалога — строго по порядку.
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+
+# Чтения DynamoDB одного хода идут параллельно (пул живёт в тёплом контейнере)
+CONTEXT_READ_CONCURRENCY = int(os.getenv("CONTEXT_READ_CONCURRENCY", "6"))
+_read_pool = ThreadPoolExecutor(max_workers=CONTEXT_READ_CONCURRENCY, thread_name_prefix="ctx-read")
+
+# Склейка «очередей» сообщений: подряд идущие записи батча от одного автора в одном диалоге
+# сохраняются по отдельности, а ответ генерируется один — на последнюю. COALESCE_DEBOUNCE_SEC > 0
+# дополнительно ждёт перед генерацией и пропускает ход, если за это время автор дописал ещё
+# (актуально для standard-очереди, где записи одного диалога идут параллельно). 0 — выкл.
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1") == "1"
+COALESCE_DEBOUNCE_SEC = float(os.getenv("COALESCE_DEBOUNCE_SEC", "0"))
+
+# Журнал обработки update-ов (таблица UPDATES_TABLE, см. dynamo_utils.claim_update):
+# повторная доставка продолжает с пройденного этапа вместо нового вызова модели.
+UPDATE_LEDGER_ENABLED = os.getenv("UPDATE_LEDGER_ENABLED", "1") == "1"
+
+# Стриминг ответа правками сообщения (telegram_utils.StreamingReply):
+#   "private" — только личка (по умолчанию), "all" — везде, "off" — ответ целиком одним заходом.
+STREAMING_MODE = os.getenv("STREAMING_MODE", "private").lower()
+
 # Эмодзи-реакции на прочитанные, но НЕ отвеченные сообщения/посты (выборочно, через модель)
 REACTIONS_ENABLED = os.getenv("REACTIONS_ENABLED", "1") == "1"
+# Модель зовём только для сообщений, прошедших локальный префильтр (claude_utils.reaction_worthy),
+# не чаще раза в REACTION_CHAT_MIN_GAP_SEC на чат и сразу пачкой до REACTION_BATCH_MAX
+# накопившихся сообщений. Кандидаты старше REACTION_MAX_AGE_SEC выбрасываются.
+REACTION_PREFILTER = os.getenv("REACTION_PREFILTER", "1") == "1"
+REACTION_CHAT_MIN_GAP_SEC = float(os.getenv("REACTION_CHAT_MIN_GAP_SEC", "30"))
+REACTION_BATCH_MAX = max(1, int(os.getenv("REACTION_BATCH_MAX", "8")))
+REACTION_MAX_AGE_SEC = float(os.getenv("REACTION_MAX_AGE_SEC", "300"))
+
+
+class _ReactionQueue:
+    """Кандидаты на реакцию по чатам, в памяти тёплого контейнера.
+
+    add() — на «молчаливом» пути хода; flush(chat_id) — в конце группы записей диалога:
+    если с прошлого вызова модели для чата прошло достаточно времени, все накопленные
+    кандидаты уходят в один choose_reactions. Иначе ждут следующего flush этого чата
+    (в этом же контейнере) или устаревают. Реакции — best effort, потеря кандидата при
+    смене контейнера допустима.
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[int, List[Tuple[float, int, str]]] = {}
+        self._last_call: Dict[int, float] = {}
+        self.stats = {"seen": 0, "filtered": 0, "calls": 0, "set": 0}
+
+    def add(self, chat_id: int, message_id: int, text: str) -> bool:
+        t = (text or "").strip()
+        with self._lock:
+            self.stats["seen"] += 1
+        if len(t) < 2 or (REACTION_PREFILTER and not reaction_worthy(t)):
+            with self._lock:
+                self.stats["filtered"] += 1
+            return False
+        with self._lock:
+            q = self._pending.setdefault(chat_id, [])
+            q.append((time.time(), message_id, t))
+            del q[:-REACTION_BATCH_MAX]  # при переполнении важнее свежие
+        return True
+
+    def _take(self, chat_id: int) -> List[Tuple[float, int, str]]:
+        now = time.time()
+        with self._lock:
+            q = [c for c in self._pending.get(chat_id, []) if now - c[0] <= REACTION_MAX_AGE_SEC]
+            if not q:
+                self._pending.pop(chat_id, None)
+                return []
+            if now - self._last_call.get(chat_id, 0.0) < REACTION_CHAT_MIN_GAP_SEC:
+                self._pending[chat_id] = q
+                return []
+            self._pending.pop(chat_id, None)
+            self._last_call[chat_id] = now
+            if len(self._last_call) > 4096:
+                cutoff = now - REACTION_CHAT_MIN_GAP_SEC
+                for k in [k for k, ts in self._last_call.items() if ts < cutoff]:
+                    del self._last_call[k]
+            self.stats["calls"] += 1
+            return q
+
+    def flush(self, chat_id: int) -> None:
+        batch = self._take(chat_id)
+        if not batch:
+            return
+        emojis = choose_reactions([t for _, _, t in batch])
+        for (_, message_id, _), emoji in zip(batch, emojis):
+            if not emoji:
+                continue
+            ok = set_message_reaction(chat_id, message_id, emoji)
+            with self._lock:
+                self.stats["set"] += int(bool(ok))
+            logger.info("STEP4r reaction %s on %s -> %s", emoji, message_id, "ok" if ok else "fail")
+        logger.info("STEP4r reactions batch=%d set=%d", len(batch), sum(1 for e in emojis if e))
+
+    def log_stats(self, reset: bool = True) -> None:
+        with self._lock:
+            st = dict(self.stats)
+            if reset:
+                self.stats = dict.fromkeys(self.stats, 0)
+        if st["seen"]:
+            logger.info("REACTIONS seen=%d filtered=%d model_calls=%d set=%d pending_chats=%d",
+                        st["seen"], st["filtered"], st["calls"], st["set"], len(self._pending))
 
-def _maybe_react(chat_id: int, message_id: int, text: str) -> None:
-    """Выборочно ставит эмодзи-реакцию на прочитанное, но не отвеченное сообщение.
 
-    Вызывается на «молчаливом» пути (бот прочитал, но не отвечает). Модель сама решает,
-    реагировать ли (в большинстве случаев — нет). Любые сбои не влияют на основной поток.
+_reactions = _ReactionQueue()
+
+
+def _maybe_react(chat_id: int, message_id: int, text: str) -> bool:
+    """Ставит прочитанное, но не отвеченное сообщение в кандидаты на эмодзи-реакцию.
+
+    Вызывается на «молчаливом» пути (бот прочитал, но не отвечает). Сам вызов модели —
+    в _flush_reactions, пачкой на чат; модель решает, реагировать ли (в большинстве
+    случаев — нет). Любые сбои не влияют на основной поток.
     """
     if not REACTIONS_ENABLED:
-        return
-    t = (text or "").strip()
-    if len(t) < 2:
-        return
+        return False
     try:
-        emoji = choose_reaction(t)
-        if emoji:
-            ok = set_message_reaction(chat_id, message_id, emoji)
-            logger.info("STEP4r reaction %s -> %s", emoji, "ok" if ok else "fail")
-        else:
-            logger.info("STEP4r no reaction")
+        return _reactions.add(chat_id, message_id, text)
     except Exception as e:
         logger.warning("STEP4r reaction error: %s", e)
+        return False
+
+
+def _flush_reactions(chat_ids) -> None:
+    for chat_id in chat_ids:
+        try:
+            _reactions.flush(chat_id)
+        except Exception as e:
+            logger.warning("STEP4r reaction error: %s", e)
+
+
+_media_pool: Optional[ThreadPoolExecutor] = None
+_media_pool_lock = threading.Lock()
+
+
+def _media_executor() -> ThreadPoolExecutor:
+    global _media_pool
+    if _media_pool is None:
+        with _media_pool_lock:
+            if _media_pool is None:
+                _media_pool = ThreadPoolExecutor(max_workers=max(WORKER_CONCURRENCY, 1),
+                                                 thread_name_prefix="media")
+    return _media_pool
+
+
+class _MediaPrefetch:
+    """Медиа хода готовится в фоне, пока идут чтения DynamoDB.
+
+    Голосовое расшифровывается сразу после разбора update (текст нужен до сохранения и
+    гейта), картинки качаются и уменьшаются (image_utils) — сразу, если ответ почти
+    наверняка будет, иначе сразу после гейта; результат забирается перед вызовом модели.
+    cancel() — ход закончился: ещё не начатые задачи снимаются, начатые докачиваются в кэш
+    картинок (пригодятся последнему сообщению очереди). Future картинки общий для ходов с той
+    же картинкой (image_utils.submit_image) — его снимает release_image, когда не ждёт никто.
+    """
+
+    def __init__(self):
+        self._voice: Optional[Future] = None
+        self._images: Dict[str, Tuple[Future, Optional[str]]] = {}
+
+    def start_voice(self, file_id: str, duration: int) -> None:
+        if self._voice is None:
+            self._voice = _media_executor().submit(_transcribe_voice, file_id, duration)
+
+    @property
+    def voice_started(self) -> bool:
+        return self._voice is not None
+
+    def voice_result(self) -> Optional[str]:
+        try:
+            return self._voice.result() if self._voice is not None else None
+        except Exception as e:
+            logger.warning("STEP0v voice prefetch failed: %s", e)
+            return None
+
+    def start_images(self, refs: List[Tuple[str, Optional[str]]]) -> None:
+        for fid, uid in refs:
+            if fid and fid not in self._images:
+                self._images[fid] = (submit_image(fid, uid), uid)
+
+    def images(self, refs: List[Tuple[str, Optional[str]]]) -> List[Optional[PreparedImage]]:
+        self.start_images(refs)
+        out: List[Optional[PreparedImage]] = []
+        for fid, _ in refs:
+            try:
+                out.append(self._images[fid][0].result())
+            except Exception as e:
+                logger.warning("STEP5b image prefetch failed: %s", e)
+                out.append(None)
+        return out
+
+    def cancel(self) -> None:
+        if self._voice is not None:
+            self._voice.cancel()
+        for fid, (_, uid) in self._images.items():
+            release_image(fid, uid)
+        self._images.clear()
 
 
 def _transcribe_voice(file_id: str, duration: int) -> Optional[str]:
@@ -105,13 +307,13 @@ def _transcribe_voice(file_id: str, duration: int) -> Optional[str]:
     if ext == "oga":  # telegram-голосовые приходят .oga; OpenAI знает это как ogg
         ext = "ogg"
     try:
-        import requests
-        r = requests.post(
+        # Транскрибация без побочных эффектов — повтор после сбоя безопасен
+        r = http_utils.post(
             "https://api.openai.com/v1/audio/transcriptions",
             headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
             data={"model": STT_MODEL, "response_format": "text"},
             files={"file": (f"voice.{ext}", data, f"audio/{ext}")},
-            timeout=30,
+            timeout=(HTTP_CONNECT_TIMEOUT, 30), idempotent=True, retries=1,
         )
         if r.status_code != 200:
             logger.warning("STT error %s: %s", r.status_code, r.text[:200])
@@ -142,12 +344,11 @@ def _fetch_weather(city: str) -> str:
     if not OPENWEATHERMAP_API_KEY:
         return "Погода недоступна: не настроен OPENWEATHERMAP_API_KEY"
     try:
-        import requests
         url = (
             f"https://api.openweathermap.org/data/2.5/weather"
             f"?q={city}&appid={OPENWEATHERMAP_API_KEY}&units=metric&lang=ru"
         )
-        r = requests.get(url, timeout=5)
+        r = http_utils.get(url, timeout=(HTTP_CONNECT_TIMEOUT, 5))
         d = r.json()
         if r.status_code == 200:
             return (
@@ -169,12 +370,11 @@ def _fetch_forecast(city: str, day: str = "tomorrow") -> str:
     if not OPENWEATHERMAP_API_KEY:
         return "Прогноз недоступен: не настроен OPENWEATHERMAP_API_KEY"
     try:
-        import requests
         url = (
             f"https://api.openweathermap.org/data/2.5/forecast"
             f"?q={city}&appid={OPENWEATHERMAP_API_KEY}&units=metric&lang=ru"
         )
-        r = requests.get(url, timeout=6)
+        r = http_utils.get(url, timeout=(HTTP_CONNECT_TIMEOUT, 6))
         d = r.json()
         if r.status_code == 404:
             return f"Город '{city}' не найден. Уточни название."
@@ -413,18 +613,6 @@ def parse_scope_command(text: str, bot_username: str) -> Optional[str]:
                 return candidate
     return None
 
-def split_telegram(text: str, limit: int = 4000):
-    if not text:
-        return
-    buf, total = [], 0
-    for line in text.splitlines(True):
-        if total + len(line) > limit and buf:
-            yield "".join(buf)
-            buf, total = [], 0
-        buf.append(line); total += len(line)
-    if buf:
-        yield "".join(buf)
-
 def _parse_update(raw: str) -> Dict[str, Any]:
     update = json.loads(raw)
     msg = (update or {}).get("message") or (update or {}).get("edited_message") or (update or {}).get("channel_post") or {}
@@ -446,6 +634,8 @@ def _parse_update(raw: str) -> Dict[str, Any]:
     # Изображение: telegram присылает photo как массив размеров — берём крупнейший
     # в пределах бюджета по размеру; альтернативно — документ с image/* mime.
     photo_file_id = None
+    photo_unique_id = None  # общий для пересылок — ключ кэша подготовленной картинки
+    photo_size = None  # (width, height) — для оценки токенов картинки
     photos = msg.get("photo") or []
     if photos:
         ranked = sorted(photos, key=lambda p: (p.get("file_size") or (p.get("width", 0) * p.get("height", 0))))
@@ -458,10 +648,13 @@ def _parse_update(raw: str) -> Dict[str, Any]:
         if chosen is None:
             chosen = ranked[0]
         photo_file_id = chosen.get("file_id")
+        photo_unique_id = chosen.get("file_unique_id")
+        photo_size = (chosen.get("width"), chosen.get("height"))
     if not photo_file_id:
         doc = msg.get("document") or {}
         if str(doc.get("mime_type") or "").startswith("image/"):
             photo_file_id = doc.get("file_id")
+            photo_unique_id = doc.get("file_unique_id")
 
     # Голосовое сообщение (voice note)
     voice = msg.get("voice") or {}
@@ -472,6 +665,7 @@ def _parse_update(raw: str) -> Dict[str, Any]:
     is_topic = bool(msg.get("is_topic_message"))
 
     return {
+        "update_id": (update or {}).get("update_id"),
         "chat_id": chat_id,
         "chat_type": chat_type,
         "message_id": message_id,
@@ -483,6 +677,8 @@ def _parse_update(raw: str) -> Dict[str, Any]:
         "text": text,
         "entities": entities,
         "photo_file_id": photo_file_id,
+        "photo_unique_id": photo_unique_id,
+        "photo_size": photo_size,
         "voice_file_id": voice_file_id,
         "voice_duration": voice_duration,
         "is_topic": is_topic,
@@ -493,10 +689,282 @@ def _parse_update(raw: str) -> Dict[str, Any]:
         },
     }
 
-def _process_one(update_raw: str) -> str:
-    parsed = _parse_update(update_raw)
+def _fanout(reads: Dict[str, Callable[[], Any]], step: str, turn: TurnContext) -> Dict[str, Any]:
+    """Выполняет независимые чтения параллельно; логирует время каждого и общее.
+
+    Упавшее чтение даёт None (функции dynamo_utils и так деградируют в None/[]).
+    Время до модели ограничено самым медленным чтением, а не их суммой. В потоках пула
+    активен снимок хода turn — чтения и upsert-ы ложатся в него.
+    """
+    t0 = time.perf_counter()
+
+    def _timed(fn):
+        start = time.perf_counter()
+        try:
+            with turn.active():
+                return fn(), time.perf_counter() - start
+        except Exception as e:
+            logger.warning("%s read failed: %s", step, e)
+            return None, time.perf_counter() - start
+
+    futures = {name: _read_pool.submit(_timed, fn) for name, fn in reads.items()}
+    results, timings = {}, {}
+    for name, fut in futures.items():
+        results[name], timings[name] = fut.result()
+    logger.info("%s reads %s wall=%dms", step,
+                " ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()),
+                (time.perf_counter() - t0) * 1000)
+    return results
+
+
+# Отрисованный блок «Участники беседы» по чату: (roster_rev, блок). Блок меняется только со
+# сменой состава или имён (roster_rev), а не с каждой репликой — и так же редко сбрасывает
+# кэш промпта, частью которого является.
+_roster_blocks: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+_roster_blocks_lock = threading.Lock()
+_ROSTER_BLOCKS_MAX = 512
+
+
+def _render_participants(members: Dict[str, Dict[str, Any]]) -> str:
+    """{user_id: {username, first_name, ...}} → блок «Участники беседы» (пусто — пустая строка)."""
+    if not members:
+        return ""
+    lines = ["Участники беседы:"]
+    for uid, info in members.items():
+        name = info.get("first_name") or info.get("username") or f"User_{uid}"
+        line = f"- {name}"
+        if info.get("username"):
+            line += f" (@{info['username']})"
+        lines.append(f"{line}, ID:{uid}")
+    return "\n".join(lines)
+
+
+def _participants_block(chat_id: str, channel: Dict[str, Any]) -> str:
+    """Блок по составу из элемента канала; порядок — по user_id, чтобы не зависеть от seen."""
+    rev = int(channel.get("roster_rev") or 0)
+    with _roster_blocks_lock:
+        hit = _roster_blocks.get(chat_id)
+        if hit and hit[0] == rev:
+            _roster_blocks.move_to_end(chat_id)
+            return hit[1]
+    roster = channel.get("roster") or {}
+    block = _render_participants({uid: roster[uid] or {} for uid in sorted(roster)})
+    with _roster_blocks_lock:
+        _roster_blocks[chat_id] = (rev, block)
+        _roster_blocks.move_to_end(chat_id)
+        while len(_roster_blocks) > _ROSTER_BLOCKS_MAX:
+            _roster_blocks.popitem(last=False)
+    return block
+
+
+class DialogContext(NamedTuple):
+    """Снимок данных диалога для сборки промпта (читается один раз, после гейта)."""
+    summary_item: Optional[Dict[str, Any]]
+    history: List[Dict[str, Any]]
+    profiles: Dict[str, Optional[Dict[str, Any]]]  # {user_id: profile}
+    recall: Optional[RecallResult] = None          # давние реплики по текущему (RECALL_ENABLED)
+    facts: List[Dict[str, Any]] = []               # факты об авторе (get_user_fact_items)
+
+
+def _load_dialog_context(turn: TurnContext, dkey: str, user_id: Optional[int],
+                         author_profile: Optional[Dict[str, Any]],
+                         author_upsert: Optional[Callable[[], Any]] = None,
+                         query: str = "",
+                         roster: Optional[Dict[str, Any]] = None) -> DialogContext:
+    """Сводка и история — параллельно; профили всех авторов истории — одним BatchGetItem.
+    Всё ложится в снимок хода: повторные чтения (задачи обслуживания, факты) идут из него.
+    author_upsert — запись автора (upsert_user), идёт параллельно с чтениями; её профиль
+    заменяет author_profile. query — текст хода для поиска давних реплик (recall_utils),
+    тоже параллельно, как и факты автора из таблицы Facts (FACTS_STORE=items). roster —
+    состав группы из элемента канала: имена авторов из него не читаются из Users."""
+    reads: Dict[str, Callable[[], Any]] = {
+        "summary": lambda: turn.summary_item(dkey),
+        "history": lambda: turn.history(dkey, HISTORY_LIMIT, consistent_read=True),
+    }
+    if author_upsert is not None:
+        reads["author"] = author_upsert
+    if RECALL_ENABLED:
+        reads["recall"] = lambda: recall(dkey, query)
+    if user_id and FACTS_STORE == "items":
+        # profile={}: факты из profile.facts добавим ниже — по профилю после upsert-а
+        reads["facts"] = lambda: get_user_fact_items(str(user_id), profile={})
+    res = _fanout(reads, "STEP5", turn)
+    history = res.get("history") or []
+    profiles: Dict[str, Optional[Dict[str, Any]]] = {}
+    if user_id:
+        profiles[str(user_id)] = (res.get("author") or {}).get("profile") or author_profile
+    others = {(m.get("from_user") or "").strip() for m in history if m.get("role") == "user"}
+    for uid in others:
+        entry = (roster or {}).get(uid)
+        if entry and uid not in profiles:
+            profiles[uid] = {"first_name": entry.get("first_name") or "",
+                             "last_name": entry.get("last_name") or ""}
+    others = sorted(u for u in others if u and u not in profiles)
+    if others:
+        t0 = time.perf_counter()
+        users = turn.users(others)
+        for uid in others:
+            profiles[uid] = (users.get(uid) or {}).get("profile") if uid in users else None
+        logger.info("STEP5 batch_get_users n=%d %dms", len(others), (time.perf_counter() - t0) * 1000)
+    facts = merge_fact_items(res.get("facts") or [], profiles.get(str(user_id))) if user_id else []
+    return DialogContext(res.get("summary"), history, profiles, res.get("recall"), facts)
+
+
+def _newer_message_exists(dkey: str, saved_ts: int, user_id: Optional[int]) -> bool:
+    """Есть ли в истории более свежая реплика того же автора, чем сохранённая этим ходом."""
+    # Мимо снимка хода: ищем как раз чужие записи, сделанные после него
+    newest = get_dialog_history(dkey, limit=1, consistent_read=True, snapshot=False)
+    if not newest:
+        return False
+    m = newest[-1]
+    return (m.get("role") == "user"
+            and int(m.get("timestamp") or 0) > saved_ts
+            and (m.get("from_user") or "") == (str(user_id) if user_id else ""))
+
+
+def _process_one(update_raw: str, *, defer_reply: bool = False,
+                 burst: Optional[Dict[str, Any]] = None) -> str:
+    """Полный ход по одному update.
+
+    defer_reply — запись не последняя в «очереди» автора: сохраняем, но не отвечаем
+                  (возвращаем "Deferred", если иначе ответили бы).
+    burst       — сведения об отложенных записях той же очереди для последней записи:
+                  {"respond": bool, "photo_file_ids": [...], "photo_unique_ids": [...],
+                   "photo_sizes": [(w, h), ...]}.
+    """
+    try:
+        parsed = _parse_update(update_raw)
+    except (TypeError, ValueError) as e:
+        # Битое тело ретраем не вылечить — не возвращаем запись в очередь
+        logger.warning("Bad update payload, dropped: %s", e)
+        return "Bad payload"
     logger.info("STEP0 parsed")
 
+    if not (parsed["chat_id"] and parsed["message_id"]):
+        logger.info("No chat/message id → skip")
+        return "No-op"
+
+    # Повторная доставка того же update (ретрай SQS) не должна заново звать модель и
+    # дублировать ответ: журнал по update_id говорит, докуда дошла прошлая попытка.
+    ledger = _UpdateLedger(parsed.get("update_id"))
+    if ledger.status == "done":
+        logger.info("STEP0 duplicate update %s, already processed", ledger.key)
+        return "Duplicate"
+    if ledger.status == "busy":
+        # Ошибка → запись уйдёт на повтор, когда текущая обработка закончится или умрёт
+        raise RuntimeError(f"update {ledger.key} is being processed by another invocation")
+    if ledger.reached("replied"):
+        _resend_unsent(parsed, ledger)
+        if not ledger.reached("maintained"):
+            tasks = list(ledger.item.get("tasks") or [])
+            _enqueue_maintenance(ledger, tasks)
+            logger.info("STEP8 resumed after reply (%s)", ",".join(t["type"] for t in tasks) or "nothing due")
+        ledger.mark("done")
+        return "Resumed"
+    # Отложенные записи очереди уже подтверждены (done), и повтор последней записи придёт без
+    # них — поэтому сведения о них (ответить ли, картинки) живут в её журнале.
+    if burst and (burst.get("respond") or burst.get("photo_file_ids")):
+        if not ledger.item.get("burst"):
+            ledger.mark(ledger.item.get("stage") or "claimed", burst=_burst_for_ledger(burst))
+    elif ledger.item.get("burst"):
+        burst = _burst_from_ledger(ledger.item["burst"])
+        logger.info("STEP0 burst restored from the ledger (respond=%s, photos=%d)",
+                    burst["respond"], len(burst["photo_file_ids"]))
+
+    prefetch = _MediaPrefetch()
+    try:
+        with TurnContext() as turn:
+            result = _handle_update(parsed, ledger, prefetch, turn, defer_reply=defer_reply, burst=burst)
+    finally:
+        prefetch.cancel()
+        stop_chat_actions(parsed["chat_id"], parsed["thread_id"])
+    ledger.mark("done")
+    return result
+
+
+def _burst_for_ledger(burst: Dict[str, Any]) -> Dict[str, Any]:
+    """burst в виде, который примет DynamoDB (без кортежей)."""
+    return {"respond": bool(burst.get("respond")),
+            "photo_file_ids": list(burst.get("photo_file_ids") or []),
+            "photo_unique_ids": list(burst.get("photo_unique_ids") or []),
+            "photo_sizes": [list(sz) if sz else None for sz in burst.get("photo_sizes") or []]}
+
+
+def _burst_from_ledger(item: Dict[str, Any]) -> Dict[str, Any]:
+    return {"respond": bool(item.get("respond")),
+            "photo_file_ids": list(item.get("photo_file_ids") or []),
+            "photo_unique_ids": list(item.get("photo_unique_ids") or []),
+            "photo_sizes": [tuple(None if x is None else int(x) for x in sz) if sz else None for sz in item.get("photo_sizes") or []]}
+
+
+def _send_reply_parts(parsed: Dict[str, Any], parts: List[str], *,
+                      hold: bool = True) -> Tuple[List[str], float]:
+    """Отправляет части ответа по порядку; возвращает те, что упёрлись в лимиты Telegram,
+    и через сколько секунд их можно дослать. hold=False — отложить их некуда (нет журнала):
+    ждём паузу чата здесь же и отправляем без повтора."""
+    for i, part in enumerate(parts):
+        kw = dict(chat_type=parsed["chat_type"], thread_id=parsed["thread_id"],
+                  reply_to=parsed["message_id"])
+        try:
+            send_message(parsed["chat_id"], part, requeue=True, **kw)
+        except TelegramRetryLater as e:
+            if hold:
+                logger.warning("STEP7 %s; %d part(s) left", e, len(parts) - i)
+                return parts[i:], e.retry_after
+            logger.warning("STEP7 %s; no ledger, waiting", e)
+            time.sleep(min(e.retry_after, TG_SEND_DEADLINE_SEC))
+            send_message(parsed["chat_id"], part, **kw)
+    return [], 0.0
+
+
+def _enqueue_maintenance(ledger: "_UpdateLedger", tasks: List[Dict[str, Any]]) -> None:
+    """Ставит задачи обслуживания хода; этап maintained — повтор записи их уже не поставит."""
+    try:
+        if tasks and not enqueue_tasks(tasks):
+            return
+    except Exception as e:
+        logger.warning("STEP8 maintenance failed: %s", e)
+        return
+    ledger.mark("maintained")
+
+
+def _resend_unsent(parsed: Dict[str, Any], ledger: "_UpdateLedger") -> None:
+    """Повтор записи после 429: досылает части ответа, сохранённые в журнале."""
+    unsent = list(ledger.item.get("unsent") or [])
+    if not unsent:
+        return
+    left, retry_after = _send_reply_parts(parsed, unsent)
+    ledger.mark("replied", unsent=left, lease_until=0)
+    logger.info("STEP7 resent %d/%d rate-limited part(s)", len(unsent) - len(left), len(unsent))
+    if left:
+        raise TelegramRetryLater(parsed["chat_id"], retry_after)
+
+
+class _UpdateLedger:
+    """Прогресс обработки одного update в журнале (dynamo_utils.claim_update).
+
+    Без update_id или при UPDATE_LEDGER_ENABLED=0 — пустышка: всё как в первой попытке.
+    """
+
+    def __init__(self, update_id: Optional[Any]):
+        self.key = str(update_id) if (update_id is not None and UPDATE_LEDGER_ENABLED) else None
+        self.status, self.item = claim_update(self.key) if self.key else ("new", {})
+        if self.status == "resume":
+            logger.info("STEP0 retry of update %s from stage=%s", self.key, self.item.get("stage"))
+
+    def reached(self, stage: str) -> bool:
+        return update_stage_reached(self.item, stage)
+
+    def mark(self, stage: str, **fields: Any) -> None:
+        self.item.update(fields, stage=stage)
+        if self.key:
+            set_update_stage(self.key, stage, **fields)
+
+
+def _handle_update(parsed: Dict[str, Any], ledger: _UpdateLedger, prefetch: _MediaPrefetch,
+                   turn: TurnContext, *, defer_reply: bool, burst: Optional[Dict[str, Any]]) -> str:
+    """Ход по разобранному update; этапы saved/replied фиксируются в ledger,
+    медиа готовится в prefetch параллельно с чтениями, чтения и отложенные записи — в turn."""
     chat_id   = parsed["chat_id"]
     chat_type = parsed["chat_type"]
     msg_id    = parsed["message_id"]
@@ -511,19 +979,62 @@ def _process_one(update_raw: str) -> str:
     photo_file_id = parsed.get("photo_file_id")
     has_image = bool(photo_file_id and VISION_ENABLED)
 
-    if not (chat_id and msg_id):
-        logger.info("No chat/message id → skip")
-        return "No-op"
-
-    # STEP0v: голосовое → текст (до сохранения в историю и mention-детекции)
+    # STEP0v: голосовое → текст (до сохранения в историю и mention-детекции) — в фоне,
+    # параллельно с чтениями STEP1. При повторе после сохранения текст (с расшифровкой)
+    # берём из журнала.
     voice_file_id = parsed.get("voice_file_id")
-    if voice_file_id and VOICE_ENABLED:
-        if chat_type == "private":
-            try:
-                send_chat_action(chat_id, action="typing", thread_id=thread_id)
-            except Exception:
-                pass
-        transcript = _transcribe_voice(voice_file_id, parsed.get("voice_duration") or 0)
+    voice_from_ledger = ledger.reached("saved") and ledger.item.get("text") is not None
+    typing = None
+    if not voice_from_ledger and voice_file_id and VOICE_ENABLED:
+        # В личке «печатает…» держим всё время скачивания и STT (в группе ещё неизвестно,
+        # ответит ли бот)
+        typing = ChatActionHeartbeat(chat_id, thread_id=thread_id).start() if chat_type == "private" else None
+        prefetch.start_voice(voice_file_id, parsed.get("voice_duration") or 0)
+
+    # Картинки хода (и отложенных сообщений очереди) качаем сразу, если ответ почти наверняка
+    # будет: личка, упоминание бота или уже решённый ответ на очередь. Иначе — после гейта.
+    photo_refs = list(zip((burst or {}).get("photo_file_ids") or [],
+                          (burst or {}).get("photo_unique_ids") or [])) if VISION_ENABLED else []
+    if has_image:
+        photo_refs.append((photo_file_id, parsed.get("photo_unique_id")))
+    if photo_refs and (chat_type == "private" or (burst or {}).get("respond")
+                       or (BOT_USERNAME and detect_mention(text or "", entities, BOT_USERNAME,
+                                                           reply_to=reply_to, bot_id=BOT_ID))):
+        prefetch.start_images(photo_refs)
+
+    is_topic = bool(parsed.get("is_topic"))
+    dkey = dialog_key_for(chat_type, chat_id, user_id, thread_id, is_topic)
+    logger.info("ctx dkey=%s chat=%s/%s msg=%s", dkey, chat_type, chat_id, msg_id)
+
+    # Запись треда заводим только для настоящих форум-топиков — тех, по которым мы
+    # реально ведём отдельную историю (см. dialog_key_for). Для комментариев под
+    # постами канала это был чистый мусор: 913 записей в Threads на ровном месте.
+    thread_key = f"{chat_id}:{thread_id}" if (chat_type != "private" and thread_id and is_topic) else None
+
+    # Независимые чтения до гейта — параллельно (чтения после гейта см. _load_dialog_context).
+    # В личке ответ будет почти всегда: вместо чтения автора — сразу upsert_user (имена,
+    # profile, +1 к message_count) одним UpdateItem, запись из ALL_NEW идёт в промпт. Счётчик
+    # не увеличиваем повторно, если прошлая попытка уже дошла до сохранения реплики.
+    reads: Dict[str, Callable[[], Any]] = {"settings": lambda: get_settings(dkey)}
+    if user_id and chat_type == "private":
+        reads["user"] = lambda: upsert_user(str(user_id), username, first_name, last_name,
+                                            increment_messages=not ledger.reached("saved"))
+    elif user_id:
+        reads["user"] = lambda: turn.user(str(user_id))
+    if chat_type != "private":
+        reads["channel"] = lambda: get_channel(str(chat_id))
+    if thread_key:
+        reads["thread"] = lambda: get_thread(thread_key)
+    pre = _fanout(reads, "STEP1", turn)
+
+    if voice_from_ledger:
+        text = ledger.item["text"]
+    elif prefetch.voice_started:
+        try:
+            transcript = prefetch.voice_result()
+        finally:
+            if typing:
+                typing.stop()
         if transcript:
             voice_text = f"[голосовое сообщение] {transcript}"
             text = f"{text}\n{voice_text}".strip() if (text or "").strip() else voice_text
@@ -545,54 +1056,62 @@ def _process_one(update_raw: str) -> str:
     if has_image and not (text or "").strip():
         stored_text = "[изображение]"
 
-    is_topic = bool(parsed.get("is_topic"))
-    dkey = dialog_key_for(chat_type, chat_id, user_id, thread_id, is_topic)
-    logger.info("ctx dkey=%s chat=%s/%s msg=%s", dkey, chat_type, chat_id, msg_id)
-
+    author_profile = None
     try:
         # Профиль автора сохраняем в ЛЮБОМ типе чата. Раньше это делалось только в личке,
         # поэтому в группах бот не знал имён участников (63 из 76 авторов отсутствовали в
-        # Users) и не мог связать «Имя» с «@ником». Пишем только при реальном изменении —
-        # иначе это была бы лишняя запись в БД на каждое сообщение.
+        # Users) и не мог связать «Имя» с «@ником». В группе пишем только новое или
+        # изменившееся — иначе это была бы лишняя запись на каждое сообщение; запись
+        # отложена до конца хода: если бот ответит, её заберёт upsert со счётчиком (STEP5).
         if user_id:
-            existing = get_user(str(user_id))
-            if not existing:
-                save_user(str(user_id), username, first_name=first_name, last_name=last_name)
-            else:
-                prof = existing.get("profile") or {}
-                if ((username or "") != (existing.get("username") or "")
-                        or (first_name or "") != (prof.get("first_name") or "")
-                        or (last_name or "") != (prof.get("last_name") or "")):
-                    update_user_names(str(user_id), username, first_name, last_name)
+            existing = pre.get("user")
+            prof = dict((existing or {}).get("profile") or {})
+            if (not existing
+                    or (username or "") != (existing.get("username") or "")
+                    or (first_name or "") != (prof.get("first_name") or "")
+                    or (last_name or "") != (prof.get("last_name") or "")):
+                # В личке сюда попадаем, только если upsert в STEP1 не удался
+                upsert_user(str(user_id), username, first_name, last_name, defer=True,
+                            increment_messages=chat_type == "private" and not ledger.reached("saved"))
+                prof.update({"first_name": first_name or "", "last_name": last_name or ""})
+            author_profile = prof
         if chat_type != "private":
-            if not get_channel(str(chat_id)): save_channel(str(chat_id), None)
-            # Запись треда заводим только для настоящих форум-топиков — тех, по которым мы
-            # реально ведём отдельную историю (см. dialog_key_for). Для комментариев под
-            # постами канала это был чистый мусор: 913 записей в Threads на ровном месте.
-            if thread_id and is_topic:
-                thread_key = f"{chat_id}:{thread_id}"
-                if not get_thread(thread_key): save_thread(thread_key, "")
+            if not pre.get("channel"): save_channel(str(chat_id), None, defer=True)
+            if thread_key and not pre.get("thread"): save_thread(thread_key, "", defer=True)
+            # Автор — в состав чата (запись только при новых именах или устаревшем seen)
+            if user_id:
+                update_roster(str(chat_id), str(user_id), username, first_name, last_name,
+                              channel=pre.get("channel"), defer=True)
         logger.info("STEP1 ensured entities")
     except Exception as e:
         logger.warning("STEP1 ensure entities failed: %s", e)
 
-    try:
-        if (stored_text or "").strip():
-            save_message(
-                dkey,
-                "user",
-                stored_text,
-                from_user=str(user_id) if user_id else None,
-                from_username=username,
-            )
-            logger.info("STEP2 saved incoming")
-        else:
-            logger.info("STEP2 skip saving empty user message")
-    except Exception as e:
-        logger.warning("STEP2 save incoming failed: %s", e)
+    saved_ts = None
+    if ledger.reached("saved"):
+        saved_ts = int(ledger.item["saved_ts"]) if ledger.item.get("saved_ts") else None
+        logger.info("STEP2 incoming already saved by a previous attempt")
+    else:
+        try:
+            if (stored_text or "").strip():
+                saved_ts = save_message(
+                    dkey,
+                    "user",
+                    stored_text,
+                    from_user=str(user_id) if user_id else None,
+                    from_username=username,
+                    tokens=calibrated_tokens(stored_text),
+                    tokens_tag=tokens_tag(),
+                )
+                logger.info("STEP2 saved incoming")
+            else:
+                logger.info("STEP2 skip saving empty user message")
+        except Exception as e:
+            logger.warning("STEP2 save incoming failed: %s", e)
+        if saved_ts or not (stored_text or "").strip():
+            ledger.mark("saved", saved_ts=saved_ts, text=text)
 
     try:
-        st = get_settings(dkey)
+        st = pre.get("settings")
         if not st:
             mode = default_mode_for(chat_type)
             save_settings(dkey, mode=mode, meta=None)
@@ -629,55 +1148,81 @@ def _process_one(update_raw: str) -> str:
     except Exception as e:
         logger.warning("Scope command handling failed: %s", e)
 
-    try:
-        send_chat_action(chat_id, action="typing", thread_id=thread_id)
-    except Exception:
-        pass
-
     mentioned = detect_mention(text or "", entities, BOT_USERNAME, reply_to=reply_to, bot_id=BOT_ID) if BOT_USERNAME else False
+    # Раньше в той же очереди было сообщение, на которое бот ответил бы (напр., с упоминанием)
+    burst_respond = bool((burst or {}).get("respond"))
+    mode = (st or {}).get("mode") or default_mode_for(chat_type)
     try:
-        mode = (st or {}).get("mode") or default_mode_for(chat_type)
-        if not should_respond_by_mode(mode, chat_type, mentioned):
+        if not should_respond_by_mode(mode, chat_type, mentioned) and not burst_respond:
             logger.info("STEP4 skip by mode=%s; mentioned=%s; text=%r", mode, mentioned, (text[:80] if text else ""))
             # Бот молчит, но прочитал — выборочно ставим реакцию (кроме режима off)
             if mode != "off":
                 _maybe_react(chat_id, msg_id, text)
             return "Skipped"
-        logger.info("STEP4 mention ok (mode=%s, mentioned=%s)", mode, mentioned)
+        if defer_reply:
+            logger.info("STEP4 deferred: the burst is answered on its last message")
+            return "Deferred"
+        logger.info("STEP4 mention ok (mode=%s, mentioned=%s, burst=%s)", mode, mentioned, burst_respond)
+        if photo_refs:
+            prefetch.start_images(photo_refs)  # не начаты до гейта — качаем, пока читается контекст
     except Exception as e:
         logger.warning("STEP4 gate failed (continue anyway): %s", e)
 
-    # Стабильный префикс (BASE_SYSTEM_PROMPT) идёт первым — удобно для будущего prompt caching.
-    # Волатильную дату/время добавляем в самом КОНЦЕ системного промпта (см. ниже), чтобы она
-    # не ломала кэшируемый префикс.
+    # Debounce: ход пропускается, если автор успел дописать (ответит более свежий ход).
+    # Только там, где свежий ход гарантированно ответит сам: личка или режим always.
+    if COALESCE_DEBOUNCE_SEC > 0 and saved_ts and (chat_type == "private" or mode in ("always", "")):
+        time.sleep(COALESCE_DEBOUNCE_SEC)
+        try:
+            if _newer_message_exists(dkey, saved_ts, user_id):
+                logger.info("STEP4 superseded by a newer message from the same author")
+                return "Superseded"
+        except Exception as e:
+            logger.warning("STEP4 debounce check failed: %s", e)
+
+    # «печатает…» — только когда точно отвечаем, и до первого сообщения в чат: сборка
+    # контекста, скачивание картинок, генерация со всеми итерациями tool use. Гасит его
+    # send_message (первый кусок стрима или ответ), а на любом выходе — _process_one.
+    ChatActionHeartbeat(chat_id, thread_id=thread_id).start()
+
+    # System собирается из трёх секций (см. claude_utils.build_system):
+    #   base_parts    — BASE_SYSTEM_PROMPT, точка кэша;
+    #   profile_parts — профиль собеседника / карта участников, точка кэша (меняется редко);
+    #   system_parts  — хвост: подсказки по инструментам и STYLE_ANCHOR (от хода не зависят).
+    # Всё, что меняется от хода к ходу (сводка, scope с ID автора, факты, давние реплики,
+    # дата/время), в system не идёт: system стоит перед историей в порядке кэша, и любая
+    # правка в нём сбрасывала бы кэш всей истории. Это turn_notes — через volatile_note
+    # после точки кэша истории.
+    base_parts = [BASE_SYSTEM_PROMPT] if BASE_SYSTEM_PROMPT else []
+    profile_parts = []
     system_parts = []
-    if BASE_SYSTEM_PROMPT:
-        system_parts.append(BASE_SYSTEM_PROMPT)
-    try:
-        summary_item = get_latest_summary_item(dkey)
-    except Exception as e:
-        logger.warning("Get summary failed: %s", e)
-        summary_item = None
+    turn_notes = []
+    # В группе счётчик сообщений автора увеличиваем только для ходов с ответом — вместе
+    # с именами, одним upsert параллельно с чтением истории
+    author_upsert = None
+    if user_id and chat_type != "private":
+        author_upsert = lambda: upsert_user(str(user_id), username, first_name, last_name,
+                                            increment_messages=True)
+    ctx = _load_dialog_context(turn, dkey, user_id, author_profile, author_upsert, query=text or "",
+                               roster=(pre.get("channel") or {}).get("roster"))
+    author_profile = ctx.profiles.get(str(user_id)) if user_id else None
+    summary_item = ctx.summary_item
     summary = (summary_item or {}).get("summary")
     if summary:
-        system_parts.append(f"Dialog summary: {summary}")
-
-    # Кешируем профили всех участников диалога для использования в контексте
-    user_profiles_cache = {}  # {user_id: profile_data}
+        turn_notes.append(f"Dialog summary: {summary}")
 
+    # Профили всех участников диалога уже прочитаны пачкой в ctx.profiles (и лежат в снимке хода)
     def get_cached_profile(uid: str) -> Optional[Dict[str, Any]]:
-        """Получить профиль из кеша или загрузить из БД."""
-        if uid not in user_profiles_cache:
-            profile = get_user_profile(uid)
-            user_profiles_cache[uid] = profile
-        return user_profiles_cache.get(uid)
+        """Профиль из ctx.profiles, иначе — из снимка хода."""
+        if uid in ctx.profiles:
+            return ctx.profiles[uid]
+        return turn.profile(uid)
 
     # НОВОЕ: Долгосрочная память о пользователе (для private чатов)
     if chat_type == "private" and user_id:
         try:
             user_profile = get_cached_profile(str(user_id))
             if user_profile and any(user_profile.values()):  # Если профиль не пустой
-                profile_parts = []
+                prof_lines = []
 
                 first_name_p = user_profile.get("first_name", "")
                 username_str = f"@{username}" if username else ""
@@ -689,85 +1234,60 @@ def _process_one(update_raw: str) -> str:
                     header += f" {username_str}"
                 header += ":"
 
-                profile_parts.append(header)
+                prof_lines.append(header)
 
                 # Стиль общения
                 comm_style = user_profile.get("communication_style", "").strip()
                 if comm_style:
-                    profile_parts.append(f"- Стиль общения: {comm_style}")
+                    prof_lines.append(f"- Стиль общения: {comm_style}")
 
                 # Интересы
                 interests = user_profile.get("interests", [])
                 if interests:
-                    profile_parts.append(f"- Интересы: {', '.join(interests)}")
+                    prof_lines.append(f"- Интересы: {', '.join(interests)}")
 
                 # Долгосрочная память
                 long_summary = user_profile.get("long_term_summary", "").strip()
                 if long_summary:
-                    profile_parts.append(f"- Контекст прошлых бесед: {long_summary}")
+                    prof_lines.append(f"- Контекст прошлых бесед: {long_summary}")
 
                 # Последние темы
                 last_topics = user_profile.get("last_topics", [])
                 if last_topics:
-                    profile_parts.append(f"- Последние темы: {', '.join(last_topics)}")
-
-                # Явно сохранённые факты (долговременная память)
-                facts = user_profile.get("facts", [])
-                if facts:
-                    profile_parts.append("- Что важно помнить: " + "; ".join(facts))
+                    prof_lines.append(f"- Последние темы: {', '.join(last_topics)}")
 
-                if len(profile_parts) > 1:  # Если есть хоть что-то кроме заголовка
-                    profile_parts.append("\nОтвечай персонализированно, учитывая этот контекст и стиль собеседника.")
-                    system_parts.append("\n".join(profile_parts))
+                if len(prof_lines) > 1:  # Если есть хоть что-то кроме заголовка
+                    prof_lines.append("\nОтвечай персонализированно, учитывая этот контекст и стиль собеседника.")
+                    profile_parts.append("\n".join(prof_lines))
         except Exception as e:
             logger.warning("Failed to add user profile context: %s", e)
 
-    history = get_dialog_history(dkey, limit=120, consistent_read=True)
+    history = ctx.history
 
     # Determine group scope
     scope = ((st or {}).get("meta") or {}).get("group_scope") or GROUP_SCOPE_DEFAULT
     if chat_type != "private" and user_id:
-        # НОВОЕ: Собираем информацию об участниках
+        # Участники: из состава чата (roster в элементе канала, блок кэширован по roster_rev);
+        # канал без состава (заведён до него) — как раньше, по авторам истории.
+        # Карта не зависит от текущего автора (он назван в scope-инструкции ниже) —
+        # иначе кэшируемая секция менялась бы при каждой смене говорящего.
         try:
-            # Получить уникальных участников из истории
-            participants_info = {}
-            for m in history:
-                if m.get("role") == "user":
-                    fu = m.get("from_user", "").strip()
-                    if fu and fu not in participants_info:
-                        profile = get_cached_profile(fu)
-                        fu_username = m.get("from_username", "")
-                        participants_info[fu] = {
-                            "user_id": fu,
-                            "username": fu_username,
-                            "first_name": profile.get("first_name", "") if profile else "",
-                            "last_name": profile.get("last_name", "") if profile else "",
-                        }
-
-            # Формируем карту участников
-            if participants_info:
-                participants_lines = ["Участники беседы:"]
-                for uid, info in participants_info.items():
-                    name = info.get("first_name") or info.get("username") or f"User_{uid}"
-                    username_str = f"@{info['username']}" if info.get("username") else ""
-
-                    # Определяем роль
-                    if str(uid) == str(user_id):
-                        role = "текущий автор запроса"
-                    else:
-                        role = "участник"
-
-                    line = f"- {name}"
-                    if username_str:
-                        line += f" ({username_str})"
-                    line += f", ID:{uid}"
-                    if role:
-                        line += f" — {role}"
-
-                    participants_lines.append(line)
-
-                participants_map = "\n".join(participants_lines)
-                system_parts.append(participants_map + "\n")
+            participants_map = _participants_block(str(chat_id), pre.get("channel") or {})
+            if not participants_map:
+                participants_info = {}
+                for m in history:
+                    if m.get("role") == "user":
+                        fu = m.get("from_user", "").strip()
+                        if fu and fu not in participants_info:
+                            profile = get_cached_profile(fu)
+                            participants_info[fu] = {
+                                "username": m.get("from_username", ""),
+                                "first_name": profile.get("first_name", "") if profile else "",
+                                "last_name": profile.get("last_name", "") if profile else "",
+                            }
+                participants_map = _render_participants(participants_info)
+            if participants_map:
+                profile_parts.append(participants_map)
         except Exception as e:
             logger.warning("Failed to build participants map: %s", e)
 
@@ -789,14 +1309,18 @@ def _process_one(update_raw: str) -> str:
                 f"Различай говорящих по именам и префиксам. Отвечай автору запроса."
             )
 
-        system_parts.append(scope_msg)
+        turn_notes.append(scope_msg)
 
-        # Долговременная память о текущем авторе (работает и в группах)
+    # Долговременная память об авторе — не весь список, а FACTS_TOP_K фактов, подходящих к
+    # сообщению (затем недавние). Выбор меняется от хода к ходу, поэтому в turn_notes — после
+    # точки кэша истории: в system (хоть в профиле, хоть в хвосте) он сбрасывал бы кэш истории.
+    picked_facts: List[Dict[str, Any]] = []
+    if user_id:
         try:
-            author_prof = get_cached_profile(str(user_id))
-            author_facts = (author_prof or {}).get("facts", [])
-            if author_facts:
-                system_parts.append("Важно помнить о текущем авторе: " + "; ".join(author_facts))
+            picked_facts = rank_facts(ctx.facts, text or "")
+            if picked_facts:
+                label = "Что важно помнить о собеседнике: " if chat_type == "private" else "Важно помнить о текущем авторе: "
+                turn_notes.append(label + "; ".join(f["fact"] for f in picked_facts))
         except Exception as e:
             logger.warning("Failed to add author facts: %s", e)
 
@@ -805,6 +1329,9 @@ def _process_one(update_raw: str) -> str:
         if m.get("role") in ("user", "assistant"):
             content = m.get("content", "")
             fu = (m.get("from_user") or "").strip() if m.get("role") == "user" else ""
+            # Оценка сохранена вместе с репликой (save_message) — не пересчитываем,
+            # если её посчитал тот же оценщик
+            tok = stored_tokens(m)
 
             if m.get("role") == "user" and fu:
                 # УЛУЧШЕННЫЙ ПРЕФИКС: получаем профиль и формируем читаемое имя
@@ -824,63 +1351,83 @@ def _process_one(update_raw: str) -> str:
                 prefix += f", ID:{fu}]"
 
                 content = f"{prefix} {content}"
+                tok += content_tokens(prefix + " ")
 
             # Filtering by scope (только в группах)
             if chat_type != "private":
                 if scope == "initiator" and m.get("role") == "user" and fu and str(user_id) != fu:
                     continue
 
-            chat_msgs.append({"role": m["role"], "content": content, "_fu": fu})
-
-    system_prompt = "\n\n".join(system_parts)
-
-    def total_tokens():
-        return num_tokens_from_messages(_view(chat_msgs), system=system_prompt)
-
-    removed_turns = []
-
-    def _drop_oldest_turn():
-        nonlocal chat_msgs, removed_turns
-        if not chat_msgs:
-            return
-        if len(chat_msgs) >= 2 and chat_msgs[0]["role"] == "user" and chat_msgs[1]["role"] == "assistant":
-            removed_turns.append(chat_msgs.pop(0))
-            removed_turns.append(chat_msgs.pop(0))
-        else:
-            removed_turns.append(chat_msgs.pop(0))
-
-    def _drop_oldest_non_initiator_user():
-        nonlocal chat_msgs, removed_turns
-        for i, mm in enumerate(chat_msgs):
-            fu = (mm.get("_fu") or "").strip()
-            if mm.get("role") == "user" and fu and str(user_id) != fu:
-                removed_turns.append(chat_msgs.pop(i))
-                return True
-        return False
+            chat_msgs.append({"role": m["role"], "content": content, "_fu": fu,
+                              "_ts": int(m.get("timestamp") or 0), "_tok": 4 + tok})
 
-    # Prepare a view for token counting
+    system_prompt = "\n\n".join(base_parts + profile_parts + system_parts + turn_notes)
+    # Картинки подмешиваются после trim-а — их место в бюджете резервируем заранее, по
+    # размерам из Telegram (документ-картинка без размеров — по максимуму)
+    image_sizes = list((burst or {}).get("photo_sizes") or []) if VISION_ENABLED else []
+    if has_image:
+        image_sizes.append(parsed.get("photo_size"))
+    image_reserve = sum(get_estimator().image_tokens(*(sz or (None, None))) for sz in image_sizes)
+    # Давние реплики (recall) подмешиваются тоже после trim-а. Резерв — фактическая стоимость
+    # блока из найденного старше загруженной истории (найденное в ней и так в окне); если
+    # trim отрежет и его, блок дополнится в пределах освободившегося места.
+    recall_hits = ctx.recall.hits if ctx.recall else []
+    recall_reserve = 0
+    if recall_hits:
+        oldest_loaded = min((mm["_ts"] for mm in chat_msgs if mm.get("_ts")), default=0)
+        recall_reserve = content_tokens(render_recall(recall_hits, before_ts=oldest_loaded or int(time.time() * 1000)))
+    budgeter = TokenBudgeter(system_prompt, budget=MAX_CONTEXT_TOKENS - image_reserve - recall_reserve)
+
+    # Prepare a view for the model
     def _view(messages_list):
         return [{"role": x["role"], "content": x["content"]} for x in messages_list]
 
-    # Trim with preference depending on scope
-    while total_tokens() > MAX_CONTEXT_TOKENS and len(chat_msgs) > 1:
-        if chat_type != "private" and scope == "hybrid" and _drop_oldest_non_initiator_user():
-            continue
-        _drop_oldest_turn()
+    def _is_cache_anchor(mm) -> bool:
+        return mm.get("role") == "user" and mm.get("_ts", 0) % HISTORY_CACHE_CHUNK == 0
+
+    # Trim with preference depending on scope: в hybrid первыми уходят чужие реплики
+    # (initiator их уже отфильтровал выше, thread режет просто старые ходы)
+    def _non_initiator_user(mm) -> bool:
+        return mm.get("role") == "user" and bool(mm.get("_fu")) and str(user_id) != mm["_fu"]
+
+    chat_msgs, removed_turns = budgeter.trim(
+        chat_msgs,
+        drop_first=_non_initiator_user if (chat_type != "private" and scope == "hybrid") else None,
+    )
 
+    # Окно истории обрезано (бюджетом или лимитом загрузки) — дотягиваем его начало до
+    # ближайшего якоря. Якорь — свойство самого сообщения (timestamp), а не позиции, поэтому
+    # соседние ходы выбирают тот же якорь, пока бюджет не заставит перейти к следующему.
+    truncated = bool(removed_turns) or len(history) >= HISTORY_LIMIT
+    if HISTORY_CACHE_CHUNK > 0 and truncated:
+        # Ищем якорь не дальше 4 порций от начала — чтобы не выбросить почти всю историю
+        window = chat_msgs[:min(len(chat_msgs) - 1, 4 * HISTORY_CACHE_CHUNK)]
+        anchor = next((i for i, mm in enumerate(window) if _is_cache_anchor(mm)), None)
+        if anchor:
+            removed_turns.extend(chat_msgs[:anchor])
+            chat_msgs = chat_msgs[anchor:]
+
+    # Сводку отрезанного на горячем пути больше не строим (раньше — лишний вызов модели ДО
+    # ответа): в промпт идёт уже готовая сводка, а если она старше самой свежей отрезанной
+    # реплики — после ответа ставится задача обслуживания с until_ts.
+    trimmed_until = None
     if removed_turns:
-        try:
-            trimmed_simple = _view(removed_turns[-16:])
-            sm = summarize_history(trimmed_simple)
-            if sm:
-                save_summary(dkey, sm)
-                system_parts.append(f"Earlier dialog summary: {sm}")
-                system_prompt = "\n\n".join(system_parts)
-        except Exception as e:
-            logger.warning("Trim summary failed: %s", e)
+        newest_removed = max(mm.get("_ts", 0) for mm in removed_turns)
+        if summary_cursor(summary_item) < newest_removed:
+            trimmed_until = newest_removed
+
+    # Из найденного по индексу — только то, чего в окне промпта уже нет; в turn_notes, после
+    # точки кэша истории: найденное меняется от сообщения к сообщению
+    if recall_hits:
+        oldest_kept = min((mm.get("_ts", 0) for mm in chat_msgs if mm.get("_ts")), default=0)
+        room = recall_reserve + max(budgeter.budget - budgeter.total(chat_msgs), 0)
+        recall_block = render_recall(recall_hits, before_ts=oldest_kept or int(time.time() * 1000),
+                                     budget=min(RECALL_TOKEN_BUDGET, room))
+        if recall_block:
+            turn_notes.append(recall_block)
 
     messages = _view(chat_msgs)
-    logger.info("STEP5 messages_ready=%d tokens~%d", len(messages), total_tokens())
+    logger.info("STEP5 messages_ready=%d tokens~%d images~%d", len(messages), budgeter.total(chat_msgs), image_reserve)
 
     # --- Инструменты (tool use) ---
     client_tools = []
@@ -914,108 +1461,259 @@ def _process_one(update_raw: str) -> str:
             "пользуйся инструментами памяти (remember_fact/forget_fact)."
         )
     if hints:
-        system_prompt = system_prompt + "\n\n" + "\n".join(hints)
-
-    # Текущая дата/время МСК — волатильно, поэтому в самом конце (не ломает будущий кэш префикса)
-    _now_msk = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=3)))
-    system_prompt = system_prompt + "\n\n" + f"Текущая дата и время: {_now_msk.strftime('%d.%m.%Y %H:%M')} (МСК)"
+        system_parts.append("\n".join(hints))
 
     # Стиль-файрвол — последним, чтобы быть самой «свежей» инструкцией для модели
-    system_prompt = system_prompt + "\n\n" + STYLE_ANCHOR
+    system_parts.append(STYLE_ANCHOR)
+    system_blocks = build_system(base_parts, profile_parts, system_parts)
 
-    # --- Изображение: подмешиваем в последнее сообщение пользователя ---
-    if has_image:
-        b64, mime = get_file_base64(photo_file_id)
-        if b64:
-            for i in range(len(messages) - 1, -1, -1):
-                if messages[i]["role"] == "user":
-                    txt = messages[i]["content"]
-                    blocks = [{"type": "image", "source": {"type": "base64", "media_type": mime, "data": b64}}]
-                    if isinstance(txt, str) and txt.strip():
-                        blocks.append({"type": "text", "text": txt})
-                    else:
-                        blocks.append({"type": "text", "text": "[пользователь прислал изображение]"})
-                    messages[i]["content"] = blocks
-                    break
-            logger.info("STEP5b image attached (%s)", mime)
+    # Текущая дата/время МСК — волатильно, поэтому идёт после всех точек кэша (в конец хода)
+    _now_msk = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=3)))
+    date_note = f"(Текущая дата и время: {_now_msk.strftime('%d.%m.%Y %H:%M')} МСК)"
+    turn_notes.append(date_note)
+
+    # --- Изображения: подмешиваем в последнее сообщение пользователя ---
+    # (вместе с картинками из отложенных сообщений той же очереди)
+    # Картинки готовились в фоне (image_utils: уменьшение, перекодирование) — забираем
+    image_blocks = []
+    for img in prefetch.images(photo_refs) if photo_refs else []:
+        if img is not None:
+            image_blocks.append(img.block())
+            logger.info("STEP5b image attached (%s %sx%s, %dKB of %dKB)", img.media_type,
+                        img.width, img.height, img.nbytes // 1024, img.src_bytes // 1024)
         else:
             logger.warning("STEP5b image download failed, proceeding text-only")
+    if image_blocks:
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i]["role"] == "user":
+                txt = messages[i]["content"]
+                blocks = list(image_blocks)
+                if isinstance(txt, str) and txt.strip():
+                    blocks.append({"type": "text", "text": txt})
+                else:
+                    blocks.append({"type": "text", "text": "[пользователь прислал изображение]"})
+                messages[i]["content"] = blocks
+                break
+
+    # Стриминг: первый кусок ответа уходит в чат, пока модель ещё пишет остальное
+    stream = None
+    if STREAMING_MODE == "all" or (STREAMING_MODE == "private" and chat_type == "private"):
+        stream = StreamingReply(chat_id, chat_type=chat_type, thread_id=thread_id, reply_to=msg_id)
 
     ai_resp = generate_response(
         messages,
-        system=system_prompt,
+        system=system_blocks,
         max_tokens=MAX_OUTPUT_TOKENS,
         tools=active_tools,
         tool_executor=_make_tool_executor(str(user_id) if user_id else None) if active_tools else None,
+        cache_history=True,
+        volatile_note="\n\n".join(turn_notes),
+        on_text=stream.update if stream else None,
     )
     if (ai_resp or "").strip().lower() in {"assistant","system","user",""}:
         logger.warning("STEP6 non-text placeholder from model: %r", ai_resp)
         ai_resp = "⚠️ Пустой ответ модели. Зафиксировал это в логах."
     logger.info("STEP6 ai_len=%d", len(ai_resp))
 
+    # Части, упёршиеся в лимиты Telegram, уходят в журнал и досылаются повтором записи
+    # через retry_after; без журнала их некуда отложить — ждём паузу чата тут же
+    unsent: List[str] = []
+    retry_after = 0.0
     try:
-        save_message(dkey, "assistant", ai_resp, to_user=str(user_id) if user_id else None)
+        if stream is not None and stream.started:
+            ok = stream.finish(ai_resp)
+            logger.info("STEP7 sent (streamed, %d parts%s)", len(stream.sent), "" if ok else ", incomplete")
+            if not ok:
+                # Не запостившиеся части: после 429 — в журнал, иначе — обычной отправкой
+                rest = [p for p in split_telegram(ai_resp) if p.strip()][len(stream.sent):]
+                if stream.rate_limited and ledger.key:
+                    unsent, retry_after = rest, stream.retry_after
+                else:
+                    unsent, retry_after = _send_reply_parts(parsed, rest, hold=bool(ledger.key))
+        else:
+            unsent, retry_after = _send_reply_parts(parsed, [p for p in split_telegram(ai_resp) if p is not None],
+                                                    hold=bool(ledger.key))
+            logger.info("STEP7 sent%s", f" ({len(unsent)} part(s) rate limited)" if unsent else "")
+    except Exception as e:
+        logger.exception("TELEGRAM SEND FAILED: %r", e)
+
+    # Запись ответа — отложенная (уйдёт в flush ниже), а оценка токенов при калибровке —
+    # сетевой вызов, поэтому после отправки
+    try:
+        save_message(dkey, "assistant", ai_resp, to_user=str(user_id) if user_id else None,
+                     tokens=calibrated_tokens(ai_resp), tokens_tag=tokens_tag(), defer=True)
     except Exception as e:
         logger.warning("Save assistant failed: %s", e)
+
+    # Отложенные записи хода (ответ, счётчики и имена, новые канал/тред STEP1)
+    # — уже после отправки: одним BatchWriteItem и одним UpdateItem на профиль.
+    # До этапа replied: повтор записи после него не перезаписывает ответ.
     try:
-        for part in (p for p in split_telegram(ai_resp) if p is not None):
-            send_message(chat_id, part, chat_type=chat_type, thread_id=thread_id, reply_to=msg_id)
-        logger.info("STEP7 sent")
+        turn.flush()
     except Exception as e:
-        logger.exception("TELEGRAM SEND FAILED: %r", e)
+        logger.warning("STEP7 turn flush failed: %s", e)
+    try:
+        # Факты, совпавшие с сообщением, — использованы: поднимаются в ранжировании
+        touch_user_facts(str(user_id), [f for f in picked_facts if f.get("_rel")])
+    except Exception as e:
+        logger.warning("STEP7 touch facts failed: %s", e)
+
+    # STEP8: обслуживание памяти — задачами в очередь обслуживания (maintenance_lambda),
+    # а не вызовами модели внутри этого хода. Решение «пора ли» — по уже прочитанным данным,
+    # без новых чтений; обработчик задачи перепроверяет его (задачи идемпотентны).
+    #  - Краткая сводка: рост токенов после её курсора и время, либо отрезанные trim-ом
+    #    реплики, которых она не покрывает.
+    #  - Долгосрочный профиль (private): набралось LONG_TERM_EVERY сообщений с прошлого раза.
+    #  - Страницы истории (MESSAGES_LAYOUT=pages): хвост с ответом дорос до страницы.
+    #  - Индекс памяти (RECALL_ENABLED): за его курсором набралось RECALL_INDEX_EVERY реплик.
+    # Задачи записываем в журнал вместе с этапом replied: повтор после отправки ответа
+    # только поставит их, не вызывая модель, — если их ещё не поставили (этап maintained).
+    tasks = []
+    try:
+        fresh = unsummarized(history, summary_item)
+        new_tokens = sum(stored_tokens(m) for m in fresh) + content_tokens(ai_resp or "")
+        enough = trimmed_until or summary_item or len(fresh) >= MIN_MSGS_FOR_SUMMARY
+        if enough and summary_due(summary_item, until_ts=trimmed_until, new_tokens=new_tokens):
+            task = {"type": TASK_SUMMARY, "dialog_key": dkey}
+            if trimmed_until:
+                task["until_ts"] = trimmed_until
+            tasks.append(task)
+        if chat_type == "private" and user_id:
+            # message_count уже с этим сообщением (upsert_user в STEP1)
+            if long_term_due(author_profile):
+                tasks.append({"type": TASK_LONG_TERM, "dialog_key": dkey,
+                              "user_id": str(user_id), "username": username})
+        if MESSAGES_LAYOUT == "pages" and history_unpaged(dkey) + 1 >= MESSAGE_PAGE_SIZE:
+            tasks.append({"type": TASK_COMPACT, "dialog_key": dkey})
+        if ctx.recall is not None:
+            # +1 — ответ этого хода
+            unindexed = sum(1 for m in ctx.history if int(m.get("timestamp") or 0) > ctx.recall.indexed_until) + 1
+            if unindexed >= RECALL_INDEX_EVERY:
+                tasks.append({"type": TASK_RECALL, "dialog_key": dkey})
+    except Exception as e:
+        logger.warning("STEP8 maintenance check failed: %s", e)
+    if unsent:
+        # lease_until=0: повтор записи не должен ждать истечения лизы этой попытки. Задачи
+        # поставит он, дослав части: иначе каждый повтор после 429 ставил бы их заново.
+        # Запись уходит на повтор (ветка replied в _process_one дошлёт только эти части).
+        ledger.mark("replied", tasks=tasks, unsent=unsent, lease_until=0)
+        logger.info("STEP8 deferred to the retry (%s)", ",".join(t["type"] for t in tasks) or "nothing due")
+        raise TelegramRetryLater(chat_id, retry_after)
+    ledger.mark("replied", tasks=tasks)
+    _enqueue_maintenance(ledger, tasks)
+    logger.info("STEP8 done (%s)", ",".join(t["type"] for t in tasks) or "nothing due")
 
-    # НОВОЕ: Обновить счётчик сообщений пользователя
-    if user_id:
+    return "OK"
+
+def _record_dialog_key(r: Dict[str, Any]) -> str:
+    """dialog_key SQS-записи: атрибут от webhook → MessageGroupId (FIFO) → разбор тела.
+
+    Записи с одним ключом обрабатываются строго по порядку, разные ключи — параллельно.
+    """
+    attr = ((r.get("messageAttributes") or {}).get("dialog_key") or {}).get("stringValue")
+    if attr:
+        return attr
+    group = (r.get("attributes") or {}).get("MessageGroupId")
+    if group:
+        return group
+    try:
+        p = _parse_update(r.get("body") or "{}")
+        return dialog_key_for(p["chat_type"], p["chat_id"], p["user_id"], p["thread_id"], bool(p.get("is_topic")))
+    except Exception:
+        return r.get("messageId") or ""
+
+
+def _record_peek(r: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        return _parse_update(r.get("body") or "{}")
+    except Exception:
+        return {}
+
+
+def _process_group(records: List[Dict[str, Any]]) -> List[str]:
+    """Обрабатывает записи одного диалога по порядку; возвращает messageId неудачных.
+
+    Подряд идущие записи одного автора — «очередь»: все сохраняются, отвечаем один раз,
+    на последнюю (см. COALESCE_ENABLED). После первой ошибки остаток группы не трогаем и
+    тоже отдаём на повтор — иначе при ретрае сообщения диалога пришли бы в модель не по
+    порядку (так же требует FIFO).
+    """
+    peeks = [_record_peek(r) for r in records]
+    try:
+        return _process_records(records, peeks)
+    finally:
+        # Кандидаты на реакцию, накопленные группой, — одним вызовом модели на чат
+        if REACTIONS_ENABLED:
+            _flush_reactions({p["chat_id"] for p in peeks if p.get("chat_id")})
+
+
+def _process_records(records: List[Dict[str, Any]], peeks: List[Dict[str, Any]]) -> List[str]:
+    authors = [p.get("user_id") for p in peeks]
+    burst: Dict[str, Any] = {"respond": False, "photo_file_ids": [], "photo_unique_ids": [], "photo_sizes": []}
+    for i, r in enumerate(records):
+        has_next = (COALESCE_ENABLED and i + 1 < len(records)
+                    and authors[i] is not None and authors[i + 1] == authors[i])
         try:
-            update_user_profile(str(user_id), increment_messages=True)
+            result = _process_one(r.get("body"), defer_reply=has_next, burst=burst)
+            logger.info("DONE record %s -> %s", r.get("messageId"), result)
+        except TelegramRetryLater as e:
+            logger.warning("Record %s deferred: %s", r.get("messageId"), e)
+            _retry_records_in(records[i:], e.retry_after)
+            return [x.get("messageId") for x in records[i:]]
         except Exception as e:
-            logger.warning("Failed to increment message count: %s", e)
+            logger.exception("Record failed: %r", e)
+            return [x.get("messageId") for x in records[i:]]
+        if has_next:
+            if result == "Deferred":
+                burst["respond"] = True
+                p = peeks[i]
+                if p.get("photo_file_id"):
+                    burst["photo_file_ids"].append(p["photo_file_id"])
+                    burst["photo_unique_ids"].append(p.get("photo_unique_id"))
+                    burst["photo_sizes"].append(p.get("photo_size"))
+        else:
+            burst = {"respond": False, "photo_file_ids": [], "photo_unique_ids": [], "photo_sizes": []}
+    return []
 
-    # STEP8: обновление памяти.
-    #  - Краткая сводка троттлится по времени (раньше регенерилась КАЖДЫЙ ход — лишний вызов Claude).
-    #  - Долгосрочный профиль (private) обновляется раз в LONG_TERM_EVERY сообщений
-    #    (раньше ветка была мёртвой: full брался с limit=24, а проверялось len>=50).
-    try:
-        full = get_dialog_history(dkey, limit=MIN_MSGS_FOR_SUMMARY * 2, consistent_read=True)
-        if len(full) >= MIN_MSGS_FOR_SUMMARY:
-            last_ts = (summary_item or {}).get("timestamp")
-            now_ms = int(time.time() * 1000)
-            stale = (last_ts is None) or (now_ms - int(last_ts) > SUMMARY_MIN_INTERVAL_SEC * 1000)
-            if stale:
-                sm = summarize_history(full[-SUMMARY_HISTORY_LIMIT:])
-                if sm:
-                    save_summary(dkey, sm)
-                logger.info("STEP8 summary refreshed")
-            else:
-                logger.info("STEP8 summary skipped (throttled)")
 
-        # Долгосрочный профиль — только private, раз в LONG_TERM_EVERY сообщений
-        if chat_type == "private" and user_id:
-            prof = get_user_profile(str(user_id)) or {}
-            mc = int(prof.get("message_count", 0) or 0)
-            if mc >= LONG_TERM_EVERY and mc % LONG_TERM_EVERY == 0:
-                try:
-                    hist = get_dialog_history(dkey, limit=80, consistent_read=True)
-                    user_info = {"first_name": prof.get("first_name", ""), "username": username}
-                    long_summary = create_long_term_summary(hist[-80:], user_info)
-                    recent_topics = extract_topics(hist[-20:])
-                    if long_summary or recent_topics:
-                        update_user_profile(
-                            str(user_id),
-                            long_term_summary=long_summary if long_summary else None,
-                            last_topics=recent_topics if recent_topics else None,
-                        )
-                    logger.info("Updated long-term profile for user %s (mc=%d)", user_id, mc)
-                except Exception as e:
-                    logger.warning("Failed to update long-term profile: %s", e)
+_sqs = None
+_sqs_lock = threading.Lock()
 
-        logger.info("STEP8 done")
-    except Exception as e:
-        logger.warning("Update summary failed: %s", e)
 
-    return "OK"
+def _sqs_client():
+    """Клиент нужен только записям, отложенным по 429, — создаётся при первой такой."""
+    global _sqs
+    with _sqs_lock:
+        if _sqs is None:
+            _sqs = boto3.client("sqs")
+    return _sqs
+
+
+def _retry_records_in(records: List[Dict[str, Any]], delay: float) -> None:
+    """Записи, отданные на повтор из-за лимитов Telegram, вернутся через retry_after, а не по
+    VisibilityTimeout очереди (70 с). Не вышло — вернутся по нему, как любая ошибка."""
+    by_queue: Dict[str, List[Dict[str, Any]]] = {}
+    for r in records:
+        arn = (r.get("eventSourceARN") or "").split(":")
+        if len(arn) == 6 and r.get("receiptHandle"):
+            url = f"https://sqs.{arn[3]}.amazonaws.com/{arn[4]}/{arn[5]}"
+            by_queue.setdefault(url, []).append(r)
+    timeout = max(1, int(math.ceil(delay)))
+    for url, recs in by_queue.items():
+        for i in range(0, len(recs), 10):
+            entries = [{"Id": str(n), "ReceiptHandle": r["receiptHandle"], "VisibilityTimeout": timeout}
+                       for n, r in enumerate(recs[i:i + 10])]
+            try:
+                r = _sqs_client().change_message_visibility_batch(QueueUrl=url, Entries=entries)
+                if r.get("Failed"):
+                    logger.warning("ChangeMessageVisibility failed for %d record(s): %s",
+                                   len(r["Failed"]), r["Failed"][0].get("Message"))
+            except Exception as e:
+                logger.warning("ChangeMessageVisibility failed: %s", e)
+
 
 def lambda_handler(event, context):
+    log_invocation("worker")
     try:
         records = event.get("Records", [])
     except Exception:
@@ -1024,12 +1722,24 @@ def lambda_handler(event, context):
         logger.info("No SQS records")
         return {"statusCode": 200, "body": "no records"}
 
+    groups: Dict[str, List[Dict[str, Any]]] = {}
     for r in records:
-        try:
-            body = r.get("body")
-            result = _process_one(body)
-            logger.info("DONE record %s -> %s", r.get("messageId"), result)
-        except Exception as e:
-            logger.exception("Record failed: %r", e)
-
-    return {"statusCode": 200, "body": "ok"}
+        groups.setdefault(_record_dialog_key(r), []).append(r)
+
+    failed: List[str] = []
+    if len(groups) == 1 or WORKER_CONCURRENCY <= 1:
+        for recs in groups.values():
+            failed.extend(_process_group(recs))
+    else:
+        workers = min(WORKER_CONCURRENCY, len(groups))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for res in pool.map(_process_group, groups.values()):
+                failed.extend(res)
+    logger.info("BATCH records=%d dialogs=%d failed=%d", len(records), len(groups), len(failed))
+    log_cache_stats()
+    log_http_stats()
+    _reactions.log_stats()
+
+    # Partial batch response: SQS повторит только неудачные записи
+    # (у event source mapping должен быть включён ReportBatchItemFailures).
+    return {"batchItemFailures": [{"itemIdentifier": mid} for mid in failed if mid]}